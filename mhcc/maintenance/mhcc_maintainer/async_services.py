@@ -0,0 +1,433 @@
+"""asyncio counterparts of the FusionTables service methods used by the maintenance jobs"""
+import asyncio
+import json
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+from google.auth.transport.requests import Request
+from httplib2 import Response
+
+from services import FusionTableHandler
+from services import FusionTableRequestPlanner
+from services import GoogleService
+from services import HttpError
+from services import HttpPool
+from services import print_progress_bar
+from services import _is_throttled
+
+
+async def _gather_or_cancel(aws) -> list:
+    '''Run the given awaitables concurrently, and cancel the unfinished ones if any of them fails.
+
+@params:
+    aws: iterable, the coroutines (or futures) to run.
+
+@return: list, the results of the awaitables, in the order they were given.
+    '''
+    tasks = [asyncio.ensure_future(x) for x in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+
+class AsyncFusionTableHandler(FusionTableRequestPlanner):
+    """FusionTables service for coroutines, with the request surface of FusionTableHandler that the
+maintenance jobs use.
+
+Requests are sent with aiohttp rather than httplib2, so many queries and task polls can be in
+flight from a single thread. At most `max_concurrency` requests are sent at once. The requests
+are paced by the same RateGovernor, and retried under the same RetryPolicy, as the synchronous
+handlers, and use (and refresh) the same credentials as them. Page sizes, rowid statements and
+backup names are planned as FusionTableHandler plans them (see FusionTableRequestPlanner). Call
+close() (or use the handler as an "async with" context manager) to release its connections.
+    """
+    BASE_URL = 'https://www.googleapis.com/fusiontables/v2/'
+    # The longest URI that is sent as a GET. Longer queries are sent in a POST body instead.
+    MAX_URI_LENGTH = 2048
+    # The default number of requests that may be in flight at once.
+    MAX_CONCURRENT_REQUESTS = 32
+    # The number of seconds after which a single request is abandoned (and possibly retried).
+    REQUEST_TIMEOUT = 300.
+    retry_policy = GoogleService.retry_policy
+    rate_governor = GoogleService.rate_governor
+
+    def __init__(self, credentials: 'google.auth.credentials.Credentials', max_concurrency: int = MAX_CONCURRENT_REQUESTS):
+        super().__init__()
+        self.__credentials = HttpPool.for_credentials(credentials).credentials
+        self.__api = 'fusiontablesv2'
+        self.max_concurrency = max(1, max_concurrency)
+        self.__session: aiohttp.ClientSession = None
+        self.__semaphore: asyncio.Semaphore = None
+        self.__refresh_lock: asyncio.Lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close the handler's connections. The handler opens new ones if it is used again."""
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Get the handler's HTTP session, creating it (in the running event loop) if needed."""
+        if self.__session is None or self.__session.closed:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.__refresh_lock = asyncio.Lock()
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT))
+        return self.__session
+
+    def get_api_summary(self):
+        return self.__api
+
+
+    async def _authorize(self, headers: dict, refresh=False):
+        '''Add the authorization header to the given headers, refreshing the access token first if needed.
+
+    Refreshing is a blocking request, so it is done on a worker thread. Coroutines which find the
+    token expired at the same time wait for the first one's refresh, rather than refreshing it again.
+        '''
+        if refresh or not self.__credentials.valid:
+            token = self.__credentials.token
+            async with self.__refresh_lock:
+                if self.__credentials.token == token:
+                    await asyncio.get_event_loop().run_in_executor(None, self.__credentials.refresh, Request())
+        self.__credentials.apply(headers)
+
+
+    async def _fetch(self, method: str, path: str, params: dict = None, body: dict = None,
+                     idempotent=True) -> bytes:
+        '''Send a request to the FusionTables API, pacing and retrying it as the synchronous handlers would.
+
+    @params:
+        method: str, the HTTP method.
+        path: str, the resource path, relative to BASE_URL.
+        params: dict, the query parameters.
+        body: dict, the JSON request body, if any.
+        idempotent: bool, whether the request may be safely applied more than once (see RetryPolicy.is_retryable).
+
+    @return: bytes, the body of the successful response.
+
+    @raises: HttpError (or ConnectionError), the error of the last attempt, if it could not be retried.
+        '''
+        url = self.BASE_URL + path
+        headers = {}
+        data = None
+        if method == 'GET' and params and len(url) + len(urlencode(params)) >= self.MAX_URI_LENGTH:
+            # Long queries must be sent in the body, as the API client itself would do.
+            method, params, data = 'POST', None, urlencode(params)
+            headers['x-http-method-override'] = 'GET'
+            headers['content-type'] = 'application/x-www-form-urlencoded'
+        session = self.get_session()
+        started = time.perf_counter()
+        attempt = 0
+        refreshed = False
+        while True:
+            await asyncio.sleep(self.rate_governor.reserve(self.__api))
+            await self._authorize(headers)
+            try:
+                async with self.__semaphore:
+                    async with session.request(method, url, params=params, data=data, json=body,
+                                               headers=headers) as response:
+                        status = response.status
+                        content = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                error = ConnectionError(f'{method} {url} failed: {err!r}')
+            else:
+                if status < 300:
+                    self.rate_governor.record_success(self.__api)
+                    self.retry_policy.record_success()
+                    return content
+                if status == 401 and not refreshed:
+                    # The token was revoked or expired early.
+                    refreshed = True
+                    await self._authorize(headers, refresh=True)
+                    continue
+                error = HttpError(Response({'status': status}), content, uri=url)
+                if _is_throttled(error):
+                    self.rate_governor.record_throttled(self.__api)
+            attempt += 1
+            delay = self.retry_policy.get_delay(error, attempt, started, idempotent=idempotent)
+            if delay is None:
+                raise error
+            await asyncio.sleep(delay)
+
+
+    async def _request(self, method: str, path: str, params: dict = None, body: dict = None,
+                       idempotent=True) -> dict:
+        """Send a request to the FusionTables API (see _fetch), and decode its JSON response"""
+        content = await self._fetch(method, path, params, body, idempotent)
+        return json.loads(content.decode('utf-8')) if content else {}
+
+
+    async def count_rows(self, tableId: str) -> int:
+        '''Query the size of a table, in terms of rows.
+
+    @params:
+        tableId: str, the target FusionTable's id.
+
+    @return: int, the number of rows in the FusionTable.
+        '''
+        if not (tableId and isinstance(tableId, str)):
+            raise TypeError("Expected string FusionTable identifier")
+
+        row_count_result = await self.get_query_result('select COUNT() from ' + tableId)
+        if row_count_result and 'rows' in row_count_result:
+            return int(row_count_result['rows'][0][0])
+
+        print(f'Row count query failed for table \'{tableId}\'')
+        return int(0)
+
+
+    async def get_tasks(self, tableId: str) -> list:
+        '''Obtain all active tasks for the given FusionTable.
+
+    @params:
+        tableId: str, the ID of the table to query for running tasks (like row deletion).
+
+    @return: list, all fusiontable#task dicts that are running or scheduled to run.
+        '''
+        if not (tableId and isinstance(tableId, str)):
+            raise TypeError('Expected string table ID.')
+        table_tasks = []
+        params = {}
+        while True:
+            response = await self._request('GET', f'tables/{tableId}/tasks', params)
+            table_tasks.extend(response.get('items', []))
+            if not response.get('nextPageToken'):
+                return table_tasks
+            params['pageToken'] = response['nextPageToken']
+
+
+    async def _await_tasks(self, tableId: str, first_poll=0.5, max_poll=10.):
+        '''Wait until the given table has no running or scheduled tasks (see FusionTableHandler._await_tasks).'''
+        poll = first_poll
+        tasks = await self.get_tasks(tableId)
+        while tasks:
+            print(tasks[0]['type'], tasks[0]['progress'])
+            await asyncio.sleep(poll)
+            poll = min(max_poll, poll * 1.5)
+            tasks = await self.get_tasks(tableId)
+
+
+    async def _get_page(self, query: str, offset: int, limit: int) -> dict:
+        '''Request a single OFFSET / LIMIT page of a query's result.
+
+    If the page is too large for a sqlGet response, it is requested as two half-size pages instead,
+    and their rows are combined.
+
+    @return: dict, the fusiontables#sqlresponse for the requested page.
+
+    @raises: HttpError, if the page could not be obtained.
+        '''
+        try:
+            content = await self._fetch('GET', 'query', {'sql': f'{query} OFFSET {offset} LIMIT {limit}'})
+        except HttpError as err:
+            if 'Response size is larger than' in err.__str__() and limit > 1:
+                half = limit // 2
+                response = await self._get_page(query, offset, half)
+                if len(response.get('rows', [])) == half:
+                    remainder = await self._get_page(query, offset + half, limit - half)
+                    response.setdefault('rows', []).extend(remainder.get('rows', []))
+                return response
+            print(f'Error during query "{query}":\n', err)
+            raise
+
+        response = json.loads(content.decode('utf-8'))
+        self._record_page_size(query, len(content), len(response.get('rows', [])))
+        return response
+
+
+    async def get_query_result(self, query: str,
+                               kb_row_size=1., offset_start=0, max_rows_received=float("inf")) -> dict:
+        '''Perform an arbitrarily-large dataquery
+
+    Perform a FusionTable query and return the fusiontables#sqlresponse object, as
+    FusionTableHandler.get_query_result does. The first page is requested alone, so that later pages
+    are sized from its measured rows. If it is full, the query's rows are counted, and all of the
+    remaining pages are requested at once (within the handler's concurrency limit).
+
+    @params:
+        query: str, the SQL GET statement (Show, Select, Describe) to execute.
+        kb_row_size: float, the expected size of an individual returned row, in kB. Only used
+                until the real row size of this table's responses has been measured.
+        offset_start: int, the global offset into the desired query result.
+        max_rows_received: int, the global maximum number of records the query should return.
+
+    @return: dict, conforming to fusiontables#sqlresponse formatting, equivalent to what
+            would be returned as though only a single query were made.
+        '''
+        query_result = {'kind': 'fusiontables#sqlresponse', 'is_complete': False}
+        end = offset_start + max_rows_received
+        try:
+            limit = int(min(self.get_page_limit(query, kb_row_size), max_rows_received))
+            pages = [await self._get_page(query, offset_start, limit)]
+            if len(pages[0].get('rows', [])) == limit and offset_start + limit < end:
+                pages.extend(await self._get_remaining_pages(query, kb_row_size, offset_start + limit, end))
+        except (HttpError, ConnectionError):
+            return {}
+        if 'columns' not in pages[0]:
+            return {}
+
+        query_result['columns'] = pages[0]['columns']
+        query_result['rows'] = [row for page in pages for row in page.get('rows', [])]
+        query_result['is_complete'] = True
+        return query_result
+
+
+    async def _get_remaining_pages(self, query: str, kb_row_size: float, offset: int, end) -> list:
+        '''Request the pages of a query's result from the given offset, concurrently if its rows can be counted.'''
+        limit = self.get_page_limit(query, kb_row_size)
+        count_query = self.get_count_query(query)
+        count_result = await self.get_query_result(count_query) if count_query else {}
+        if count_result.get('rows'):
+            end = min(int(count_result['rows'][0][0]), end)
+            return await _gather_or_cancel(self._get_page(query, start, min(limit, end - start))
+                                           for start in range(offset, int(end), limit))
+
+        pages = []
+        while offset < end:
+            limit = int(min(limit, end - offset))
+            pages.append(await self._get_page(query, offset, limit))
+            offset += limit
+            if len(pages[-1].get('rows', [])) < limit:
+                break
+            limit = self.get_page_limit(query, kb_row_size)
+        return pages
+
+
+    async def get_records_by_rowid(self, rowids: list, tableId: str) -> list:
+        '''Download the specified rows from the specified table
+
+    Returns a list of lists (i.e. 2D array) corresponding to the full records (SELECT * FROM ...)
+    associated with the requested rowids in the specified table. The rowids are packed into as few
+    "ROWID IN (...)" queries as MAX_GET_QUERY_LENGTH allows, and all of the queries are sent at once.
+
+    @params:
+        rowids: list[str], the ids of rows to acquire. The list is not modified.
+        tableId: str, the table to download rows from.
+
+    @return: list, the full contents of the indicated rows, in the order of the given rowids' queries.
+        '''
+        self._check_rowid_request(rowids, tableId)
+        queries = self.get_rowid_queries(tableId, rowids)
+        progress_parameters = {'total': len(rowids), 'prefix': 'Record retrieval: ', 'length': 50}
+        received = 0
+        start = time.perf_counter()
+
+        async def _get_chunk(query: str) -> dict:
+            nonlocal received
+            response = await self._request('GET', 'query', {'sql': query})
+            received += len(response.get('rows', []))
+            print_progress_bar(received, **progress_parameters)
+            return response
+
+        print_progress_bar(0, **progress_parameters)
+        results = await _gather_or_cancel(_get_chunk(query) for query in queries)
+        print()
+        print('\tDid {} queries in {:.1f} sec to retrieve {} records'.format(
+            len(queries), time.perf_counter() - start, len(rowids)))
+        return self._combine_rowid_responses(results, rowids)
+
+
+    async def delete_records_by_rowid(self, tableId: str, rowids: list, checkpoint: str = '') -> int:
+        '''Delete the given records from the given FusionTable. Does not back up the table
+        first. Does not require all input rowids to be present in the target table.
+
+    All of the DELETE statements are sent at once (within the handler's concurrency limit). Statements
+    that still fail after their retries are written to a checkpoint file, from which the deletion can be
+    finished later with FusionTableHandler.resume_deletes.
+
+    @params:
+        tableId: str, the ID of the FusionTable which should have select rows deleted.
+        rowids: list, the rowids identifying data to remove. The list is not modified.
+        checkpoint: str, the file in which to save failed statements. Defaults to the file
+                FusionTableHandler.delete_records_by_rowid would use.
+
+    @return: int, the number of deleted rows.
+        '''
+        queries = self.get_rowid_queries(tableId, rowids, delete=True)
+        if not queries:
+            return 0
+        checkpoint = checkpoint or FusionTableHandler.get_delete_checkpoint_filename(tableId)
+        progress_parameters = {'total': len(queries), 'prefix': 'Deleting: ', 'length': 50}
+        deleted = 0
+        done = 0
+        failed = []
+
+        async def _delete_chunk(query: str):
+            nonlocal deleted, done
+            try:
+                response = await self._request('POST', 'query', {'sql': query})
+                deleted += int(response['rows'][0][0])
+            except (HttpError, ConnectionError) as err:
+                print('\nDelete failed:', err)
+                failed.append(query)
+            done += 1
+            print_progress_bar(done, **progress_parameters, suffix=f'({deleted:,} rows)')
+
+        print_progress_bar(0, **progress_parameters)
+        tasks = [asyncio.ensure_future(_delete_chunk(query)) for query in queries]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Deleting by ROWID is idempotent, so unfinished statements can safely be resent.
+            for task, query in zip(tasks, queries):
+                if not task.done() or task.cancelled() or task.exception():
+                    task.cancel()
+                    failed.append(query)
+            FusionTableHandler.save_delete_checkpoint(checkpoint, tableId, failed)
+            if failed:
+                print(f'{len(failed)} DELETE statements failed. Resume them with resume_deletes("{checkpoint}")')
+        return deleted
+
+
+    async def backup_table(self, tableId: str, await_clone=False) -> dict:
+        '''Create a copy of the the input FusionTable
+
+    Writes the new name & id to disk as well.
+    Does not delete any previous backups (and thus can trigger used space quota exception).
+
+    @params:
+        tableId: str, the ID for a FusionTable which should be copied. (str)
+        await_clone: bool, whether to wait until the created backup is done importing rows.
+
+    @return: dict, the minimal metadata for the copied FusionTable (id, name, description).
+        '''
+        if not tableId:
+            return {}
+        fields = {'fields': 'tableId,name,description'}
+        try:
+            # A retried copy could leave a duplicate backup behind.
+            backup = await self._request('POST', f'tables/{tableId}/copy', dict(fields, copyPresentation='true'),
+                                         idempotent=False)
+        except (HttpError, ConnectionError) as err:
+            print('Backup operation failed due to error:\n', err)
+            return {}
+
+        # Rename the copied table, and provide a better description.
+        copy = dict(backup)
+        self.describe_backup(backup, tableId)
+        try:
+            await self._request('PATCH', f'tables/{backup["tableId"]}', fields, backup)
+        except (HttpError, ConnectionError) as err:
+            # The copy is still a complete backup, so it is kept (and logged) under its original name.
+            print(f'Unable to rename backup {backup["tableId"]}:', err)
+            backup = copy
+        # Log this new table to disk.
+        self._log_backup(backup)
+
+        if await_clone:
+            # Pause this job while the backup is cloning
+            await self._await_tasks(backup['tableId'])
+        print(f'Backup of table \'{tableId}\' completed; new table logged to disk.')
+        return backup
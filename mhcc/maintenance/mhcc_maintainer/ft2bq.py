@@ -1,9 +1,12 @@
 """Script for exporting all FusionTables to a corresponding BigQuery Table"""
 import csv
 from datetime import datetime
+from itertools import islice
 from re import sub as regex_replace
+from services import BigQueryHandler
 from services import FusionTableHandler
-from regression_fixer import get_as_int
+from services import HttpError
+from services import get_as_int
 
 from google.cloud import bigquery
 
@@ -11,10 +14,11 @@ def to_safe_name(name: str) -> str:
     """Convert text to be made BQ-compatible (alphanumeric + underscores)"""
     return regex_replace(r'\-|\.|:', "", name.replace(' ', '_'))
 
-def create_dataset(client: bigquery.Client, dataset_name: str, description: str = 'Automatic imports of known FusionTables') -> bigquery.Dataset:
+def create_dataset(bq: BigQueryHandler, dataset_name: str, description: str = 'Automatic imports of known FusionTables') -> bigquery.Dataset:
+    client = bq.get_client()
     ds = bigquery.Dataset(f'{client.project}.{to_safe_name(dataset_name)}')
     ds.description = description
-    return client.create_dataset(ds)
+    return bq.call(client.create_dataset, ds)
 
 def decode_fusionTable_schema(tables: list) -> dict:
     """Returns a dictionary mapping from a FusionTable ID to its corresponding BigQuery TableColumn Schema
@@ -42,12 +46,12 @@ def decode_fusionTable_schema(tables: list) -> dict:
 
     return dict((s.get('tableId'), s) for s in map(_map_table, tables))
 
-def create_tables(client: bigquery.Client, tableSchemas: dict) -> dict:
+def create_tables(bq: BigQueryHandler, tableSchemas: dict) -> dict:
     """Create empty BigQuery tables for the given partial Table schemas.
 
     Returns a dict of `{ftId : bqId}` to the caller
     """
-    ds = create_dataset(client, f'FusionTable_Autoimport_{datetime.now()}')
+    ds = create_dataset(bq, f'FusionTable_Autoimport_{datetime.now()}')
 
     def _create_field_schema(col_schema: dict) -> bigquery.SchemaField:
         """Create a SchemaField from the dict"""
@@ -71,22 +75,29 @@ def create_tables(client: bigquery.Client, tableSchemas: dict) -> dict:
         return table
 
     return {
-        ftId: client.create_table(_table_from_ft(ftSchema))
+        ftId: bq.call(bq.get_client().create_table, _table_from_ft(ftSchema))
             for (ftId, ftSchema) in tableSchemas.items()
     }
 
-def upload_table_data(client: bigquery.Client, tableRef: bigquery.Table, fusionFile: str) -> bigquery.LoadJob:
-    """Given the client, BigQuery table target, and data, upload the data"""
+def upload_table_data(bq: BigQueryHandler, tableRef: bigquery.Table, fusionFile: str) -> bigquery.LoadJob:
+    """Given the BigQuery service, BigQuery table target, and data, upload the data"""
     with open(fusionFile, mode='rb') as file:
-        job = client.load_table_from_file(file, tableRef)
+        job = bq.call(bq.get_client().load_table_from_file, file, tableRef)
     return job
 
-def download_table_data(ft: FusionTableHandler, tableId: str, table: bigquery.Table) -> list:
-    """Download the data from the given FusionTable and process it to match the given schema"""
-    data: dict = ft.get_query_result(f'select * from {tableId}')
-    if 'rows' in data:
-        transform_table_data(data['rows'], table)
-        return data['rows']
+def download_table_data(ft: FusionTableHandler, tableId: str, table: bigquery.Table, batch_size: int = 10000):
+    """Download the data from the given FusionTable and yield its rows, processed to match the given schema, one batch at a time"""
+    sql = f'select * from {tableId}'
+    try:
+        _, rows = ft.iter_media_rows(sql)
+        batches = iter(lambda: list(islice(rows, batch_size)), [])
+    except HttpError:
+        print(f'Unable to stream FT {tableId} as media, paging through it instead')
+        batches = (page['rows'] for page in ft.iter_query_pages(sql, parallel=ft.MAX_PARALLEL_REQUESTS))
+    for batch in batches:
+        if batch:
+            transform_table_data(batch, table)
+            yield from batch
 
 def transform_table_data(tableRows: list, table: bigquery.Table):
     """Convert floats to ints where required prior to uploading. Convert NaN to 0 for numeric types"""
@@ -110,21 +121,21 @@ def transform_table_data(tableRows: list, table: bigquery.Table):
                 row[idx] = result if result is not None else 0
     return
 
-def write_table_data(tableId: str, tableRows: list):
-    """Write the given data to local disk in prep for uploading"""
+def write_table_data(tableId: str, tableRows):
+    """Write the given data (any iterable of rows) to local disk in prep for uploading"""
     filename = f'table_{tableId}.csv'
     with open(filename, 'w', newline='', encoding='utf-8') as f_:
         csv.writer(f_, quoting=csv.QUOTE_NONNUMERIC).writerows(tableRows)
     return filename
 
-def export(ft: FusionTableHandler, client: bigquery.Client, allTables=True, tableIds: list = None):
+def export(ft: FusionTableHandler, bq: BigQueryHandler, allTables=True, tableIds: list = None):
     """Exports either all known FusionTables, or the given FusionTable IDs, to BigQuery"""
     schemas = dict()
     if allTables:
         all_tables = []
         request = ft.table.list(fields="items(name,tableId,description,columns(name,columnId,description,type,formatPattern))")
         while request is not None:
-            response = request.execute()
+            response = ft.execute(request)
             all_tables.extend(response.get('items', []))
             request = ft.table.list_next(request, response)
 
@@ -135,9 +146,9 @@ def export(ft: FusionTableHandler, client: bigquery.Client, allTables=True, tabl
         raise NotImplementedError()
 
     jobs = []
-    for (tableId, tableRef) in create_tables(client, schemas).items():
+    for (tableId, tableRef) in create_tables(bq, schemas).items():
         rows = download_table_data(ft, tableId, tableRef)
-        job: bigquery.LoadJob = upload_table_data(client, tableRef, write_table_data(tableId, rows))
+        job: bigquery.LoadJob = upload_table_data(bq, tableRef, write_table_data(tableId, rows))
         job.add_done_callback(lambda job, ftId=tableId: print(f'Load job {"finished" if not job.error_result else "failed"} for FT {ftId}'))
         jobs.append(job)
 
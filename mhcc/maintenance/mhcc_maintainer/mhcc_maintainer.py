@@ -2,16 +2,22 @@
 Script which performs maintenance functions for the MHCC FusionTable and
 initiates a resumable upload to handle the large datasetimport csv
 '''
+import asyncio
 import csv
 import random
 import time
 from datetime import datetime
+from operator import itemgetter
+
+import numpy as np
 
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
+from async_services import AsyncFusionTableHandler
+from mirror import LocalMirror
 from services import DriveHandler, FusionTableHandler, BigQueryHandler
 from services import HttpError
-from services import print_progress_bar as ppb
+from services import RequestException
 from services import _write_as_csv as save
 
 STRTM_FMT = '%Y-%m-%dT%H:%M:%S.%f%z'
@@ -92,7 +98,74 @@ def authorize(local_keys: dict) -> 'Dict[str, GoogleService]':
 
 
 
-def prune_ranks(tableId: str, ft: FusionTableHandler):
+def _to_int_array(values: list, skip_invalid=False) -> tuple:
+    '''Convert each value as int() would, into an int64 array.
+
+    @params:
+        values: list, the values to convert.
+        skip_invalid: bool, whether values that int() rejects (with ValueError) are skipped, rather than raising.
+
+    @return: tuple(np.ndarray, the converted values
+                   np.ndarray, the positions of the converted values, or None if every value was converted)
+    '''
+    try:
+        return np.fromiter(map(int, values), dtype=np.int64, count=len(values)), None
+    except ValueError:
+        if not skip_invalid:
+            raise
+    converted = []
+    positions = []
+    for i, value in enumerate(values):
+        try:
+            converted.append(int(value))
+        except ValueError:
+            continue
+        positions.append(i)
+    return np.array(converted, dtype=np.int64), np.array(positions, dtype=np.int64)
+
+
+def select_interesting_rank_records(records: list, indices: dict) -> tuple:
+    """Select the first record of each (UID, LastSeen, Rank) triple, in the order of the given records.
+
+    Records whose LastSeen is not an integer are skipped. Values are compared as the original
+    per-record selection compared them: UIDs as strings, and LastSeen, Rank and RankTime (which must
+    be integers) as ints. The columns are converted to arrays once, the triples are sorted (keeping
+    the records' order within each triple) and the first of each run of equal triples is kept.
+
+    @params:
+        records: list, the records to select from, e.g. ordered by UID, LastSeen and RankTime.
+        indices: dict, the index of the 'rowid', 'uid', 'ls' (LastSeen), 'rank' and 'rt' (RankTime)
+            columns of the records.
+
+    @return: tuple(list, the rowid (as a str) of each kept record
+                   list, the position of each kept record in the given records, ascending)
+    """
+    if not records:
+        return [], []
+    last_seen, positions = _to_int_array(list(map(itemgetter(indices['ls']), records)), skip_invalid=True)
+    selected = records if positions is None else list(map(records.__getitem__, positions.tolist()))
+    if positions is None:
+        positions = np.arange(len(records))
+    if not selected:
+        return [], []
+    ranks, _ = _to_int_array(list(map(itemgetter(indices['rank']), selected)))
+    # RankTime is not compared, but (as before) must be an integer.
+    _to_int_array(list(map(itemgetter(indices['rt']), selected)))
+    _, uids = np.unique(np.array(list(map(str, map(itemgetter(indices['uid']), selected)))), return_inverse=True)
+    uids = uids.reshape(-1)
+
+    # Sort by triple, and then by position, so the first of each run of equal triples is the earliest.
+    order = np.lexsort((positions, ranks, last_seen, uids))
+    uids, last_seen, ranks = uids[order], last_seen[order], ranks[order]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = (uids[1:] != uids[:-1]) | (last_seen[1:] != last_seen[:-1]) | (ranks[1:] != ranks[:-1])
+    kept = np.sort(positions[order][is_first]).tolist()
+    rowids = list(map(str, map(itemgetter(indices['rowid']), map(records.__getitem__, kept))))
+    return rowids, kept
+
+
+
+def prune_ranks(tableId: str, ft: FusionTableHandler, dryRun=False):
     """Routine which prunes out boring Rank DB data.
     # [Member, UID, LastSeen, RankTime, Rank, MHCC]
     Multiple approaches are possible:
@@ -104,79 +177,11 @@ def prune_ranks(tableId: str, ft: FusionTableHandler):
         Option 2 will prune many records from members with relatively fixed rank positions, even
             if they frequently refresh their crown counts
         Option 3 is not as aggressive as options 1 and 2, and is the one implemented.
+    The records are selected from the table's local mirror (see LocalMirror), which only downloads
+    the rows that changed since it was last synced.
+    The boring records are either deleted or replaced along with the rest of the table, whichever
+    FusionTableHandler.plan_row_removal estimates to be cheaper. If dryRun, only the estimate is shown.
     """
-    def get_records_with_criteria(sql_parts: dict, criteria_values: list, ft: FusionTableHandler) -> dict:
-        """Get a set of records that need analysis
-
-    Returns the collective fusiontables#sqlresponse for the set of queries that need to be performed.
-    @params
-        sql_parts: dict, contains the respective sql clauses, including the logic for assembly with format_map
-        criteria_values: list, the collection that needs to be iterated and included.
-        ft: FusionTableHandler, an authenticated service handler
-    @return: dict, the fusiontables#sqlresponse to the collective query set.
-        """
-        if not (isinstance(sql_parts, dict) and isinstance(criteria_values, list) and isinstance(ft, FusionTableHandler)):
-            raise TypeError('Invalid argument types')
-        if not sql_parts or 'assembly' not in sql_parts:
-            raise AttributeError('Input sql definition has no reassembly instructions')
-        if isinstance(criteria_values[0], list):
-            raise NotImplementedError('Paired criteria restriction is not supported.')
-
-        result = {'kind':'fusiontables#sqlresponse', 'is_complete': False}
-        margin = ft.remaining_query_length(sql_parts['assembly'].format_map(sql_parts))
-        est_size = 0.25 # kB per row estimate
-        # Show a progress bar (in case of a slow connection, large query, etc.).
-        progress_parameters = {'total': len(criteria_values),
-                               'prefix': 'Member data retrieval: ',
-                               'length': 50}
-        ppb(iteration=0, **progress_parameters)
-        while criteria_values:
-            queried_criteria = []
-            where_str = ','.join(queried_criteria)
-            while criteria_values and len(where_str) < margin:
-                queried_criteria.append(criteria_values.pop())
-                where_str = ','.join(queried_criteria)
-            sql_parts['where_values'] = where_str
-            response = ft.get_query_result(sql_parts['assembly'].format_map(sql_parts), kb_row_size=est_size)
-            ppb(progress_parameters['total'] - len(criteria_values), **progress_parameters)
-            if not response: # HttpError, so an API issue or other. Already retried the query twice.
-                return result
-            if 'columns' not in result: # Write columns once.
-                result['columns'] = response['columns']
-            if 'rows' not in response or not response['rows']:
-                print('Warning: no results for query "{}"'.format(
-                    sql_parts['assembly'].format_map(sql_parts)))
-            else:
-                result.setdefault('rows', []).extend(response['rows'])
-                est_size = get_size_estimate(result['rows']) * 2048 / len(result['rows'])
-
-        # Send the dict back to the callee.
-        result['is_complete'] = True
-        return result
-
-    def select_interesting_rank_records(records: list, rowids: list, indices: dict, tracker: dict) -> list:
-        """Add the rowid of interesting records into input, and return a copy with only the interesting records"""
-        kept_records = []
-        for record in records:
-            uid = str(record[indices['uid']])
-            try:
-                ls = str(int(record[indices['ls']]))
-            except ValueError:
-                continue
-            rank = str(int(record[indices['rank']]))
-            rt = str(int(record[indices['rt']]))
-            if uid not in tracker:
-                tracker[uid] = dict([(ls, {rank})])
-            elif ls not in tracker[uid]:
-                tracker[uid][ls] = {rank}
-            elif rank not in tracker[uid][ls]:
-                tracker[uid][ls].add(rank)
-            else:
-                continue
-            rowids.append(str(record[indices['rowid']]))
-            kept_records.append(record[:])
-        return kept_records
-
     def validate_retained_rank_records(tableId: str, records: list, members: list) -> bool:
         """Ensure that the input records do not delete all of any members' data
         """
@@ -186,8 +191,12 @@ def prune_ranks(tableId: str, ft: FusionTableHandler):
 
         # Get metadata from the target table.
         remote_columns = ft.get_all_columns(tableId)
-        remote_row_counts = ft.get_query_result(
-            f'SELECT UID, COUNT() FROM {tableId} GROUP BY UID', 0.05)['rows']
+        # The table may have changed since the mirror was synced, so count its rows as they are now.
+        count_result = ft.get_query_result(f'SELECT UID, COUNT() FROM {tableId} GROUP BY UID', 0.05)
+        if 'rows' not in count_result:
+            print('Unable to count the table\'s rows by member.')
+            return False
+        remote_row_counts = count_result['rows']
         if len(records) < len(remote_row_counts):
             return False
 
@@ -235,7 +244,7 @@ def prune_ranks(tableId: str, ft: FusionTableHandler):
             elif int(row[1]) < local_row_counts[row[0]]:
                 print(f'More rows in upload data than source data for member UID=\'{row[0]}\'')
                 has_valid_dataset = False
-        revalidation = select_interesting_rank_records(records, rowids=[], tracker={}, indices= {
+        _, revalidation = select_interesting_rank_records(records, indices= {
             'uid': 1, 'ls': 2, 'rt': 3, 'rank':4, 'rowid': 0})
         if len(revalidation) != len(records):
             print(f'Reanalysis of upload data yielded {len(records) - len(revalidation)} non-interesting rows.')
@@ -246,58 +255,131 @@ def prune_ranks(tableId: str, ft: FusionTableHandler):
     if not tableId or not isinstance(tableId, str):
         return
 
-    # Download only the columns necessary to pick records to keep.
-    criteria_sql = {'assembly': '{select} {from} {where_start}{where_values}{where_end} {order}',
-                    'select': "SELECT ROWID, UID, Rank, LastSeen, RankTime",
-                    'from': "FROM " + tableId,
-                    'where_start': "WHERE UID IN (",
-                    'where_values': '',
-                    'where_end': ")",
-                    'order': "ORDER BY UID ASC, LastSeen ASC, RankTime ASC"}
     members = ft.get_user_batch()
 
-    # Always requery the target table for rowid data.
+    # Bring the local mirror up to date, and select only the columns necessary to pick records to keep.
     print('Pruning ranks for {} members'.format(len(members)))
     uids = [x[1] for x in members]
-    criteria_result = get_records_with_criteria(criteria_sql, uids, ft)
-    if not criteria_result['is_complete']:
-        print('Criteria querying exited prior to full retrieval. Aborting prune...')
+    with LocalMirror.for_table(ft, tableId, 'RankTime') as mirror:
+        criteria_records = mirror.select_for_members(['rowid', 'UID', 'Rank', 'LastSeen', 'RankTime'], uids,
+                                                     order='UID ASC, LastSeen ASC, RankTime ASC')
+        if not criteria_records:
+            print('No records matching criteria')
+            return
+
+
+        # Analyse the records to get the desired rowids
+        # Index the columns of the criteria query.
+        criteria_indices = {'rowid': 0, 'uid': 1, 'rank': 2, 'ls': 3, 'rt': 4}
+        print('Selecting records of interest...')
+        rowids, kept_positions = select_interesting_rank_records(criteria_records, criteria_indices)
+        if len(kept_positions) == len(criteria_records):
+            print('No redundant data detected.')
+            return
+        print('Found {:,} records to remove from {:,} total records.'.format(
+            len(criteria_records) - len(kept_positions), len(criteria_records)))
+
+        is_dropped = np.ones(len(criteria_records), dtype=bool)
+        is_dropped[kept_positions] = False
+        dropped = [str(criteria_records[i][0]) for i in np.flatnonzero(is_dropped).tolist()]
+        table_size = len(mirror.snapshot)
+        plan = ft.plan_row_removal(tableId, rowids, dropped, table_size)
+        ft.print_removal_plan(plan)
+        if dryRun:
+            return
+
+        table_data = None
+        if plan['strategy'] == 'replace':
+            # Take the records to be kept from the local mirror.
+            table_data = mirror.get_records(rowids)
+            # Verify record validity
+            data_is_valid = (table_data and len(table_data) == len(rowids)
+                             and validate_retained_rank_records(tableId, table_data, members))
+            if not data_is_valid:
+                print('Downloading full records...')
+                table_data = ft.get_records_by_rowid(rowids, tableId)
+                data_is_valid = validate_retained_rank_records(tableId, table_data, members)
+
+            if not data_is_valid:
+                print('Unable to obtain validated data')
+                save(table_data, 'invalid_rank_data_snapshot.csv')
+                return
+
+    backup = ft.backup_table(tableId, await_clone=True)
+    if not backup:
+        print('Failed to create table backup. Aborting prune...')
         return
-    try:
-        criteria_records = criteria_result['rows']
-    except KeyError:
-        print('No records matching criteria')
+
+    # Do the actual removal. The table is counted again first, so rows added since the mirror was
+    # synced are not lost by replacing it.
+    result = ft.remove_rows(tableId, rowids, dropped, table_size, kept_rows=table_data)
+    if result.get('aborted'):
+        print('Aborting prune...')
         return
+    print('Ranks have been successfully pruned.')
+
 
 
-    # Analyse the records to get the desired rowids
-    rowids = []
-    seen = {}
-    # Index the columns of the criteria query.
-    criteria_indices = {'rowid': 0, 'uid': 1, 'rank': 2, 'ls': 3, 'rt': 4}
-    print('Selecting records of interest...')
-    interesting_records = select_interesting_rank_records(criteria_records, rowids, criteria_indices, seen)
-    if len(interesting_records) == len(criteria_records):
+def prune_crowns(tableId: str, ft: FusionTableHandler, dryRun=False):
+    """Routine which prunes out duplicated Crown DB data.
+    # [Member, UID, LastSeen, LastCrown, LastTouched, Bronze, Silver, Gold, MHCC, Squirrel]
+    A member's crown record is only interesting if its LastSeen or any of its crown counts differ
+    from those of the member's previous interesting record, so each member's first record is kept,
+    along with each record that reports a change.
+    The table is streamed in a single request, sorted by UID and then LastTouched, so only the
+    previous kept record of the current member needs to be remembered. The stream is not resumed if
+    it fails, as that sort is not unique, and the prune is aborted instead. The kept records are written
+    to a staging file as they are read, which then replaces the table's rows (after a backup).
+    Blank cells are read as None, and compare equal only to other blanks.
+    The table is counted again after the stream, and again just before the upload, and the prune is
+    aborted if either count differs from the number of streamed records. Records appended after the
+    last count, and before the replaceRows upload completes, are not in the staging file and would
+    be lost, so this should not run while the table is being written to.
+    If dryRun, only the number of records that would be removed is shown.
+    """
+    if not tableId or not isinstance(tableId, str):
+        return
+
+    headers = ft.get_all_columns(tableId)['headers']
+    compared = [headers.index(x) for x in ('UID', 'LastSeen', 'Bronze', 'Silver', 'Gold', 'MHCC')]
+    get_signature = itemgetter(*compared)
+    uid_index = headers.index('UID')
+    staging_file = ft.get_filename_for_table(tableId, '_pruned')
+    query = 'SELECT {} FROM {} ORDER BY UID ASC, LastTouched ASC'.format(
+        ', '.join(f"'{x}'" for x in headers), tableId)
+
+    print('Selecting crown records of interest...')
+    total = kept = 0
+    last_kept = None
+    try:
+        with open(staging_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, strict=True, quoting=csv.QUOTE_NONNUMERIC)
+            # UID and LastTouched need not be unique, so a resumed stream could skip or repeat records.
+            _, rows = ft.iter_media_rows(query, typed=True, resumable=False)
+            for total, row in enumerate(rows, 1):
+                signature = get_signature(row)
+                if signature == last_kept:
+                    continue
+                writer.writerow(row)
+                last_kept = signature
+                kept += 1
+                if kept % 100000 == 0:
+                    print(f'Kept {kept:,} of {total:,} records (at UID \'{row[uid_index]}\')')
+    except (HttpError, RequestException) as err:
+        print(f'Unable to read the records of {tableId}:', err, '\nAborting prune...')
+        return
+
+    # A stream that ended early would otherwise drop the rest of the table.
+    table_size = ft.count_rows(tableId, cached=False)
+    if total != table_size:
+        print(f'Received {total:,} of the table\'s {table_size:,} records. Aborting prune...')
+        return
+    if kept == total:
         print('No redundant data detected.')
         return
-    print('Found {:,} records to remove from {:,} total records.'.format(
-        len(criteria_records) - len(interesting_records), len(criteria_records)))
-
-    # Download the records to be kept.
-    local_filename = ft.get_filename_for_table(tableId)
-    table_data = ([] if not ft.can_use_local_data(tableId, local_filename, handlers['Drive'])
-                  else ft.read_local_data(local_filename))
-    # Verify record validity
-    data_is_valid = (table_data and len(table_data) == len(rowids)
-                     and validate_retained_rank_records(tableId, table_data, members))
-    if not data_is_valid:
-        print('Downloading full records...')
-        table_data = ft.get_records_by_rowid(rowids, tableId)
-        data_is_valid = validate_retained_rank_records(tableId, table_data, members)
-
-    if not data_is_valid:
-        print('Unable to obtain validated data')
-        save(table_data, 'invalid_rank_data_snapshot.csv')
+    print('Found {:,} records to remove from {:,} total records.'.format(total - kept, total))
+    if dryRun:
+        print(f'The records to keep were written to \'{staging_file}\'.')
         return
 
     backup = ft.backup_table(tableId, await_clone=True)
@@ -305,20 +387,13 @@ def prune_ranks(tableId: str, ft: FusionTableHandler):
         print('Failed to create table backup. Aborting prune...')
         return
 
-    # Do the actual replacement.
-    ft.replace_rows(tableId, table_data)
-    print('Ranks have been successfully pruned.')
-
-
-
-def prune_crowns(tableId: str):
-    """
-    Routine which prunes out duplicated Crown DB data.
-    """
-    if not tableId or not isinstance(tableId, str):
+    # Rows may have been added while the table was being backed up.
+    current_size = ft.count_rows(tableId, cached=False)
+    if current_size != table_size:
+        print(f'Table {tableId} now has {current_size:,} rows rather than {table_size:,}. Aborting prune...')
         return
-    # [Member, UID, LastSeen, LastCrown, LastTouched, B, S, G, MHCC, Squirrel]
-    return
+    ft.replace_rows_from_file(tableId, staging_file)
+    print('Crowns have been successfully pruned.')
 
 
 def keep_interesting_records(tableId: str):
@@ -435,7 +510,7 @@ def pick_table() -> str:
     '''
     def is_valid_fusiontable(id: str) -> bool:
         try:
-            handlers['FusionTables'].table.get(tableId=id).execute()
+            handlers['FusionTables'].execute(handlers['FusionTables'].table.get(tableId=id))
             return True
         except HttpError as err:
             print(err)
@@ -470,15 +545,40 @@ def clean_regressions(service: FusionTableHandler,
     from regression_fixer import clean_rank_regression, clean_crown_regression
     uids = [x[1] for x in service.get_user_batch()]
     args = (service, uids, time_start, time_end)
-    clean_rank_regression(*args, tableId=TABLE_LIST['MHCC Rank DB'])
-    clean_crown_regression(*args, tableId=TABLE_LIST['MHCC Crowns DB'])
+    # Back up both tables at once, rather than each cleaner waiting for its own backup to clone.
+    # A table whose backup failed is backed up again by its cleaner, before any rows are removed.
+    rank_backup, crown_backup = back_up_tables([TABLE_LIST['MHCC Rank DB'], TABLE_LIST['MHCC Crowns DB']],
+                                               service.get_credentials())
+    # Scan the local mirrors of the tables, so only the rows to remove are sent to (or requested from) the API.
+    with LocalMirror.for_table(service, TABLE_LIST['MHCC Rank DB'], 'RankTime') as mirror:
+        clean_rank_regression(*args, tableId=TABLE_LIST['MHCC Rank DB'], mirror=mirror, backed_up=bool(rank_backup))
+    with LocalMirror.for_table(service, TABLE_LIST['MHCC Crowns DB'], 'LastTouched') as mirror:
+        clean_crown_regression(*args, tableId=TABLE_LIST['MHCC Crowns DB'], mirror=mirror, backed_up=bool(crown_backup))
+
+async def back_up_table(tableId: str, aft: AsyncFusionTableHandler) -> dict:
+    """Back up the given table, and wait for the copy to finish cloning, without blocking other jobs."""
+    row_count = await aft.count_rows(tableId)
+    print(f'Backing up {row_count:,} rows of table \'{tableId}\'')
+    return await aft.backup_table(tableId, await_clone=True)
+
+
+def back_up_tables(tableIds: list, credentials: Credentials) -> list:
+    """Back up the given tables (e.g. the Rank DB and Crown DB) at the same time, in one event loop.
+
+    @return: list, the metadata of each table's backup (an empty dict if its backup failed).
+    """
+    async def _run() -> list:
+        async with AsyncFusionTableHandler(credentials) as aft:
+            return await asyncio.gather(*(back_up_table(tableId, aft) for tableId in tableIds))
+
+    return asyncio.run(_run())
 
 if __name__ == "__main__":
     initialize(LOCAL_KEYS, TABLE_LIST)
     handlers = authorize(LOCAL_KEYS)
     handlers['FusionTables'].verify_known_tables(TABLE_LIST, handlers['Drive'].get_service())
     handlers['FusionTables'].set_user_table(TABLE_LIST['MHCC Members'])
-    client = handlers['BigQuery'].get_client()
+    handlers['FusionTables'].enable_query_cache(handlers['Drive'])
     #print('Pick a table')
     #table = pick_table()
     #print("Select the rank table")
@@ -487,4 +587,6 @@ if __name__ == "__main__":
     #prune_crowns(TABLE_LIST['MHCC Crown DB'], handlers['FusionTables'])
     # print('waiting for you to do stuff')
     from ft2bq import export
-    export(handlers['FusionTables'], client)
+    export(handlers['FusionTables'], handlers['BigQuery'])
+    print('API retries:', handlers['FusionTables'].retry_policy.report())
+    print('API pacing:', handlers['FusionTables'].rate_governor.report())
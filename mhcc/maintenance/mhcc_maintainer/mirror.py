@@ -0,0 +1,186 @@
+"""Local, indexed SQLite copies of FusionTables, so maintenance analyses can run as local SQL"""
+import json
+import os
+import sqlite3
+
+from snapshot import TableSnapshot
+
+
+def quote_name(name: str) -> str:
+    """Quote a column name for use in SQLite SQL (e.g. one with spaces, like MHCC Crowns)"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+
+class LocalMirror():
+    """SQLite database holding a copy of one FusionTable's rows.
+
+The rows are kept in the "records" table, with the FusionTable's columns (and each row's ROWID, as
+the "rowid" column). The columns that maintenance queries filter and sort by (INDEXED_COLUMNS) are
+indexed. The database is loaded from the table's synced snapshot (see
+FusionTableHandler.sync_local_mirror), so refreshing it only downloads the rows that changed.
+Analyses query the mirror, and only the resulting rowids need to be sent to the FusionTables API.
+    """
+    TABLE = 'records'
+    INDEXED_COLUMNS = ('UID', 'LastSeen', 'RankTime', 'LastTouched')
+    COLUMN_TYPES = {'int': 'INTEGER', 'float': 'REAL', 'str': 'TEXT'}
+
+    def __init__(self, path: str):
+        '''Open (or create) the mirror database at the given path.
+
+    @params:
+        path: str, the SQLite database file.
+        '''
+        self.path = path
+        self.snapshot: TableSnapshot = None
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS mirror_info (name TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def for_table(cls, ft: 'FusionTableHandler', tableId: str, key: str, uid_column='UID') -> 'LocalMirror':
+        '''Sync the local copy of the given table, and open its mirror database.
+
+    @params:
+        ft: FusionTableHandler, an authenticated service handler.
+        tableId: str, the table to mirror.
+        key: str, the numeric column whose value increases as rows are added (e.g. RankTime).
+        uid_column: str, the column which identifies the member of each row.
+
+    @return: LocalMirror, the up-to-date mirror. Its snapshot is the synced TableSnapshot.
+        '''
+        snapshot = ft.sync_local_mirror(tableId, key, uid_column)
+        mirror = cls(os.path.splitext(snapshot.path)[0] + '.sqlite')
+        mirror.load(snapshot)
+        return mirror
+
+    def get_info(self, name: str) -> str:
+        row = self.connection.execute('SELECT value FROM mirror_info WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, snapshot: TableSnapshot) -> bool:
+        '''Bring the mirrored rows up to date with the given snapshot, unless they were already loaded from it.
+
+    If the snapshot records its change from the snapshot that was last loaded (see
+    FusionTableHandler.sync_local_mirror), only the removed and updated rows are deleted and
+    (re)inserted, by rowid. Otherwise the mirrored rows are replaced.
+
+    @params:
+        snapshot: TableSnapshot, the table's rows.
+
+    @return: bool, whether any rows were (re)loaded.
+        '''
+        self.snapshot = snapshot
+        source = {'modified': snapshot.modified, 'rows': len(snapshot),
+                  'columns': snapshot.columns, 'properties': snapshot.properties}
+        loaded = json.loads(self.get_info('source') or 'null')
+        if loaded == json.loads(json.dumps(source)):
+            return False
+
+        delta = snapshot.properties.get('delta')
+        if (loaded and delta and loaded['modified'] == delta['previous']
+                and loaded['columns'] == snapshot.columns):
+            self._apply_delta(snapshot, delta['removed'], delta['updated'])
+        else:
+            self._replace_rows(snapshot)
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO mirror_info VALUES (?, ?)', ('source', json.dumps(source)))
+        snapshot.close()
+        return True
+
+    def _insert_rows(self, snapshot: TableSnapshot, indices=None):
+        """Insert the given rows (by position) of the snapshot, or all of them."""
+        self.connection.executemany(
+            'INSERT INTO {} VALUES ({})'.format(quote_name(self.TABLE), ', '.join('?' * len(snapshot.columns))),
+            zip(*(snapshot.get_values(name, indices) for name in snapshot.columns)))
+
+    def _replace_rows(self, snapshot: TableSnapshot):
+        """Recreate the records table (and its indexes) with the rows of the snapshot."""
+        table = quote_name(self.TABLE)
+        definitions = ', '.join('{} {}'.format(quote_name(name), self.COLUMN_TYPES[snapshot.get_kind(name)])
+                                for name in snapshot.columns)
+        indexed = [name for name in snapshot.columns
+                   if name.lower() in (x.lower() for x in self.INDEXED_COLUMNS)]
+        with self.connection:
+            self.connection.execute(f'DROP TABLE IF EXISTS {table}')
+            self.connection.execute(f'CREATE TABLE {table} ({definitions})')
+            self._insert_rows(snapshot)
+            # Indexes are built after the rows are inserted, which is much faster than maintaining them.
+            for name in indexed:
+                self.connection.execute('CREATE INDEX {} ON {} ({})'.format(
+                    quote_name(f'{self.TABLE}_{name}'), table, quote_name(name)))
+            # The rowid is indexed so that changes can be applied to the rows by id.
+            self.connection.execute('CREATE UNIQUE INDEX {} ON {} ("rowid")'.format(
+                quote_name(f'{self.TABLE}_rowid'), table))
+
+    def _apply_delta(self, snapshot: TableSnapshot, removed: list, updated: list):
+        """Delete the removed and updated rows (by rowid), and insert the snapshot's version of each updated row."""
+        self._set_selection(removed + updated)
+        with self.connection:
+            self.connection.execute('DELETE FROM {} WHERE "rowid" IN (SELECT value FROM selection)'.format(
+                quote_name(self.TABLE)))
+            self._insert_rows(snapshot, snapshot.isin('rowid', updated).nonzero()[0])
+
+    def iter_query(self, sql: str, parameters=()):
+        """Yield each row (as a list) of the result of the given SQLite query."""
+        for row in self.connection.execute(sql, parameters):
+            yield list(row)
+
+    def query(self, sql: str, parameters=()) -> list:
+        '''Perform the given SQLite query against the mirror.
+
+    @params:
+        sql: str, the query. The mirrored rows are in the "records" table.
+        parameters: sequence, the values of the query's "?" placeholders.
+
+    @return: list, the rows (as lists) of the result.
+        '''
+        return list(self.iter_query(sql, parameters))
+
+    def _set_selection(self, values):
+        """Store the given values in the temporary "selection" table, for queries to join against."""
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS selection (value TEXT PRIMARY KEY)')
+            self.connection.execute('DELETE FROM selection')
+            self.connection.executemany('INSERT OR IGNORE INTO selection VALUES (?)', ((str(x),) for x in values))
+
+    def select_for_members(self, columns: list, uids, uid_column='UID', order='') -> list:
+        '''Select the given columns of the rows of the given members.
+
+    @params:
+        columns: list, the names of the columns to select.
+        uids: iterable, the members whose rows should be selected. There is no limit on their number.
+        uid_column: str, the column which identifies the member of each row.
+        order: str, the ORDER BY clause (without "ORDER BY"), if any.
+
+    @return: list, the selected rows.
+        '''
+        self._set_selection(uids)
+        sql = 'SELECT {} FROM {} WHERE {} IN (SELECT value FROM selection)'.format(
+            ', '.join(quote_name(x) for x in columns), quote_name(self.TABLE), quote_name(uid_column))
+        return self.query(f'{sql} ORDER BY {order}' if order else sql)
+
+    def get_records(self, rowids, columns: list = None) -> list:
+        '''Get the given rows of the mirrored table.
+
+    @params:
+        rowids: iterable, the ids of the rows to get.
+        columns: list, the names of the columns to get. Defaults to every column of the FusionTable
+                (i.e. all but the rowid).
+
+    @return: list, the rows that are in the mirror, in no particular order.
+        '''
+        if columns is None:
+            columns = [x[1] for x in self.query(f'PRAGMA table_info({quote_name(self.TABLE)})')][1:]
+        self._set_selection(rowids)
+        return self.query('SELECT {} FROM {} WHERE "rowid" IN (SELECT value FROM selection)'.format(
+            ', '.join(quote_name(x) for x in columns), quote_name(self.TABLE)))
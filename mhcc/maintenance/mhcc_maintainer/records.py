@@ -0,0 +1,121 @@
+"""Compact, typed representations of the rows of the Rank DB and Crowns DB tables"""
+from operator import itemgetter
+from sys import intern
+
+from services import get_as_int
+
+
+def _to_int(value) -> int:
+    """Convert a numeric value (or its string) to an int. Blank values become None."""
+    if value is None or value == '':
+        return None
+    return value if type(value) is int else get_as_int(value)
+
+
+def _to_name(value) -> str:
+    """Convert a repeated string value (e.g. a UID or member name) to an interned str."""
+    return None if value is None else intern(str(value))
+
+
+
+class _Record():
+    """Base class for table records, which store each column's value in a slot.
+
+Slotted records hold no per-record dict, so millions of them take a fraction of the memory of the
+equivalent dicts, and reading a value is an attribute lookup rather than a string hash. The values
+are converted when the record is made: UIDs and names are interned, so each distinct value is held
+once, and timestamps and counts are ints.
+    """
+    __slots__ = ()
+    # The table column held by each slot, in the same order.
+    COLUMNS = ()
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(repr(x) for x in self.to_row()))
+
+    @classmethod
+    def get_converter(cls, columns) -> 'Callable[[list], _Record]':
+        '''Get the function that makes a record from a row with the given columns.
+
+    @params:
+        columns: list, the column name of each value in the rows (e.g. the headers of a query result).
+                Columns which are not part of the record are ignored, and slots whose column is
+                not given are set to None.
+
+    @return: callable, which makes a record from one row (a list).
+        '''
+        columns = [str(x).strip("'") for x in columns]
+        positions = [columns.index(name) if name in columns else None for name in cls.COLUMNS]
+        if None not in positions:
+            get_values = itemgetter(*positions)
+            return lambda row: cls(*get_values(row))
+        return lambda row: cls(*(None if i is None else row[i] for i in positions))
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        '''Make a record from each of the given rows.
+
+    @params:
+        columns: list, the column name of each value in the rows (see get_converter).
+        rows: iterable, the rows (lists of values).
+
+    @yields: _Record, the record of each row.
+        '''
+        return map(cls.get_converter(columns), rows)
+
+    def to_row(self, columns=None) -> list:
+        '''Get the record's values as a row.
+
+    @params:
+        columns: list, the names of the columns to include, in order. Defaults to COLUMNS.
+
+    @return: list, the value of each column.
+        '''
+        if columns is None:
+            return [getattr(self, name) for name in self.__slots__]
+        slots = dict(zip(self.COLUMNS, self.__slots__))
+        return [getattr(self, slots[name]) for name in columns]
+
+
+
+class RankRecord(_Record):
+    """A row of the Rank DB: [rowid, Member, UID, LastSeen, RankTime, Rank, MHCC Crowns]"""
+    __slots__ = ('rowid', 'member', 'uid', 'last_seen', 'rank_time', 'rank', 'mhcc')
+    COLUMNS = ('rowid', 'Member', 'UID', 'LastSeen', 'RankTime', 'Rank', 'MHCC Crowns')
+
+    def __init__(self, rowid, member, uid, last_seen, rank_time, rank, mhcc):
+        self.rowid = None if rowid is None else str(rowid)
+        self.member = _to_name(member)
+        self.uid = _to_name(uid)
+        self.last_seen = _to_int(last_seen)
+        self.rank_time = _to_int(rank_time)
+        self.rank = _to_int(rank)
+        self.mhcc = _to_int(mhcc)
+
+
+
+class CrownRecord(_Record):
+    """A row of the Crowns DB: [rowid, Member, UID, LastSeen, LastCrown, LastTouched, Bronze, Silver, Gold, MHCC, Squirrel]"""
+    __slots__ = ('rowid', 'member', 'uid', 'last_seen', 'last_crown', 'last_touched',
+                 'bronze', 'silver', 'gold', 'mhcc', 'squirrel')
+    COLUMNS = ('rowid', 'Member', 'UID', 'LastSeen', 'LastCrown', 'LastTouched',
+               'Bronze', 'Silver', 'Gold', 'MHCC', 'Squirrel')
+
+    def __init__(self, rowid, member, uid, last_seen, last_crown, last_touched,
+                 bronze, silver, gold, mhcc, squirrel):
+        self.rowid = None if rowid is None else str(rowid)
+        self.member = _to_name(member)
+        self.uid = _to_name(uid)
+        self.last_seen = _to_int(last_seen)
+        self.last_crown = _to_int(last_crown)
+        self.last_touched = _to_int(last_touched)
+        self.bronze = _to_int(bronze)
+        self.silver = _to_int(silver)
+        self.gold = _to_int(gold)
+        self.mhcc = _to_int(mhcc)
+        self.squirrel = _to_name(squirrel)
+
+    @property
+    def total(self) -> int:
+        """The member's total number of (bronze, silver and gold) crowns."""
+        return self.bronze + self.silver + self.gold
@@ -3,9 +3,13 @@ import random
 import time
 from collections import defaultdict
 from datetime import datetime
+from operator import attrgetter
 
+from mirror import LocalMirror, quote_name
+from records import CrownRecord, RankRecord
 from services import DriveHandler, FusionTableHandler
 from services import HttpError
+from services import RequestException
 
 STRTM_FMT = '%Y-%m-%dT%H:%M:%S.%f%z'
 
@@ -43,6 +47,10 @@ def getMHCCMembersInJacks(users: list, jd: dict):
     return mhcc_jd
 
 
+def to_millis(timestring: str) -> float:
+    '''Convert the input time string to the corresponding UTC millis value'''
+    return datetime.strptime(timestring, STRTM_FMT).timestamp() * 1000
+
 def get_sql(headers, tableId: str, order: str,
             criteria_key: str = None, start: str = None, end: str = None):
     '''Generate the appropriate select statement to obtain records that should be checked for data regressions'''
@@ -53,99 +61,87 @@ def get_sql(headers, tableId: str, order: str,
         parts.append('WHERE')
         # For any input time strings, convert to the corresponding UTC millis value.
         if start:
-            ts = datetime.strptime(start, STRTM_FMT).timestamp() * 1000
-            parts.append(f'{criteria_key} > {ts}')
+            parts.append(f'{criteria_key} > {to_millis(start)}')
         if end:
-            te = datetime.strptime(end, STRTM_FMT).timestamp() * 1000
             if start:
                 parts.append('and')
-            parts.append(f'{criteria_key} < {te}')
+            parts.append(f'{criteria_key} < {to_millis(end)}')
 
     # Add the ordering instruction
     parts.append(f'ORDER BY {order}')
 
     return ' '.join(parts)
 
-def get_table_data(service: FusionTableHandler, tableId: str, sql: str):
-    '''Obtain annotated table data as determined from the input SQL'''
+def get_table_data(service: FusionTableHandler, tableId: str, sql: str, record_type=RankRecord):
+    '''Obtain table data as determined from the input SQL, as records of the given type (RankRecord or CrownRecord).
+    The query result is streamed as CSV media and converted as it arrives. The paged JSON query is only used if the
+    stream cannot be opened. (The queries are ORDERed, so a stream that fails once opened is resumed by iter_media_rows.)'''
     try:
-        data = service.get_query_result(query=sql, kb_row_size=0.2)
-    except HttpError:
-        print('Unable to obtain ROWIDs in bulk query')
-        byte_data = service.query.sqlGet_media(sql=sql).execute()
-        data = service.bytestring_to_queryresult(byte_data)
-    # Convert list of list to list of dicts
-    headers = data['columns']
-    output = (dict(zip(headers, x)) for x in data['rows'])
-    return coerce_to_typed_info(tableId, output)
-
-def coerce_to_typed_info(tableId: str, data):
+        headers, rows = service.iter_media_rows(sql, typed=True)
+    except (HttpError, RequestException):
+        print('Unable to stream query result as media, paging through it instead')
+        headers, rows = service.iter_query_rows(query=sql, kb_row_size=0.2)
+        rows = coerce_to_typed_info(tableId, headers, rows)
+    return record_type.from_rows(headers, rows)
+
+def get_local_table_data(mirror: LocalMirror, headers, order: str,
+                         criteria_key: str = None, start: str = None, end: str = None, record_type=RankRecord):
+    '''Obtain table data from the table's local mirror, selected as get_sql would select it from the FusionTable.
+    The mirror's indexes on the time columns make the range selection and ordering cheap.'''
+    names = [x.strip("'") for x in headers]
+    sql = 'SELECT {} FROM records'.format(', '.join(quote_name(x) for x in names))
+    conditions = []
+    parameters = []
+    if criteria_key and start:
+        conditions.append(f'{quote_name(criteria_key)} > ?')
+        parameters.append(to_millis(start))
+    if criteria_key and end:
+        conditions.append(f'{quote_name(criteria_key)} < ?')
+        parameters.append(to_millis(end))
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += f' ORDER BY {order}'
+    return record_type.from_rows(names, mirror.iter_query(sql, parameters))
+
+def coerce_to_typed_info(tableId: str, headers, data):
         '''Converts str-only data elements to str, int, or float, in accordance with the FusionTable's
-        formatPattern and type for the given column'''
+        formatPattern and type for the given column. Returns a generator over the converted rows.'''
         converter = get_column_mappings(tableId)
-        coerced = [{k: converter[k](v) for k, v in x.items()} for x in data]
-        return coerced
-
-def get_as_int(val):
-    ''' Function which coerces the input value to an int (or None, if NaN was given) '''
-    try:
-        return int(val)
-    except ValueError:
-        try:
-            return int(float(val))
-        except ValueError as err:
-            if val == 'NaN':
-                return None
-            raise err
-    raise TypeError(f'Unknown or unhandled conversion of {val}')
+        converters = [converter[k] for k in headers]
+        return ([convert(v) for convert, v in zip(converters, x)] for x in data)
 
 def get_column_mappings(tableId):
-    '''Query the table and determine the appropriate str/int/float type coercion for each column.'''
-
-    cols = ft.table.get(tableId=tableId, fields='columns(columnId,name,type,formatPattern)').execute()['columns']
-    maps = {'rowid': str}
-    for c in cols:
-        patt = c['formatPattern']
-        cType = c['type'] # NUMBER or STRING (in future, maybe DATETIME)
-        if cType == 'NUMBER':
-            if patt == 'NUMBER_INTEGER':
-                f_func = get_as_int
-            else:
-                f_func = float
-        else:
-            f_func = str
-        assert c['name'] not in maps # column name must be unique
-        maps[c['name']] = f_func
-    return maps
+    '''Determine the appropriate str/int/float type coercion for each column of the table.'''
+    return ft.get_column_converters(tableId)
 
-def deannotate(headers, record):
-    ''' Convert the input record back to a list of lists '''
-    output = []
-    for col in headers:
-        output.append(record[col])
-    return output
+def write_records(records: list, filename: str, columns=None):
+    ''' Write the given records (and a header row of their columns) to disk '''
+    columns = columns or records[0].COLUMNS
+    with open(filename, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(columns)
+        writer.writerows(x.to_row(columns) for x in records)
 
 
-def sort_by_ranktime(record):
-    return record['RankTime']
-def sort_by_lasttouched(record):
-    return record['LastTouched']
+sort_by_ranktime = attrgetter('rank_time')
+sort_by_lasttouched = attrgetter('last_touched')
 
 def get_first_decrease(records: list, key: str):
-    ''' Find the first record in which the value of the given key decreases.
+    ''' Find the first record in which the value of the given attribute decreases.
     Implicitly assumes that the records are appropriately sorted.
     Implicitly assumes that comparing all input records is sensible.
     '''
     if records:
+        get_value = attrgetter(key)
         last_key_value = None
         start = 0
         while last_key_value is None and start < len(records):
-            last_key_value = records[start][key]
+            last_key_value = get_value(records[start])
             start += 1
         if last_key_value is None:
             return None
         for i, record in enumerate(records[start:], start):
-            current_key_value = record[key]
+            current_key_value = get_value(record)
             if(last_key_value > current_key_value):
                 return i
             else:
@@ -153,20 +149,21 @@ def get_first_decrease(records: list, key: str):
     return None
 
 def get_first_correct(records: list, key: str, start: int):
-    '''Find the first record in which the value of the given key returns to "normal"
+    '''Find the first record in which the value of the given attribute returns to "normal"
     Implicitly assumes that the records are appropriately sorted.
     Implicitly assumes that comparing all input records is sensible.
     '''
     if records:
         assert start < len(records), f'Inspection index {start} exceeds maximum dimension {len(records)-1}'
         assert start > 0, f'Unable to obtain required comparison value due to invalid starting index {start}'
-        last_key_value = records[start - 1][key]
+        get_value = attrgetter(key)
+        last_key_value = get_value(records[start - 1])
         for i, record in enumerate(records[start:], start):
-            if record[key] >= last_key_value:
+            if get_value(record) >= last_key_value:
                 return i
     return None
 
-def get_prune_range(sorted_records: list, based_on_col: str='LastSeen'):
+def get_prune_range(sorted_records: list, based_on_col: str='last_seen'):
     '''Return a tuple with the range of the bad data in the input list.
     Implicitly assumes the input records are sorted.
     '''
@@ -184,30 +181,40 @@ def get_prune_range(sorted_records: list, based_on_col: str='LastSeen'):
 
 
 def _perform_deletion(service: FusionTableHandler, tableId: str, target_rowids: list):
-    ''' Delete the rows with the given ROWIDs '''
-    num_rows = service.count_rows(tableId)
+    ''' Delete the rows with the given ROWIDs.
+    Only DELETE statements are used: replacing the table's rows would also drop any rows added to the live table meanwhile.
+    '''
+    num_rows = service.count_rows(tableId, cached=False)
     target_rows = num_rows - len(target_rowids)
-    deleted = service.delete_records_by_rowid(tableId, target_rowids)
-    new_count = service.count_rows(tableId)
+    removed = service.delete_records_by_rowid(tableId, target_rowids)
+    new_count = service.count_rows(tableId, cached=False)
     if new_count >= num_rows:
-        print('Table {tableId} does not have fewer rows', new_count, num_rows)
+        print(f'Table {tableId} does not have fewer rows', new_count, num_rows)
     if new_count != target_rows:
         print(f'Expected table {tableId} to have {target_rows}, but it has {new_count}')
-    print(f'Deleted {deleted} rows from {tableId}')
+    print(f'Deleted {removed} rows from {tableId}')
 
-def clean_rank_regression(service: FusionTableHandler, uids: list, start: str, end: str, filename='bad_rank_data.csv', tableId=''):
+def clean_rank_regression(service: FusionTableHandler, uids: list, start: str, end: str, filename='bad_rank_data.csv', tableId='',
+                          mirror: LocalMirror = None, backed_up=False):
+    '''Removes the rank records that regressed, reading the rank data from the table's local mirror if one is given.
+    Unless the table was already backed up (e.g. by back_up_tables), it is backed up before anything is removed.
+    '''
     global ft
     ft = service
 
     print(f'Collecting rank data in range {start} - {end}')
-    ranks = get_table_data(service, tableId,
-                           get_sql(headers=('rowid', 'Member', 'UID', 'LastSeen', 'RankTime', 'Rank', '\'MHCC Crowns\''),
-                                   tableId=tableId, order='UID ASC, RankTime ASC',
-                                   criteria_key='RankTime', start=start, end=end))
-    print(f'Indexing {len(ranks)} by UID')
+    headers = ('rowid', 'Member', 'UID', 'LastSeen', 'RankTime', 'Rank', '\'MHCC Crowns\'')
+    if mirror is None:
+        ranks = get_table_data(service, tableId,
+                               get_sql(headers=headers, tableId=tableId, order='RankTime ASC',
+                                       criteria_key='RankTime', start=start, end=end), RankRecord)
+    else:
+        ranks = get_local_table_data(mirror, headers, 'RankTime ASC', 'RankTime', start, end, RankRecord)
     indexed_ranks = defaultdict(list)
-    for record in ranks:
-        indexed_ranks[record['UID']].append(record)
+    count = 0
+    for count, record in enumerate(ranks, 1):
+        indexed_ranks[record.uid].append(record)
+    print(f'Indexed {count} records by UID')
 
     collected_bad_ranks = []
     for uid in uids:
@@ -227,38 +234,40 @@ def clean_rank_regression(service: FusionTableHandler, uids: list, start: str, e
 
     if collected_bad_ranks:
         # Write this data to disk (allow avoiding an expensive requery of the table)
-        with open(filename, 'w', encoding='utf-8', newline='') as file:
-            dw = csv.DictWriter(file, fieldnames=list(collected_bad_ranks[0].keys()), quoting=csv.QUOTE_NONNUMERIC)
-            dw.writeheader()
-            dw.writerows(collected_bad_ranks)
+        write_records(collected_bad_ranks, filename)
 
-        min_ms = min(x["RankTime"] for x in collected_bad_ranks if x['MHCC Crowns'] > 0)
+        min_ms = min(x.rank_time for x in collected_bad_ranks if x.mhcc > 0)
         print(f'Earliest rank regression was on {datetime.utcfromtimestamp(min_ms//1000).replace(microsecond=min_ms%1000*1000).strftime(STRTM_FMT)}')
 
         # Create a backup of the rank table
-        if ft.backup_table(tableId, await_clone=True):
-            _perform_deletion(ft, tableId, [x['rowid'] for x in collected_bad_ranks])
+        if backed_up or ft.backup_table(tableId, await_clone=True):
+            _perform_deletion(ft, tableId, [x.rowid for x in collected_bad_ranks])
         else:
             print('Skipped rank data deletion due to failed backup')
     else:
         print('No detected regressions')
 
-def compute_count_regression_dates(service: FusionTableHandler, start: str, end: str, filename='bad_count_data.csv', tableId=''):
+def compute_count_regression_dates(service: FusionTableHandler, start: str, end: str, filename='bad_count_data.csv', tableId='',
+                                   mirror: LocalMirror = None):
     '''Inspects the given table's data to determine the first instance of a crown total count decreasing, within the window provided.
     Also reports the first spike in totals that corresponds to a restoration of valid data.
+    If the table's local mirror is given, the data is read (and the affected rows counted) from it instead.
     '''
     global ft
     ft = service
     print(f'Collecting crown data in range {start} - {end}')
-    crowns = get_table_data(service, tableId,
-                            get_sql(headers=('UID', 'LastSeen', 'LastCrown', 'LastTouched', 'Bronze', 'Silver', 'Gold'),
-                                    tableId=tableId, order='UID ASC, LastTouched ASC',
-                                    criteria_key='LastTouched', start=start, end=end))
-    print(f'Indexing {len(crowns)} by UID')
+    headers = ('UID', 'LastSeen', 'LastCrown', 'LastTouched', 'Bronze', 'Silver', 'Gold')
+    if mirror is None:
+        crowns = get_table_data(service, tableId,
+                                get_sql(headers=headers, tableId=tableId, order='LastTouched ASC',
+                                        criteria_key='LastTouched', start=start, end=end), CrownRecord)
+    else:
+        crowns = get_local_table_data(mirror, headers, 'LastTouched ASC', 'LastTouched', start, end, CrownRecord)
     indexed_counts=defaultdict(list)
-    for record in crowns:
-        total_crowns = record['Bronze'] + record['Silver'] + record['Gold']
-        indexed_counts[record['UID']].append({ 'UID': record['UID'], 'LastSeen': record['LastSeen'], 'LastCrown': record['LastCrown'], 'LastTouched': record['LastTouched'], 'total': total_crowns })
+    count = 0
+    for count, record in enumerate(crowns, 1):
+        indexed_counts[record.uid].append(record)
+    print(f'Indexed {count} records by UID')
 
     start_list = []
     for uid in indexed_counts:
@@ -269,36 +278,46 @@ def compute_count_regression_dates(service: FusionTableHandler, start: str, end:
             start_list.append(member_rows[first_bad])
 
     print(f'{len(start_list)} members affected')
-    first_report = min(x["LastTouched"] for x in start_list)
-    print(f'First occurrence: {first_report}\nLast occurrence: {max(x["LastTouched"] for x in start_list)}')
+    first_report = min(x.last_touched for x in start_list)
+    print(f'First occurrence: {first_report}\nLast occurrence: {max(x.last_touched for x in start_list)}')
 
     # Write this data to disk (allow avoiding an expensive requery of the table)
     with open(filename, 'w', encoding='utf-8', newline='') as file:
-        dw = csv.DictWriter(file, fieldnames=list(start_list[0].keys()), quoting=csv.QUOTE_NONNUMERIC)
-        dw.writeheader()
-        dw.writerows(start_list)
+        writer = csv.writer(file, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(['UID', 'LastSeen', 'LastCrown', 'LastTouched', 'total'])
+        writer.writerows([x.uid, x.last_seen, x.last_crown, x.last_touched, x.total] for x in start_list)
 
     # Report how many rows each member has after the start
-    affected_row_count = service.query.sqlGet(sql=f'SELECT COUNT() FROM {tableId} WHERE LastTouched >= {first_report}').execute()
+    if mirror is None:
+        affected_row_count = service.execute(service.query.sqlGet(sql=f'SELECT COUNT() FROM {tableId} WHERE LastTouched >= {first_report}'))
+    else:
+        affected_row_count = mirror.query('SELECT COUNT(*) FROM records WHERE LastTouched >= ?', (first_report,))
     print(affected_row_count)
 
-def clean_crown_regression(service: FusionTableHandler, uids: list, start: str, end: str, filename='bad_crown_data.csv', tableId=''):
+def clean_crown_regression(service: FusionTableHandler, uids: list, start: str, end: str, filename='bad_crown_data.csv', tableId='',
+                           mirror: LocalMirror = None, backed_up=False):
     '''Bad data may have additionally accumulated in the Crowns DB that does not quite correspond to that visible via the Rank DB
     For example, if information from all data sources is added, then the recorded information toggles between the two, but only the most
     recently added would be presented for inclusion in the Rank DB.
+    If the table's local mirror is given, the crown data is read from it instead.
+    Unless the table was already backed up (e.g. by back_up_tables), it is backed up before anything is removed.
     '''
     global ft
     ft = service
 
     print(f'Collecting crown data in range {start} - {end}')
-    crowns = get_table_data(service, tableId,
-                            get_sql(headers=('rowid', 'Member', 'UID', 'LastSeen', 'LastCrown', 'LastTouched', 'Bronze', 'Silver', 'Gold', 'MHCC', 'Squirrel'),
-                                    tableId=tableId, order='UID ASC, LastTouched ASC',
-                                    criteria_key='LastTouched', start=start, end=end))
-    print(f'Indexing {len(crowns)} by UID')
+    headers = ('rowid', 'Member', 'UID', 'LastSeen', 'LastCrown', 'LastTouched', 'Bronze', 'Silver', 'Gold', 'MHCC', 'Squirrel')
+    if mirror is None:
+        crowns = get_table_data(service, tableId,
+                                get_sql(headers=headers, tableId=tableId, order='LastTouched ASC',
+                                        criteria_key='LastTouched', start=start, end=end), CrownRecord)
+    else:
+        crowns = get_local_table_data(mirror, headers, 'LastTouched ASC', 'LastTouched', start, end, CrownRecord)
     indexed_crowns = defaultdict(list)
-    for record in crowns:
-        indexed_crowns[record['UID']].append(record)
+    count = 0
+    for count, record in enumerate(crowns, 1):
+        indexed_crowns[record.uid].append(record)
+    print(f'Indexed {count} records by UID')
 
     crown_header_order = [x['name'] for x in ft.get_all_columns(tableId)['columns']]
     lastcrown_recalculations = []
@@ -319,36 +338,33 @@ def clean_crown_regression(service: FusionTableHandler, uids: list, start: str,
                 # There is a record to compute with.
                 reference = member_crowns[indices[0] - 1]
                 modified = member_crowns[indices[1]]
-                if all(modified[key] == reference[key] for key in ('Silver', 'Gold', 'MHCC')):
-                    modified['LastCrown'] = reference['LastCrown']
-                    lastcrown_modifications.append({'rowid': modified['rowid'],
-                                                    'new_record': deannotate(crown_header_order, modified)})
-                elif modified['LastCrown'] != modified['LastSeen']:
-                    print(f'Has new MHCC crowns but not new LastCrown. Updating from {modified["LastCrown"]} to {modified["LastSeen"]}')
-                    modified['LastCrown'] = modified['LastSeen']
-                    lastcrown_modifications.append({'rowid': modified['rowid'],
-                                                    'new_record': deannotate(crown_header_order, modified)})
+                if (modified.silver, modified.gold, modified.mhcc) == (reference.silver, reference.gold, reference.mhcc):
+                    modified.last_crown = reference.last_crown
+                    lastcrown_modifications.append({'rowid': modified.rowid,
+                                                    'new_record': modified.to_row(crown_header_order)})
+                elif modified.last_crown != modified.last_seen:
+                    print(f'Has new MHCC crowns but not new LastCrown. Updating from {modified.last_crown} to {modified.last_seen}')
+                    modified.last_crown = modified.last_seen
+                    lastcrown_modifications.append({'rowid': modified.rowid,
+                                                    'new_record': modified.to_row(crown_header_order)})
             # It is possible there is more than one set of bad data. Remove all of them.
             del member_crowns[indices[0] : indices[1]]
             indices = get_prune_range(member_crowns)
         # Update the stored data to reflect the fixed representation.
         indexed_crowns[uid] = member_crowns
-        kept_rowids = set(x['rowid'] for x in member_crowns)
+        kept_rowids = set(x.rowid for x in member_crowns)
         lastcrown_recalculations.extend([x for x in lastcrown_modifications if x['rowid'] in kept_rowids])
 
     if collected_bad_crowns:
         # Write this data to disk (allow avoiding an expensive requery of the table)
-        with open(filename, 'w', encoding='utf-8', newline='') as file:
-            dw = csv.DictWriter(file, fieldnames=list(collected_bad_crowns[0].keys()), quoting=csv.QUOTE_NONNUMERIC)
-            dw.writeheader()
-            dw.writerows(collected_bad_crowns)
+        write_records(collected_bad_crowns, filename)
 
-        min_ms = min(x["LastTouched"] for x in collected_bad_crowns if x['MHCC'] > 0)
+        min_ms = min(x.last_touched for x in collected_bad_crowns if x.mhcc > 0)
         print(f'Earliest data regression was on {datetime.utcfromtimestamp(min_ms//1000).replace(microsecond=min_ms%1000*1000).strftime(STRTM_FMT)}')
 
         # Create a backup of the crowns table
-        if ft.backup_table(tableId, await_clone=True):
-            _perform_deletion(ft, tableId, [x['rowid'] for x in collected_bad_crowns])
+        if backed_up or ft.backup_table(tableId, await_clone=True):
+            _perform_deletion(ft, tableId, [x.rowid for x in collected_bad_crowns])
 
             # Update the associated LastCrown records
             ft.delete_records_by_rowid(tableId, [x['rowid'] for x in lastcrown_recalculations])
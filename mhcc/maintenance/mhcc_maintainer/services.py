@@ -1,20 +1,49 @@
+import codecs
 import csv
 import datetime
+import hashlib
+import io
 import json
 import os
+import random
+import re
+import queue
+import threading
 import time
+import weakref
+from collections import Counter
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from itertools import islice
 from pprint import pprint
+from urllib.parse import urlparse
 
 from googleapiclient.discovery import build
 from googleapiclient.discovery import Resource
 from googleapiclient.http import BatchHttpRequest
+from googleapiclient.http import build_http
 from googleapiclient.http import HttpError
 from googleapiclient.http import HttpRequest
 from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaUpload
+from google.auth.transport.requests import AuthorizedSession
+from google_auth_httplib2 import AuthorizedHttp
 from httplib2 import HttpLib2Error
-
+from httplib2 import Response
+from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import RequestException
+from requests.exceptions import Timeout as RequestsTimeout
+
+from google.api_core.exceptions import Forbidden
+from google.api_core.exceptions import TooManyRequests
 from google.cloud import bigquery
 
+from snapshot import TableSnapshot
+
 def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█'):
     """Call in a loop to create terminal progress bar
 @params:
@@ -37,32 +66,101 @@ Refs https://stackoverflow.com/a/34325723
 
 
 
-def _send_whole_upload(request: HttpRequest):
-    '''Upload a non-resumable media file.
+def get_as_int(val):
+    ''' Function which coerces the input value to an int (or None, if NaN was given) '''
+    try:
+        return int(val)
+    except ValueError:
+        try:
+            return int(float(val))
+        except ValueError as err:
+            if val == 'NaN':
+                return None
+            raise err
+    raise TypeError(f'Unknown or unhandled conversion of {val}')
+
+
+
+def _blank_as_none(convert):
+    '''Wrap a numeric conversion so that blank values (e.g. empty cells) become None, rather than raising.'''
+    return lambda value: None if value == '' or value is None else convert(value)
+
+
+
+def iter_in_clause_queries(template: str, values, max_length: int):
+    '''Pack the given values into as few queries as possible, each no longer than the given length.
+
+The running length of the current IN-list is tracked as values are added, so packing N values
+costs O(N) rather than re-joining the list for every value that is added.
 
 @params:
-    request: HttpRequest, a MediaUpload object.
+    template: str, the query, with '{}' where the comma-separated values belong.
+            e.g. 'SELECT * FROM <tableId> WHERE ROWID IN ({})'
+    values: iterable, the values to include in the queries (converted with str). Not modified.
+    max_length: int, the maximum length of each yielded query.
 
-@return: tuple(bool, whether or not the upload succeeded
-               response, the result of the executed request (or None)
-    '''
-    if not request or not isinstance(request, HttpRequest):
-        return (False, None)
+@yields: tuple(str, the next query
+               int, the number of values in that query)
 
+@raises: ValueError, if the template has no '{}', or a single value cannot fit within the limit.
+    '''
+    head, marker, tail = template.partition('{}')
+    if not marker:
+        raise ValueError('Query template has no placeholder for its values.')
+    margin = max_length - len(head) - len(tail)
+    chunk = []
+    length = -1
+    for value in values:
+        value = str(value)
+        if chunk and length + 1 + len(value) > margin:
+            yield (head + ','.join(chunk) + tail, len(chunk))
+            chunk = []
+            length = -1
+        if len(value) > margin:
+            raise ValueError(f'Value "{value[:25]}" is too long to fit in a query.')
+        chunk.append(value)
+        length += 1 + len(value)
+    if chunk:
+        yield (head + ','.join(chunk) + tail, len(chunk))
+
+
+
+def _is_throttled(err: HttpError) -> bool:
+    '''Whether the error indicates the request was refused due to rate limiting or server load.'''
+    if err.resp.status in (429, 503):
+        return True
+    if err.resp.status != 403:
+        return False
     try:
-        resp = request.execute(num_retries=2)
-        return (True, resp)
-    except (HttpLib2Error | HttpError) as err:
-        print('Upload failed:', err)
-    return (False, None)
+        reasons = [x.get('reason') for x in json.loads(err.content.decode())['error']['errors']]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return False
+    return any(x in ('rateLimitExceeded', 'userRateLimitExceeded') for x in reasons)
+
+
+
+# The initial size of each request of a resumable upload, and the bounds within which it is adapted
+# to the connection. Each must be a multiple of 256 kB.
+UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+MIN_UPLOAD_CHUNK_BYTES = 256 * 1024
+MAX_UPLOAD_CHUNK_BYTES = 64 * 1024 * 1024
+# The desired duration of each request of a resumable upload.
+UPLOAD_CHUNK_SECONDS = 20.
 
 
 
-def _step_upload(request: HttpRequest):
+def _step_upload(request: HttpRequest, session: dict = None, http=None, show_progress=True,
+                 policy: 'RetryPolicy' = None):
     '''Print the percentage complete for a given upload while it is executing.
+If a session is given, the upload's state is saved after each chunk, so resume_upload can continue it.
 
 @params:
     request: HttpRequest, supporting next_chunk() (i.e., is resumable).
+    session: dict, the 'path' of the session file, and the values needed to recreate the
+            request (e.g. 'tableId', 'method', 'delimiter').
+    http: AuthorizedHttp, the transport to use (e.g. borrowed from an HttpPool), if not the service's.
+    show_progress: bool, whether to print a progress bar as each chunk is sent.
+    policy: RetryPolicy, the retry schedule to use. Defaults to that of GoogleService.
 
 @return: tuple(bool, whether or not the upload succeeded
                response, the result of the executed request (or None)
@@ -73,42 +171,293 @@ def _step_upload(request: HttpRequest):
     if not request or not isinstance(request, HttpRequest):
         return (False, None)
 
+    policy = policy or GoogleService.retry_policy
+    media = request.resumable
     done = None
     fails = 0
+    started = time.perf_counter()
     while done is None:
+        start = time.perf_counter()
         try:
-            status, done = request.next_chunk()
+            status, done = request.next_chunk(http=http)
         except HttpLib2Error as err:
             print('Transport error: ', err)
+            fails += 1
+            delay = policy.get_delay(err, fails, started)
+            if delay is None:
+                return (False, None)
+            # Ask the server how much of the upload it received before sending more.
+            request._in_error_state = True
+            _set_chunksize(media, media.chunksize() // 2)
+            time.sleep(delay)
         except HttpError as err:
-            print()
+            if show_progress:
+                print()
             if err.resp.status in [404]:
+                _remove_upload_session(session)
                 return (False, None)
-            if err.resp.status in [500, 502, 503, 504] and fails < 5:
-                time.sleep(2 ^ fails)
-                fails += 1
-            elif (err.resp.status in [417] and fails < 5
+            if (err.resp.status in [417]
                     and 'Table will exceed allowed maximum size' in err.__str__()):
                 raise err
-            else:
+            fails += 1
+            delay = policy.get_delay(err, fails, started)
+            if delay is None:
                 print('Upload failed:', err)
                 return (False, None)
+            _set_chunksize(media, media.chunksize() // 2)
+            time.sleep(delay)
         else:
-            print_progress_bar(status.progress() if status else 1., 1., 'Uploading...', length=50)
-
-    print()
+            policy.record_success()
+            fails = 0
+            elapsed = time.perf_counter() - start
+            if elapsed < UPLOAD_CHUNK_SECONDS / 2:
+                _set_chunksize(media, media.chunksize() * 2)
+            elif elapsed > UPLOAD_CHUNK_SECONDS * 2:
+                _set_chunksize(media, media.chunksize() // 2)
+            if done is None:
+                _save_upload_session(request, session)
+            if show_progress:
+                print_progress_bar(status.progress() if status else 1., 1., 'Uploading...', length=50)
+
+    _remove_upload_session(session)
+    if isinstance(media, _RowStreamUpload):
+        media.close()
+    if show_progress:
+        print()
     return (True, done)
 
 
 
-def _make_media_file(values: list, path: str, is_resumable=None, delimiter=','):
-    '''Returns a MediaFileUpload with UTF-8 encoding.
+def _set_chunksize(media: MediaUpload, size: int):
+    '''Change the size of the remaining requests of a resumable upload, within the allowed bounds.'''
+    size = min(MAX_UPLOAD_CHUNK_BYTES, max(MIN_UPLOAD_CHUNK_BYTES, size))
+    # Both MediaFileUpload and _RowStreamUpload read their request size from this attribute.
+    media._chunksize = size - size % MIN_UPLOAD_CHUNK_BYTES
+
+
+
+def _get_media_source(media: MediaUpload) -> str:
+    '''Get the local file from which all of the media's bytes can be read again, if there is one.'''
+    if isinstance(media, _RowStreamUpload):
+        return media.get_source()
+    return getattr(media, '_filename', '')
+
+
+
+def _save_upload_session(request: HttpRequest, session: dict):
+    '''Record the progress of the given resumable upload in its session file.
+
+The session is only saved if the rest of the upload's bytes can be read from disk. Streamed rows
+that have a disk copy are first written to it in full (see _RowStreamUpload.persist).
+    '''
+    if not session or not request.resumable_uri:
+        return
+    if isinstance(request.resumable, _RowStreamUpload):
+        request.resumable.persist()
+    source = _get_media_source(request.resumable)
+    if not source:
+        return
+    state = dict(session, uri=request.resumable_uri, progress=request.resumable_progress,
+                 chunksize=request.resumable.chunksize(), filename=os.path.abspath(source))
+    with open(session['path'] + '.partial', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(session['path'] + '.partial', session['path'])
+
+
+
+def _remove_upload_session(session: dict):
+    '''Remove the session file of a finished upload.'''
+    if session and os.path.exists(session['path']):
+        os.remove(session['path'])
+
+
+
+def _measure_response(request: HttpRequest) -> dict:
+    '''Record the size of the given request's response body when it is executed.
+
+@params:
+    request: HttpRequest, a request that has not yet been executed.
+
+@return: dict, whose 'bytes' property holds the size of the received response body, in bytes.
+    '''
+    measured = {'bytes': 0}
+    postproc = request.postproc
+
+    def _postproc(resp, content):
+        measured['bytes'] = len(content)
+        return postproc(resp, content)
+
+    request.postproc = _postproc
+    return measured
+
+
+
+def _iter_text_lines(chunks, encoding='utf-8'):
+    '''Incrementally decode the given byte chunks, and yield each line of the text.
+
+Lines are only split at newlines (which are kept), so that a CSV reader can rejoin quoted fields
+that span several lines.
+
+@params:
+    chunks: iterable, the bytes to decode, in order (e.g. from a streamed HTTP response).
+    encoding: str, the text encoding of the bytes.
+
+@yields: str, the next line of the text, including its trailing newline (if any).
+    '''
+    decoder = codecs.getincrementaldecoder(encoding)()
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + decoder.decode(chunk)).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    partial += decoder.decode(b'', final=True)
+    if partial:
+        yield partial
+
+
+
+class _RowStreamUpload(MediaUpload):
+    """Resumable media upload which serializes its rows as CSV only as the upload consumes them.
+
+Rows are written to the buffer just ahead of the chunk being sent, so serialization overlaps the
+upload of earlier chunks, and bytes that the server has acknowledged are discarded. If a path is
+given, the serialized rows are also written to that file, e.g. to retry a failed upload from disk.
+Once persisted, the rest of the rows are in that file, and the upload reads its bytes from it.
+    """
+    def __init__(self, rows, delimiter=',', chunksize=UPLOAD_CHUNK_BYTES, path=''):
+        self._rows = iter(rows)
+        self._chunksize = chunksize
+        self._text = io.StringIO()
+        self._writer = csv.writer(self._text, strict=True, delimiter=delimiter, quoting=csv.QUOTE_NONNUMERIC)
+        self._copy = open(path, 'wb') if path else None
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._next_begin = 0
+        self._exhausted = False
+        self._source = None
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return 'application/octet-stream'
+
+    def resumable(self):
+        return True
+
+    def size(self):
+        # Serialize one byte past the next chunk, so that a payload ending on a chunk boundary
+        # is still recognized as complete when that chunk is sent.
+        self._fill(self._next_begin + self._chunksize + 1)
+        return self._buffer_start + len(self._buffer) if self._exhausted else None
+
+    def is_complete(self) -> bool:
+        """Whether every row has been serialized (and written to the disk copy, if any)."""
+        return self._exhausted
+
+    def getbytes(self, begin, length):
+        if self._source:
+            self._source.seek(begin)
+            return self._source.read(length)
+        if begin < self._buffer_start:
+            raise IOError(f'Bytes before offset {self._buffer_start} have already been discarded.')
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+        self._fill(begin + length)
+        self._next_begin = begin + min(length, len(self._buffer))
+        return bytes(self._buffer[:length])
+
+    def get_source(self) -> str:
+        """The path of the disk copy, once every row has been written to it (otherwise an empty string)."""
+        return self._copy.name if self._copy and self._exhausted else ''
+
+    def persist(self) -> str:
+        """Write every remaining row to the disk copy, and read the rest of the upload from it.
+
+    @return: str, the path of the complete disk copy, or an empty string if there is no disk copy.
+        """
+        if not self._copy:
+            return ''
+        if not self._source:
+            while not self._exhausted:
+                self._fill(self._buffer_start + len(self._buffer) + 1)
+                # The disk copy already holds the buffered bytes.
+                self._buffer_start += len(self._buffer)
+                self._buffer.clear()
+            self._source = open(self._copy.name, 'rb')
+        return self._copy.name
+
+    def close(self):
+        """Close the disk copy, if any."""
+        if self._copy:
+            self._copy.close()
+        if self._source:
+            self._source.close()
+
+    def _fill(self, end: int, batch_size=1000):
+        """Serialize rows until the buffer reaches the given byte offset, or the rows are exhausted."""
+        while not self._exhausted and self._buffer_start + len(self._buffer) < end:
+            batch = list(islice(self._rows, batch_size))
+            if not batch:
+                self._exhausted = True
+                self.close()
+                break
+            self._writer.writerows(batch)
+            data = self._text.getvalue().encode('utf-8')
+            self._text.seek(0)
+            self._text.truncate()
+            self._buffer.extend(data)
+            if self._copy:
+                self._copy.write(data)
+
+
+
+def _iter_csv_shards(rows, max_bytes: int, delimiter=',', copy=None):
+    '''Serialize the given rows as CSV, in consecutive shards of at most the given size.
 
-Also creates a hard disk backup (to facilitate the MediaFile creation).
-If the upload fails, the backup can be used to avoid re-downloading the input.
+@params:
+    rows: iterable, the rows to serialize (e.g. a list of lists).
+    max_bytes: int, the maximum size of each shard. A single larger row is its own shard.
+    delimiter: str, the CSV delimiter to use.
+    copy: file, a binary file to which every shard is also written, if any.
+
+@yields: tuple(bytes, the serialized (UTF-8) rows of the shard
+               int, the number of rows in the shard)
     '''
-    _write_as_csv(values, path, 'w', delimiter)
-    return MediaFileUpload(path, mimetype='application/octet-stream', resumable=is_resumable)
+    text = io.StringIO()
+    writer = csv.writer(text, strict=True, delimiter=delimiter, quoting=csv.QUOTE_NONNUMERIC)
+    shard = bytearray()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        data = text.getvalue().encode('utf-8')
+        text.seek(0)
+        text.truncate()
+        if count and len(shard) + len(data) > max_bytes:
+            yield (bytes(shard), count)
+            shard = bytearray()
+            count = 0
+        shard.extend(data)
+        count += 1
+        if copy:
+            copy.write(data)
+    if count:
+        yield (bytes(shard), count)
+
+
+
+def _get_csv_bytes(rows, delimiter=',') -> int:
+    '''Measure the size of the given rows when serialized as (UTF-8) CSV, without keeping the result.'''
+    text = io.StringIO()
+    writer = csv.writer(text, strict=True, delimiter=delimiter, quoting=csv.QUOTE_NONNUMERIC)
+    size = 0
+    for row in rows:
+        writer.writerow(row)
+        size += len(text.getvalue().encode('utf-8'))
+        text.seek(0)
+        text.truncate()
+    return size
 
 
 
@@ -129,19 +478,316 @@ Example path: 'staging.csv' -> write file 'staging.csv' in the script's director
 
 
 
+class RateGovernor():
+    """Process-wide request pacing, with a token bucket for each API.
+
+Each API's rate (requests per second) grows additively with every successful request and is cut
+multiplicatively whenever a request is rate limited (AIMD), so that requests are sent close to
+the quota that is actually available, without repeated bursts of rate limit errors. A bucket holds
+at most one second's worth of requests, so idle time does not allow a large burst.
+    """
+    def __init__(self, rate=5., min_rate=0.2, max_rate=50., increase=0.1, decrease=0.5):
+        self.initial_rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _get_bucket(self, api: str) -> dict:
+        bucket = self._buckets.get(api)
+        if bucket is None:
+            bucket = {'rate': self.initial_rate, 'tokens': 1., 'updated': time.perf_counter(),
+                      'requests': 0, 'throttled': 0, 'waited': 0.}
+            self._buckets[api] = bucket
+        return bucket
+
+    def acquire(self, api: str):
+        """Wait until the given API's bucket allows another request to be sent."""
+        delay = self.reserve(api)
+        if delay:
+            time.sleep(delay)
+
+    def reserve(self, api: str) -> float:
+        """Reserve the given API's next request, and return the number of seconds to wait before sending it.
+    For callers which must not block while waiting, e.g. coroutines.
+        """
+        with self._lock:
+            bucket = self._get_bucket(api)
+            now = time.perf_counter()
+            capacity = max(1., bucket['rate'])
+            bucket['tokens'] = min(capacity, bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+            bucket['updated'] = now
+            # Reserve a token now, so concurrent callers queue behind each other.
+            bucket['tokens'] -= 1
+            delay = -bucket['tokens'] / bucket['rate'] if bucket['tokens'] < 0 else 0.
+            bucket['requests'] += 1
+            bucket['waited'] += delay
+        return delay
+
+    def record_success(self, api: str):
+        """Increase the given API's rate, after a request that was not rate limited."""
+        with self._lock:
+            bucket = self._get_bucket(api)
+            bucket['rate'] = min(self.max_rate, bucket['rate'] + self.increase)
+
+    def record_throttled(self, api: str):
+        """Decrease the given API's rate, after a request that was rate limited."""
+        with self._lock:
+            bucket = self._get_bucket(api)
+            bucket['rate'] = max(self.min_rate, bucket['rate'] * self.decrease)
+            bucket['tokens'] = min(bucket['tokens'], 0.)
+            bucket['throttled'] += 1
+
+    def get_rate(self, api: str) -> float:
+        """The current rate of the given API, in requests per second."""
+        with self._lock:
+            return self._get_bucket(api)['rate']
+
+    def report(self) -> str:
+        """Summarize the pacing of each API."""
+        with self._lock:
+            return '; '.join('{}: {:,} requests, {:,} rate limited, {:,.1f} sec waiting, now {:.1f}/sec'.format(
+                api, x['requests'], x['throttled'], x['waited'], x['rate']) for api, x in self._buckets.items())
+
+
+
+class RetryPolicy():
+    """Retry schedule for the API requests of every GoogleService.
+
+Transport errors, server errors and rate limiting are retried with jittered exponential backoff,
+drawn from a shared retry budget. Requests that are not idempotent are only retried if rate limited.
+    """
+    RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+    TRANSPORT_ERRORS = (HttpLib2Error, ConnectionError, TimeoutError,
+                        RequestsConnectionError, RequestsTimeout, ChunkedEncodingError)
+
+    def __init__(self, max_attempts=6, base_delay=1., max_delay=64., deadline=600.,
+                 budget=100, budget_refill=0.1):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.budget = budget
+        self.budget_refill = budget_refill
+        self._tokens = float(budget)
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0, 'waited': 0., 'budget_exhausted': 0}
+
+    @classmethod
+    def is_retryable(cls, err: Exception, idempotent=True) -> bool:
+        """Whether the error indicates the request could succeed (and be applied only once) if it is sent again."""
+        if not idempotent:
+            # Only a request refused before it was processed is sure not to have been applied.
+            return isinstance(err, HttpError) and err.resp.status != 503 and _is_throttled(err)
+        if isinstance(err, HttpError):
+            return err.resp.status in cls.RETRYABLE_STATUSES or _is_throttled(err)
+        return isinstance(err, cls.TRANSPORT_ERRORS)
+
+    def get_delay(self, err: Exception, attempt: int, started: float, deadline: float = None,
+                  idempotent=True) -> float:
+        '''Determine how long to wait before the given attempt of a call is retried.
+
+    @params:
+        err: Exception, the error of the failed attempt.
+        attempt: int, the number of attempts of the call that have failed (1 for the first).
+        started: float, the time.perf_counter() at which the call was first attempted.
+        deadline: float, the number of seconds after which the call may no longer be retried.
+        idempotent: bool, whether the call may be safely applied more than once.
+
+    @return: float, the number of seconds to wait, or None if the call should not be retried.
+        '''
+        deadline = self.deadline if deadline is None else deadline
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        with self._lock:
+            if (not self.is_retryable(err, idempotent) or attempt >= self.max_attempts
+                    or time.perf_counter() - started + delay > deadline):
+                self.stats['failures'] += 1
+                return None
+            if self._tokens < 1:
+                self.stats['budget_exhausted'] += 1
+                self.stats['failures'] += 1
+                return None
+            self._tokens -= 1
+            self.stats['retries'] += 1
+            self.stats['waited'] += delay
+        return delay
+
+    def record_success(self):
+        """Count a successful call, and refill the retry budget."""
+        with self._lock:
+            self.stats['calls'] += 1
+            self._tokens = min(self.budget, self._tokens + self.budget_refill)
+
+    def execute(self, request, http=None, deadline: float = None, governor: RateGovernor = None, api='',
+                idempotent=True):
+        '''Execute the given request, retrying it according to this policy.
+
+    @params:
+        request: HttpRequest (or BatchHttpRequest), the request to execute.
+        http: AuthorizedHttp, the transport to use (e.g. borrowed from an HttpPool), if not the service's.
+        deadline: float, the number of seconds after which the request may no longer be retried.
+        governor: RateGovernor, which paces each attempt of the request, if any.
+        api: str, the API whose rate the governor should use.
+        idempotent: bool, whether the request may be safely applied more than once (see is_retryable).
+
+    @return: the result of the executed request.
+
+    @raises: HttpError (or HttpLib2Error), the error of the last attempt, if it could not be retried.
+        '''
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            if governor:
+                governor.acquire(api)
+            try:
+                response = request.execute(http=http)
+            except (HttpError,) + self.TRANSPORT_ERRORS as err:
+                if governor and isinstance(err, HttpError) and _is_throttled(err):
+                    governor.record_throttled(api)
+                attempt += 1
+                delay = self.get_delay(err, attempt, started, deadline, idempotent)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                if governor:
+                    governor.record_success(api)
+                self.record_success()
+                return response
+
+    def report(self) -> str:
+        """Summarize the retries made under this policy."""
+        return ('{calls:,} calls succeeded, {retries:,} retries ({waited:,.1f} sec waiting), '
+                '{failures:,} failed, retry budget exhausted {budget_exhausted:,} times').format_map(self.stats)
+
+
+
+class _SharedCredentials():
+    """Credentials wrapper which lets many transports (and threads) use, and refresh, one set of credentials.
+
+Only one thread refreshes the access token at a time, and a thread that waited on another's refresh
+(of an expired or rejected token) uses the new token rather than refreshing it again.
+    """
+    def __init__(self, credentials: 'google.auth.credentials.Credentials'):
+        self._credentials = credentials
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._credentials, name)
+
+    def before_request(self, request, method, url, headers):
+        with self._lock:
+            if not self._credentials.valid:
+                self._credentials.refresh(request)
+        self._credentials.apply(headers)
+
+    def refresh(self, request):
+        token = self._credentials.token
+        with self._lock:
+            # Skip the refresh if another thread replaced the token while this one waited for the lock.
+            if self._credentials.token == token or not self._credentials.valid:
+                self._credentials.refresh(request)
+
+
+
+class HttpPool():
+    """Bounded pool of authorized HTTP transports, which share one set of credentials.
+
+httplib2 connections are not thread-safe, so each request borrows a transport for as long as it is
+being executed. Transports are reused (most recently returned first), so their keep-alive
+connections stay open. Services built with the same credentials share one pool (see for_credentials).
+    """
+    _pools = weakref.WeakKeyDictionary()
+    _pools_lock = threading.Lock()
+
+    def __init__(self, credentials: 'google.auth.credentials.Credentials', size: int = 8):
+        self.credentials = _SharedCredentials(credentials)
+        self.size = size
+        self._created = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_credentials(cls, credentials: 'google.auth.credentials.Credentials', size: int = 8) -> 'HttpPool':
+        """Get the pool shared by every service using the given credentials, creating it (or enlarging it) if needed."""
+        with cls._pools_lock:
+            pool = cls._pools.get(credentials)
+            if pool is None:
+                pool = cls._pools[credentials] = cls(credentials, size)
+            pool.size = max(pool.size, size)
+            return pool
+
+    def acquire(self) -> AuthorizedHttp:
+        """Borrow a transport, waiting for one to be returned if the pool is at its size limit."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self.create()
+        return self._idle.get()
+
+    def create(self) -> AuthorizedHttp:
+        """Create a new transport using the pool's shared credentials (which is not counted against its size)."""
+        return AuthorizedHttp(self.credentials, http=build_http())
+
+    def release(self, http: AuthorizedHttp):
+        """Return a borrowed transport to the pool."""
+        self._idle.put(http)
+
+    @contextmanager
+    def transport(self):
+        """Borrow a transport for the duration of a with block."""
+        http = self.acquire()
+        try:
+            yield http
+        finally:
+            self.release(http)
+
+
+
 class GoogleService():
     """Basic authenticated Google API"""
+    # Shared by all services, so that the retry budget, request rates and statistics cover the whole process.
+    retry_policy = RetryPolicy()
+    rate_governor = RateGovernor()
+    # The maximum number of concurrent requests (across all services with the same credentials).
+    HTTP_POOL_SIZE = 8
 
     def __init__(self, API_NAME: str, API_VERSION: str, credentials: 'google.oauth2.credentials.Credentials'):
-        self.__service: Resource = build(API_NAME, API_VERSION, credentials=credentials)
+        self.http_pool: HttpPool = HttpPool.for_credentials(credentials, self.HTTP_POOL_SIZE)
+        # The service's own transport (for requests executed without one) also uses the pool's credentials.
+        self.__service: Resource = build(API_NAME, API_VERSION, http=self.http_pool.create())
         self.__API_NAME: str = API_NAME
         self.__API_VERSION: str = API_VERSION
         self.__credentials: google.auth.credentials.Credentials = credentials
         self.__scopes: list = credentials.scopes
+        self.__session: AuthorizedSession = None
 
     def get_service(self) -> Resource:
         return self.__service
 
+    def execute(self, request, http=None, deadline: float = None, idempotent=True):
+        """Execute the given request at the pace set by the rate_governor, retrying it as the retry_policy allows.
+    Unless a transport is given, one is borrowed from the http_pool, so requests may be executed from any thread.
+    Requests which are not idempotent are only retried if they were refused for rate limiting.
+        """
+        if http is None:
+            with self.http_pool.transport() as http:
+                return self.execute(request, http, deadline, idempotent)
+        return self.retry_policy.execute(request, http=http, deadline=deadline, governor=self.rate_governor,
+                                         api=self.get_api_summary(), idempotent=idempotent)
+
+    def get_authorized_session(self) -> AuthorizedSession:
+        """Get an authorized requests session, for responses that should be streamed rather than read whole."""
+        if self.__session is None:
+            self.__session = AuthorizedSession(self.http_pool.credentials)
+        return self.__session
+
     def get_credentials(self):
         return self.__credentials
 
@@ -195,7 +841,7 @@ https://developers.google.com/resources/api-libraries/documentation/drive/v3/pyt
                              'file': None}
         request = self.files.get(**kwargs)
         try:
-            fusiontable_file_resource = request.execute()
+            fusiontable_file_resource = self.execute(request)
             file_datetime = datetime.datetime.strptime(
                 fusiontable_file_resource['modifiedTime'][:-1] + '+0000', '%Y-%m-%dT%H:%M:%S.%f%z')
         except HttpError as err:
@@ -218,12 +864,341 @@ https://developers.google.com/resources/api-libraries/documentation/drive/v3/pyt
 
     Requests the About() resource.
         """
-        about = self.get_service().about().get(fields="user,storageQuota").execute()
+        about = self.execute(self.get_service().about().get(fields="user,storageQuota"))
         pprint(about)
 
 
 
-class FusionTableHandler(GoogleService):
+class MetadataRegistry():
+    """Thread-safe memo of table metadata, such as column lists, type converters and row counts.
+
+Each value expires after a time-to-live, and all of a table's values are discarded when the table
+is invalidated (e.g. after its rows are modified). Concurrent requests for the same missing value
+wait for a single load, rather than each performing it.
+    """
+
+    def __init__(self, ttl=600.):
+        """Constructor for a registry whose values expire after the given number of seconds"""
+        self._ttl = ttl
+        self._values = {}
+        self._loading = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind: str, tableId: str, loader, ttl=None):
+        """Get the named metadata of the table, loading it if it is missing or expired.
+
+    @params:
+        kind: str, the name of the metadata (e.g. 'columns').
+        tableId: str, the table the metadata describes.
+        loader: callable, takes no arguments and returns the metadata. Results of None are not stored.
+        ttl: float, the number of seconds for which a newly loaded value is kept, if not the default.
+
+    @return: the stored or newly-loaded metadata.
+        """
+        key = (kind, tableId)
+        while True:
+            with self._lock:
+                known = self._values.get(key)
+                if known is not None and known[0] > time.monotonic():
+                    return known[1]
+                pending = self._loading.get(key)
+                is_loader = pending is None
+                if is_loader:
+                    pending = self._loading[key] = threading.Event()
+                    generation = self._generations.get(tableId, 0)
+            if not is_loader:
+                # Another thread is loading this value. Once it's done, check again.
+                pending.wait()
+                continue
+
+            try:
+                value = loader()
+                with self._lock:
+                    # Values loaded while the table was being modified may already be stale.
+                    if value is not None and generation == self._generations.get(tableId, 0):
+                        self._values[key] = (time.monotonic() + (self._ttl if ttl is None else ttl), value)
+                return value
+            finally:
+                with self._lock:
+                    del self._loading[key]
+                pending.set()
+
+    def invalidate(self, tableId: str):
+        """Discard all stored metadata of the given table."""
+        with self._lock:
+            self._generations[tableId] = self._generations.get(tableId, 0) + 1
+            for key in [x for x in self._values if x[1] == tableId]:
+                del self._values[key]
+
+
+
+class QueryResultCache():
+    """Size-bounded, on-disk cache of complete FusionTable query results.
+
+Entries are keyed by the query and the modifiedTime of the queried table. The least recently used
+entries are removed when the cache exceeds its size bound.
+    """
+
+    def __init__(self, drive_handler: DriveHandler, directory='query_cache',
+                 max_bytes=1024 * 1024 * 1024, metadata: MetadataRegistry = None):
+        """Constructor for a cache of query results in the given local directory
+
+    @params:
+        drive_handler: DriveHandler, used to read the modification time of queried tables.
+        directory: str, the local directory in which results are stored.
+        max_bytes: int, the total size of stored results above which entries are evicted.
+        metadata: MetadataRegistry, the registry in which tables' modification times are kept
+                (e.g. that of the FusionTableHandler). Defaults to a new registry.
+        """
+        self._drive = drive_handler
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._metadata = metadata if metadata is not None else MetadataRegistry()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def normalize_sql(query: str) -> str:
+        """Collapse whitespace outside of quoted literals, so equivalent queries share entries."""
+        parts = re.split(r"""('[^']*'|"[^"]*")""", query.strip())
+        return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts))
+
+    def get_table_version(self, tableId: str) -> str:
+        """Get the table's Drive modifiedTime, reusing the value held with its metadata. Empty if unavailable."""
+        return self._metadata.get('modified', tableId,
+                                  lambda: self._drive.get_modified_info(tableId)['modifiedString'] or None) or ''
+
+
+    def get_entry_path(self, tableId: str, query: str, *args) -> str:
+        """Get the file path for the given query of the given table, or '' if it can't be cached."""
+        version = self.get_table_version(tableId)
+        if not version:
+            return ''
+        key = json.dumps([self.normalize_sql(query), version] + [str(x) for x in args])
+        return os.path.join(self._directory,
+                            f'{tableId}_{hashlib.sha1(key.encode("utf-8")).hexdigest()}.jsonl')
+
+    def read(self, path: str):
+        """Yield the pages (fusiontables#sqlresponse) of the stored entry, or None if there is none."""
+        try:
+            entry = open(path, 'r', encoding='utf-8')
+        except (FileNotFoundError, PermissionError):
+            return None
+        # Mark the entry as recently used.
+        os.utime(path)
+
+        def _pages():
+            with entry:
+                columns = json.loads(entry.readline())
+                for line in entry:
+                    yield {'kind': 'fusiontables#sqlresponse', 'columns': columns, 'rows': json.loads(line)}
+        return _pages()
+
+    def write_through(self, path: str, pages):
+        """Yield the given pages while storing them. The entry is only kept if all pages are consumed."""
+        partial = path + '.partial'
+        is_complete = False
+        try:
+            with open(partial, 'w', encoding='utf-8') as entry:
+                for page in pages:
+                    if not is_complete:
+                        entry.write(json.dumps(page['columns']) + '\n')
+                        is_complete = True
+                    # Store the page before the caller has a chance to modify its rows.
+                    entry.write(json.dumps(page['rows']) + '\n')
+                    yield page
+        except BaseException:
+            is_complete = False
+            raise
+        finally:
+            if is_complete:
+                os.replace(partial, path)
+                self.evict()
+            elif os.path.exists(partial):
+                os.remove(partial)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within its size bound."""
+        entries = []
+        for name in os.listdir(self._directory):
+            if name.endswith('.jsonl'):
+                stat = os.stat(os.path.join(self._directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(x[1] for x in entries)
+        for _, size, name in entries:
+            if total <= self._max_bytes:
+                break
+            os.remove(os.path.join(self._directory, name))
+            total -= size
+
+    def invalidate(self, tableId: str):
+        """Remove all stored results for the given table."""
+        self._metadata.invalidate(tableId)
+        for name in os.listdir(self._directory):
+            if name.startswith(tableId + '_'):
+                os.remove(os.path.join(self._directory, name))
+
+
+
+class FusionTableRequestPlanner():
+    """The parts of the FusionTables handlers that do not depend on how their requests are sent.
+
+FusionTableHandler (httplib2, from threads) and AsyncFusionTableHandler (aiohttp, from coroutines)
+both size query pages from the measured sizes of earlier responses, pack rowids into as few
+"ROWID IN (...)" statements as the query length limits allow, check the rows received for a set of
+rowids, and name and log their table backups in the same way.
+    """
+    MAX_GET_QUERY_LENGTH = 7900
+    MAX_DELETE_QUERY_LENGTH = 6000
+    # sqlGet responses larger than 10 MB are refused, so pages are sized to fill most of that.
+    MAX_RESPONSE_BYTES = 10 * 1024 * 1024
+    TARGET_RESPONSE_BYTES = int(9.5 * 1024 * 1024)
+
+    def __init__(self):
+        # Measured response sizes, as {(tableId, selected columns): [total bytes, total rows]}.
+        self._row_sizes = {}
+        self._row_size_lock = threading.Lock()
+
+
+    @staticmethod
+    def get_row_size_key(query: str) -> tuple:
+        '''Identify the table and column selection of a SELECT query, for row size bookkeeping.
+
+    @params:
+        query: str, the SQL GET statement.
+
+    @return: tuple(str, the table id; str, the normalized column selection), or None if the query
+            is not a SELECT statement.
+        '''
+        match = re.match(r'\s*select\s+(.+?)\s+from\s+([\w-]+)', query, re.IGNORECASE | re.DOTALL)
+        if not match:
+            return None
+        return (match.group(2), ' '.join(match.group(1).lower().split()))
+
+
+    def get_page_limit(self, query: str, kb_row_size=1.) -> int:
+        '''Determine the number of rows that fit in a single sqlGet response for the given query.
+
+    Uses the row size measured from earlier responses to queries against the same table (and
+    same selected columns), if there are any. Otherwise, the caller's estimate is used.
+
+    @params:
+        query: str, the SQL GET statement.
+        kb_row_size: float, the expected size of an individual returned row, in kB.
+
+    @return: int, the LIMIT to use for the next page of the query.
+        '''
+        measured = self._row_sizes.get(self.get_row_size_key(query))
+        if measured and measured[1]:
+            return max(1, int(self.TARGET_RESPONSE_BYTES * measured[1] / measured[0]))
+        return max(1, int(9.5 * 1024 / kb_row_size))
+
+
+    def _record_page_size(self, query: str, response_bytes: int, row_count: int):
+        '''Store the measured size of a query response, for sizing later pages.'''
+        key = self.get_row_size_key(query)
+        if key is None or not row_count:
+            return
+        with self._row_size_lock:
+            measured = self._row_sizes.setdefault(key, [0, 0])
+            measured[0] += response_bytes
+            measured[1] += row_count
+
+
+    @staticmethod
+    def get_count_query(query: str) -> str:
+        '''Rewrite a SELECT query into one that counts the rows of its result.
+
+    @params:
+        query: str, the SQL SELECT statement.
+
+    @return: str, the equivalent "SELECT COUNT()" statement, or an empty string if the query's
+            result cannot be counted this way (e.g. it aggregates or groups its rows).
+        '''
+        match = re.match(r'\s*select\s+(.+?)\s+(from\s.+)', query, re.IGNORECASE | re.DOTALL)
+        if not match or '(' in match.group(1) or re.search(r'\bgroup\s+by\b', query, re.IGNORECASE):
+            return ''
+        source = re.split(r'\border\s+by\b', match.group(2), flags=re.IGNORECASE)[0]
+        return 'SELECT COUNT() ' + source.strip()
+
+
+    @classmethod
+    def get_rowid_queries(cls, tableId: str, rowids, delete=False) -> list:
+        '''Pack the given rowids into as few "ROWID IN (...)" statements as the query length limit allows.
+
+    @params:
+        tableId: str, the table whose rows are selected (or deleted).
+        rowids: iterable, the ids of the rows.
+        delete: bool, whether to DELETE the rows, rather than SELECT all of their columns.
+
+    @return: list[str], the statements.
+        '''
+        if delete:
+            template, max_length = f'DELETE FROM {tableId} WHERE ROWID IN ({{}})', cls.MAX_DELETE_QUERY_LENGTH
+        else:
+            template, max_length = f'SELECT * FROM {tableId} WHERE ROWID IN ({{}})', cls.MAX_GET_QUERY_LENGTH
+        return [query for query, _ in iter_in_clause_queries(template, rowids, max_length)]
+
+
+    @staticmethod
+    def _check_rowid_request(rowids: list, tableId: str):
+        '''Validate the inputs of get_records_by_rowid.
+
+    @raises: TypeError, if the rowids are not a (non-empty) list, or the table id is not a string.
+             ValueError, if the table id is not a valid FusionTable id.
+        '''
+        if not (rowids and isinstance(rowids, list)):
+            raise TypeError('Expected list of rowids.')
+        if not isinstance(tableId, str):
+            raise TypeError('Expected string table ID.')
+        elif len(tableId) != 41:
+            raise ValueError('Received invalid table ID.')
+
+
+    @staticmethod
+    def _combine_rowid_responses(responses: list, rowids: list) -> list:
+        '''Combine the responses to the queries of get_records_by_rowid into its result.
+
+    @params:
+        responses: list, the fusiontables#sqlresponse of each query, in order.
+        rowids: list, the ids of the rows that were requested.
+
+    @return: list, the rows of every response, in order.
+
+    @raises: ValueError, if the responses have different columns, or not every row was received.
+        '''
+        columns = responses[0]['columns']
+        for i, response in enumerate(responses):
+            if len(response['columns']) != len(columns):
+                raise ValueError(f'Incorrect column count in response to query {i}')
+        rows = [row for response in responses for row in response.get('rows', [])]
+        if len(rows) != len(rowids):
+            raise ValueError('Obtained different number of records than specified')
+        return rows
+
+
+    @staticmethod
+    def describe_backup(backup: dict, tableId: str) -> dict:
+        """Rename a copied table ("Copy of ...") to a dated backup name, and describe what it backs up."""
+        assert backup['name'].find('Copy of ') > -1, 'Name does not have "Copy of " in it: \'{}\''.format(backup['name'])
+        now = datetime.datetime.utcnow()
+        backup['name'] = '_'.join(backup['name'][(backup['name'].find('Copy of ') + len('Copy of ')):].split())
+        backup['name'] = '{}_AsOf_{}-{!s:0>2}-{!s:0>2} {!s:0>2}:{!s:0>2}'.format(
+            backup['name'], now.year, now.month, now.day, now.hour, now.minute)
+        backup['description'] = 'Automatically generated backup of tableId=' + tableId
+        return backup
+
+
+    @staticmethod
+    def _log_backup(backup: dict):
+        """Append the name and id of a new backup to the local list of tables."""
+        with open('tables.txt', 'a', newline='') as f:
+            csv.writer(f, quoting=csv.QUOTE_ALL).writerows([[backup['name'], backup['tableId']]])
+
+
+
+class FusionTableHandler(GoogleService, FusionTableRequestPlanner):
     """Authenticated FusionTables service instance with appropriate methods for my personal use.
 
 Required scopes for this particular class:
@@ -233,16 +1208,36 @@ Required scopes for this particular class:
 Full documentation of the actual service available here:
 https://developers.google.com/resources/api-libraries/documentation/fusiontables/v2/python/latest/
     """
-    MAX_GET_QUERY_LENGTH = 7900
-    MAX_DELETE_QUERY_LENGTH = 6000
+    # The number of concurrent requests used by full-table reads that opt in to parallel paging.
+    MAX_PARALLEL_REQUESTS = 4
+    # The size of the buffers in which media (CSV) query results are streamed.
+    MEDIA_CHUNK_BYTES = 1024 * 1024
+    # Numeric columns that a query may be ORDERed BY in order to be paged by key instead of OFFSET.
+    # (ROWID is not one: it can only be filtered by = or IN, and need not increase in table order.)
+    KEYSET_COLUMNS = ('lastseen', 'lastcrown', 'ranktime', 'lasttouched')
+    # The number of seconds for which a table's row count is reused. Column metadata is kept longer.
+    ROW_COUNT_TTL = 60.
+    # Rough costs used by plan_row_removal to compare deleting rows with replacing the table's rows.
+    REMOVAL_COSTS = {'seconds_per_request': 1.0,        # round trip and overhead of any API call
+                     'seconds_per_deleted_row': 0.005,  # server time to apply a DELETE, per row
+                     'seconds_per_imported_row': 0.0005,  # server time to apply replaceRows, per row
+                     'bytes_per_second': 1024 * 1024,   # transfer rate, in either direction
+                     'bytes_per_row': 250}              # until a SELECT * response has been measured
+    # FusionTables refuse uploads (HTTP 417) that would make a table's data exceed 250 MB.
+    MAX_TABLE_BYTES = 250 * 1024 * 1024
+    # The maximum size of each separately-uploaded part of an importRows call.
+    IMPORT_SHARD_BYTES = 32 * 1024 * 1024
 
     def __init__(self, credentials: 'google.auth.credentials.Credentials'):
         super().__init__('fusiontables', 'v2', credentials)
+        FusionTableRequestPlanner.__init__(self)
         # Assign handles for the general resources.
         self.column = self.get_service().column()
         self.query = self.get_service().query()
         self.table = self.get_service().table()
         self.task = self.get_service().task()
+        self._query_cache: QueryResultCache = None
+        self.metadata = MetadataRegistry()
 
     @classmethod
     def remaining_query_length(cls, query: str = '') -> int:
@@ -305,17 +1300,37 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
             raise TypeError('Expected bytestring input data')
 
         query_result = {'kind': "fusiontables#sqlresponse"}
-        separator = ','
-        result_string = media_input.decode()
-        collected_row_data = []
-        for row in result_string.splitlines():
-            collected_row_data.append(row.split(separator))
+        collected_row_data = list(csv.reader(_iter_text_lines([media_input]), strict=True))
 
         query_result['columns'] = collected_row_data.pop(0)
         query_result['rows'] = collected_row_data
         return query_result
 
 
+    def enable_query_cache(self, drive_handler: DriveHandler, directory='query_cache',
+                           max_bytes=1024 * 1024 * 1024):
+        '''Serve repeated SELECT queries of unchanged tables from an on-disk cache.
+
+    @params:
+        drive_handler: DriveHandler, used to read the modification time of queried tables.
+        directory: str, the local directory in which results are stored.
+        max_bytes: int, the total size of stored results above which entries are evicted.
+        '''
+        self._query_cache = QueryResultCache(drive_handler, directory, max_bytes, self.metadata)
+
+
+    def invalidate_query_cache(self, tableId: str):
+        '''Discard any cached query results for the given table (e.g. after modifying its rows).'''
+        if self._query_cache is not None:
+            self._query_cache.invalidate(tableId)
+
+
+    def _on_table_modified(self, tableId: str):
+        '''Discard all cached query results and metadata of a table whose rows were modified.'''
+        self.metadata.invalidate(tableId)
+        self.invalidate_query_cache(tableId)
+
+
     @staticmethod
     def get_filename_for_table(tableId: str, method: str = '') -> str:
         """Returns the name that would be used to save that table data locally"""
@@ -332,7 +1347,7 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
         all_tables = []
         request = self.table.list(fields="items(name,tableId,columns/name)")
         while request is not None:
-            response = request.execute()
+            response = self.execute(request)
             all_tables.extend(response.get('items', []))
             request = self.table.list_next(request, response)
 
@@ -347,21 +1362,39 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
                 csv.writer(f, quoting=csv.QUOTE_ALL).writerows(tables_to_write)
 
 
-    def count_rows(self, tableId: str) -> int:
+    def count_rows(self, tableId: str, cached=True) -> int:
         '''Query the size of a table, in terms of rows.
 
+    Counts are reused for ROW_COUNT_TTL seconds. Rows may be added to the live tables at any time,
+    so decisions that could lose rows (e.g. whether a download is complete) should not use a reused count.
+
     @params:
         tableId: str, the target FusionTable's id.
+        cached: bool, whether a recently-read count may be used. If not, the rows are counted now
+                (bypassing both the metadata and the query caches).
 
     @return: int, the number of rows in the FusionTable.
         '''
         if not (tableId and isinstance(tableId, str)):
             raise TypeError("Expected string FusionTable identifier")
 
-        count_sql = 'select COUNT() from ' + tableId
-        row_count_result = self.get_query_result(count_sql)
-        if row_count_result and 'rows' in row_count_result:
-            return int(row_count_result['rows'][0][0])
+        if not cached:
+            try:
+                response = self.execute(self.query.sqlGet(sql='select COUNT() from ' + tableId))
+                return int(response['rows'][0][0])
+            except (HttpError, KeyError, IndexError) as err:
+                print(f'Row count query failed for table \'{tableId}\':', err)
+                return int(0)
+
+        def _count():
+            row_count_result = self.get_query_result('select COUNT() from ' + tableId)
+            if row_count_result and 'rows' in row_count_result:
+                return int(row_count_result['rows'][0][0])
+            return None
+
+        row_count = self.metadata.get('row_count', tableId, _count, self.ROW_COUNT_TTL)
+        if row_count is not None:
+            return row_count
 
         print(f'Row count query failed for table \'{tableId}\'')
         return int(0)
@@ -380,25 +1413,77 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
         table_tasks = []
         request = self.task.list(tableId=tableId)
         while request is not None:
-            response = request.execute()
+            response = self.execute(request)
             table_tasks.extend(response.get('items', []))
             request = self.task.list_next(request, response)
 
         return table_tasks
 
 
+    def _await_tasks(self, tableId: str, first_poll=0.5, max_poll=10.):
+        '''Wait until the given table has no running or scheduled tasks.
+
+    The table is polled again soon after a task is found, and then less and less frequently while it
+    continues (each poll is also paced by the rate governor), so short tasks are not waited on for long.
+
+    @params:
+        tableId: str, the table whose tasks (like row deletion) must finish.
+        first_poll: float, the number of seconds to wait before the first repeated poll.
+        max_poll: float, the maximum number of seconds to wait between polls.
+        '''
+        poll = first_poll
+        tasks = self.get_tasks(tableId)
+        while tasks:
+            print(tasks[0]['type'], tasks[0]['progress'])
+            time.sleep(poll)
+            poll = min(max_poll, poll * 1.5)
+            tasks = self.get_tasks(tableId)
+
+
     def get_all_columns(self, tableId: str) -> dict:
         """Get all columns for the target table
 
         Returns an ordered list of the column resources for the given table.
         The list is ordered as the columns are displayed.
+        The result is shared by later calls (until it expires or the table is modified), so it
+        should not be modified.
         """
+        return self.metadata.get('columns', tableId, lambda: self._list_columns(tableId))
+
+
+    def get_column_converters(self, tableId: str) -> dict:
+        '''Get the str, int, or float coercion for each column of the target table.
+
+    Uses the FusionTable's type and formatPattern for each column. The result is shared by later calls.
+
+    @params:
+        tableId: str, the target FusionTable's id.
+
+    @return: dict, the conversion function for each column name (and for 'rowid').
+        '''
+        def _build_converters():
+            converters = {'rowid': str}
+            for column in self.get_all_columns(tableId)['columns']:
+                col_type = column['type'] # NUMBER or STRING (in future, maybe DATETIME)
+                if col_type == 'NUMBER':
+                    converter = _blank_as_none(get_as_int if column.get('formatPattern') == 'NUMBER_INTEGER' else float)
+                else:
+                    converter = str
+                assert column['name'] not in converters # column name must be unique
+                converters[column['name']] = converter
+            return converters
+
+        return self.metadata.get('converters', tableId, _build_converters)
+
+
+    def _list_columns(self, tableId: str) -> dict:
+        """Request all column resources of the target table (see get_all_columns)"""
         columns = {'columns': [], 'total': 0, 'tableId': tableId}
         kwargs = {'tableId': tableId,
-                  'fields': 'nextPageToken,totalItems,items(name,type,columnId,description)'}
+                  'fields': 'nextPageToken,totalItems,items(name,type,formatPattern,columnId,description)'}
         request = self.column.list(**kwargs)
         while request is not None:
-            response = request.execute(num_retries=1)
+            response = self.execute(request)
             if 'totalItems' in response:
                 columns['total'] = response['totalItems']
             columns['columns'].extend(response.get('items', []))
@@ -429,27 +1514,23 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
         return []
 
 
-    def get_records_by_rowid(self, rowids: list, tableId: str) -> list:
+    def get_records_by_rowid(self, rowids: list, tableId: str, workers: int = MAX_PARALLEL_REQUESTS) -> list:
         '''Download the specified rows from the specified table
 
     Returns a list of lists (i.e. 2D array) corresponding to the full records (SELECT * FROM ...)
-    associated with the requested rowids in the specified table.
+    associated with the requested rowids in the specified table. The rowids are packed into as few
+    "ROWID IN (...)" queries as MAX_GET_QUERY_LENGTH allows, and the queries are performed by a
+    bounded pool of threads. Each query is retried individually (see RetryPolicy).
 
     @params:
-        rowids: list[str], the ids of rows to acquire.
+        rowids: list[str], the ids of rows to acquire. The list is not modified.
         tableId: str, the table to download rows from.
+        workers: int, the maximum number of queries to have in flight at once.
 
-    @return: list, the full contents of the indicated rows
+    @return: list, the full contents of the indicated rows, in the order of the given rowids' queries.
         '''
-        if not (rowids and isinstance(rowids, list)):
-            raise TypeError('Expected list of rowids.')
-        if not isinstance(tableId, str):
-            raise TypeError('Expected string table ID.')
-        elif len(tableId) != 41:
-            raise ValueError('Received invalid table ID.')
+        self._check_rowid_request(rowids, tableId)
 
-        data = {'rows': [], 'requested_row_count': len(rowids),
-                'queries': {}, 'to_retry': [], 'total errors': 0}
         # Each row is roughly the same size, depending on the name of the member and
         # the length of their UID. Assumption: UTF-8 (~2B per char), all numbers as char
         # String columns:               Numeric columns
@@ -457,144 +1538,332 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
         #     Squirrel/name: 16 - 30 char   Crown/Ranks: 4 char, 4 max
         # = 91 to 131 characters to be retrieved per row means <<< 1kB per row to transfer.
         # Thus rowid transfer does not require guarding against the 10 MB GET ceiling.
-
-        # Since we use a "delete & replace" maintenance method, the rowids will never be so
-        # different in length that implementing a max-packing algorithm is worthwhile.
-        sql = {'assembly': '{select} {from} {where_start}{where_values}{where_end}',
-               'select': 'SELECT *',
-               'from': 'FROM ' + tableId,
-               'where_start': 'WHERE ROWID IN (',
-               'where_values': '',
-               'where_end': ')'}
-
-        # Cache the length of the static portion of the query.
-        margin = self.remaining_query_length(sql['assembly'].format_map(sql))
-        # Cache progress parameters
-        progress_parameters = {'total': data['requested_row_count'],
-                               'prefix': 'Record retrieval: ',
-                               'length': 50}
-
-        # Row Collection callback.
-        # TODO: alter this? BatchHttpRequests don't seem to work nicely, giving winerr 10053.
-        def collect_rows(rq_id: str, response: dict, exception: HttpError):
-            """Batch HTTP Callback
-            Adds response rows to the output collection and reports completion progress.
-            """
-            nonlocal data
-            if exception is not None or 'columns' not in response:
-                data['total errors'] += 1
-                data['to_retry'].append(rq_id)
-            elif len(data.setdefault('columns', response['columns'])) == len(response['columns']):
-                try:
-                    data['rows'].extend(response['rows'])
-                except KeyError:
-                    pass
-            else:
-                print(f'Incorrect column count in response for requestId {rq_id}')
-                print(response)
-            print_progress_bar(len(data['rows']), **progress_parameters)
-
-        # Use request_ids of max length 25 char, and map to the real values of the 'where_str'
-        # Used if retrying queries made from batch requests.
-        request_map = {}
-
-        data['timing'] = time.perf_counter()
+        queries = self.get_rowid_queries(tableId, rowids)
+        progress_parameters = {'total': len(rowids), 'prefix': 'Record retrieval: ', 'length': 50}
+        results = [None] * len(queries)
+        received = 0
+        start = time.perf_counter()
         print_progress_bar(0, **progress_parameters)
-        while rowids:
-            queried_rowids = []
-            where_str = ','.join(queried_rowids)
-            while rowids and len(where_str) < margin:
-                queried_rowids.append(rowids.pop())
-                where_str = ','.join(queried_rowids)
-            sql['where_values'] = where_str
-            # if not doing batch query, do not need to save queries.
-            data['queries'][where_str] = sql['assembly'].format_map(sql)
-            rq_id = where_str[0:25]
-            assert rq_id not in request_map
-            request_map[rq_id] = data['queries'][where_str]
-            collect_rows(rq_id, self.query.sqlGet(sql=data['queries'][where_str]).execute(), None) # redo this
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(self._get_rowid_chunk, query): i
+                       for i, query in enumerate(queries)}
+            try:
+                for future in as_completed(futures):
+                    response = future.result()
+                    results[futures[future]] = response
+                    received += len(response.get('rows', []))
+                    print_progress_bar(received, **progress_parameters)
+            finally:
+                for future in futures:
+                    future.cancel()
 
         print()
-        print('\tDid {} queries in {} sec to retrieve {requested_row_count} records:'
-              .format(len(data['queries']), time.perf_counter() - data['timing'], **data))
-
-        # Retry failed requests ad nauseum.
-        while data['to_retry']:
-            print(f'\n\tRetrying {len(data["to_retry"])} failed requests')
-            row_repeats = self.new_batch_http_request(callback=collect_rows)
-            for rq_id in data['to_retry']:
-                row_repeats.add(self.query.sqlGet(sql=request_map[rq_id]), request_id=rq_id)
-            data['to_retry'] = []
-            row_repeats.execute()
-
-        if len(data['rows']) != data['requested_row_count']:
-            raise ValueError('Obtained different number of records than specified')
-        #data['timing'] = time.perf_counter() - data['timing']
-        #print('\tRetrieved {requested_row_count} records in {timing} sec.'.format_map(data))
-        # TODO: dictwriter to save all the data generated?
-        return data['rows']
+        print('\tDid {} queries in {:.1f} sec to retrieve {} records'.format(
+            len(queries), time.perf_counter() - start, len(rowids)))
+        return self._combine_rowid_responses(results, rowids)
+
+
+    def _get_rowid_chunk(self, query: str) -> dict:
+        """Perform one query of get_records_by_rowid (e.g. from a worker thread)"""
+        return self.execute(self.query.sqlGet(sql=query))
+
+
+    @classmethod
+    def get_keyset_column(cls, query: str) -> str:
+        '''Determine the column by which the given query's result can be paged without OFFSET.
+
+    A query can be paged by key if it is ORDERed BY a single, ascending, numeric column (one of
+    KEYSET_COLUMNS) that is included in its result, and does not group its rows.
+
+    @params:
+        query: str, the SQL SELECT statement.
+
+    @return: str, the name of the key column as written in the query, or an empty string.
+        '''
+        match = re.match(r'\s*select\s+(.+?)\s+from\s.+?\sorder\s+by\s+(\w+)(\s+asc)?\s*$',
+                         query, re.IGNORECASE | re.DOTALL)
+        if not match or re.search(r'\b(group\s+by|offset|limit)\b', query, re.IGNORECASE):
+            return ''
+        key = match.group(2)
+        if key.lower() not in cls.KEYSET_COLUMNS:
+            return ''
+        selected = [x.strip().strip("'").lower() for x in match.group(1).split(',')]
+        if key.lower() in selected or selected == ['*']:
+            return key
+        return ''
+
+
+    def _get_page(self, query: str, offset: int, limit: int, http=None) -> dict:
+        '''Request a single OFFSET / LIMIT page of a query's result.
+
+    Retryable errors are retried (see RetryPolicy). If the page is too large for a sqlGet response,
+    it is requested as two half-size pages instead, and their rows are combined.
+
+    @params:
+        query: str, the SQL GET statement, without OFFSET or LIMIT.
+        offset: int, the index of the first row of the page.
+        limit: int, the maximum number of rows in the page.
+        http: AuthorizedHttp, the transport to use (e.g. borrowed from an HttpPool), if not the service's.
+
+    @return: dict, the fusiontables#sqlresponse for the requested page.
+
+    @raises: HttpError, if the page could not be obtained.
+        '''
+        request: HttpRequest = self.query.sqlGet(sql=f'{query} OFFSET {offset} LIMIT {limit}')
+        response_size = _measure_response(request)
+        try:
+            response = self.execute(request, http=http)
+        except HttpError as err:
+            if 'Response size is larger than' in err.__str__() and limit > 1:
+                half = limit // 2
+                response = self._get_page(query, offset, half, http)
+                if len(response.get('rows', [])) == half:
+                    remainder = self._get_page(query, offset + half, limit - half, http)
+                    response.setdefault('rows', []).extend(remainder.get('rows', []))
+                return response
+            rq_as_json = json.loads(request.to_json())
+            print('Error during query:\n')
+            pprint(err)
+            pprint(rq_as_json)
+            raise
+
+        self._record_page_size(query, response_size['bytes'], len(response.get('rows', [])))
+        return response
+
+
+    def _iter_sequential_pages(self, query: str, kb_row_size: float, offset: int):
+        '''Request pages of the query one after another, each sized from the measured row size.
+
+    @yields: tuple(dict, the fusiontables#sqlresponse for the page
+                   int, the LIMIT that was requested for the page)
+        '''
+        while True:
+            limit = self.get_page_limit(query, kb_row_size)
+            yield (self._get_page(query, offset, limit), limit)
+            offset += limit
+
+
+    def _iter_keyset_pages(self, query: str, kb_row_size: float, key: str):
+        '''Request pages of the query one after another, bounding each page by the last key seen.
+    Falls back to OFFSET paging if a full page holds a single key value.
+
+    @yields: tuple(dict, the fusiontables#sqlresponse for the page
+                   int, the number of rows the page must have for more pages to follow)
+        '''
+        head, order = re.split(r'\sorder\s+by\s', query, flags=re.IGNORECASE)
+        conjunction = 'AND' if re.search(r'\bwhere\b', head, re.IGNORECASE) else 'WHERE'
+        page_query = query
+        key_index = -1
+        while True:
+            limit = self.get_page_limit(query, kb_row_size)
+            response = self._get_page(page_query, 0, limit)
+            rows = response.get('rows', [])
+            if len(rows) < limit:
+                yield (response, limit)
+                return
+
+            headers = [x.lower() for x in response.get('columns', [])]
+            if key.lower() in headers:
+                key_index = headers.index(key.lower())
+            last = rows[-1][key_index] if key_index > -1 else ''
+            kept = len(rows)
+            while kept and rows[kept - 1][key_index] == last:
+                kept -= 1
+            if not kept or not re.fullmatch(r'-?\d+(\.\d*)?([eE][-+]?\d+)?', last):
+                yield (response, limit)
+                yield from self._iter_sequential_pages(page_query, kb_row_size, limit)
+                return
+
+            del rows[kept:]
+            yield (response, kept)
+            page_query = f'{head} {conjunction} {key} >= {last} ORDER BY {order}'
+
+
+    def _iter_parallel_pages(self, query: str, kb_row_size: float, offset: int,
+                             max_rows_received, workers: int):
+        '''Request disjoint OFFSET / LIMIT windows of the query from a bounded pool of threads.
+    The pages are yielded in window order. Falls back to sequential pages if the rows cannot be counted.
+
+    @yields: tuple(dict, the fusiontables#sqlresponse for the page
+                   int, the LIMIT that was requested for the page)
+        '''
+        end = offset + max_rows_received
+        limit = self.get_page_limit(query, kb_row_size)
+        yield (self._get_page(query, offset, limit), limit)
+        offset += limit
+
+        count_result = self.get_query_result(self.get_count_query(query))
+        limit = self.get_page_limit(query, kb_row_size)
+        if not count_result.get('rows'):
+            yield from self._iter_sequential_pages(query, kb_row_size, offset)
+            return
+        end = min(int(count_result['rows'][0][0]), end)
+        if end - offset <= limit:
+            yield from self._iter_sequential_pages(query, kb_row_size, offset)
+            return
+        windows = iter(range(offset, int(end), limit))
+        pending = deque()
+
+        def _get_window(start: int) -> dict:
+            return self._get_page(query, start, limit)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                pending.extend(pool.submit(_get_window, start) for start in islice(windows, 2 * workers))
+                while pending:
+                    response = pending.popleft().result()
+                    pending.extend(pool.submit(_get_window, start) for start in islice(windows, 1))
+                    yield (response, limit)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+    def iter_query_pages(self, query: str,
+                         kb_row_size=1., offset_start=0, max_rows_received=float("inf"), parallel=1,
+                         keyset=True):
+        '''Perform an arbitrarily-large dataquery, yielding each page of the result as it arrives
+
+    At least one page (possibly with no rows) is yielded for a valid query. If the query cache is
+    enabled, an unchanged table's earlier result is read from disk instead.
+
+    @params:
+        query: str, the SQL GET statement (Show, Select, Describe) to execute.
+        kb_row_size: float, the expected size of an individual returned row, in kB. Only used
+                until the real row size of this table's responses has been measured.
+        offset_start: int, the global offset into the desired query result.
+                i.e. the value normally written after a SQL "OFFSET" descriptor.
+        max_rows_received: int, the global maximum number of records the query should return.
+                i.e. the value normally written after a SQL "LIMIT" descriptor.
+        parallel: int, the number of pages to request concurrently. If greater than 1, the query's
+                rows are counted and the pages are requested as disjoint OFFSET windows. Queries
+                whose rows cannot be counted (e.g. GROUP BY) are always paged sequentially.
+        keyset: bool, whether a sequentially-paged query may be paged by its ORDER BY column
+                instead of by OFFSET, if the query allows it (see get_keyset_column).
+
+    @yields: dict, conforming to fusiontables#sqlresponse formatting, for a single page of the
+            result. Each page has both 'columns' and 'rows' properties.
+
+    @raises: HttpError, if a page could not be obtained. Any earlier pages have already been yielded.
+        '''
+        if not isinstance(query, str):
+            raise TypeError('Complex sql recombination should be done by callee.')
+        if not self.validate_query_is_get(query):
+            print(f'Query is incompatible with sqlGet method:\n{query}')
+            return
+
+        cache_path = ''
+        table_key = self.get_row_size_key(query)
+        if self._query_cache is not None and table_key:
+            cache_path = self._query_cache.get_entry_path(table_key[0], query, offset_start, max_rows_received)
+            cached_pages = self._query_cache.read(cache_path) if cache_path else None
+            if cached_pages is not None:
+                yield from cached_pages
+                return
+
+        pages = self._iter_received_pages(query, kb_row_size, offset_start, max_rows_received,
+                                          parallel, keyset)
+        if cache_path:
+            pages = self._query_cache.write_through(cache_path, pages)
+        yield from pages
+
+
+    def _iter_received_pages(self, query: str, kb_row_size: float, offset_start: int,
+                             max_rows_received, parallel: int, keyset: bool):
+        '''Request the pages of a validated query from FusionTables (see iter_query_pages).'''
+        keyset_column = self.get_keyset_column(query) if keyset and not offset_start else ''
+        if parallel > 1 and self.get_count_query(query):
+            pages = self._iter_parallel_pages(query, kb_row_size, offset_start, max_rows_received, parallel)
+        elif keyset_column:
+            pages = self._iter_keyset_pages(query, kb_row_size, keyset_column)
+        else:
+            pages = self._iter_sequential_pages(query, kb_row_size, offset_start)
+
+        columns = []
+        received = 0
+        try:
+            for response, limit in pages:
+                columns = response.get('columns', columns)
+                rows = response.get('rows', [])
+                # Ensure that the requested maximum return count is obeyed.
+                if received + len(rows) > max_rows_received:
+                    del rows[int(max_rows_received - received):]
+                received += len(rows)
+                yield {'kind': 'fusiontables#sqlresponse', 'columns': columns, 'rows': rows}
+                if (len(rows) < limit
+                        or received >= max_rows_received):
+                    break
+        finally:
+            pages.close()
+
+
+    def iter_query_rows(self, query: str,
+                        kb_row_size=1., offset_start=0, max_rows_received=float("inf"), parallel=1,
+                        keyset=True) -> tuple:
+        '''Perform an arbitrarily-large dataquery, reporting its columns before any rows are consumed
+
+    The first page of the result is requested immediately (so any error in the query is raised
+    here), and the remaining pages are only requested as the returned row iterator is consumed.
+
+    @params:
+        (see iter_query_pages)
+
+    @return: tuple(list, the column headers of the query result (empty if the query was invalid)
+                   generator, yields each row of the query result)
+
+    @raises: HttpError, if the first page could not be obtained.
+        '''
+        pages = self.iter_query_pages(query, kb_row_size, offset_start, max_rows_received, parallel, keyset)
+        first_page = next(pages, None)
+        if first_page is None:
+            return ([], iter(()))
+
+        def _rows(page: dict):
+            while page is not None:
+                yield from page['rows']
+                page = next(pages, None)
+
+        return (first_page['columns'], _rows(first_page))
 
 
     def get_query_result(self, query: str,
-                         kb_row_size=1., offset_start=0, max_rows_received=float("inf")) -> dict:
+                         kb_row_size=1., offset_start=0, max_rows_received=float("inf"), parallel=1,
+                         keyset=True) -> dict:
         '''Perform an arbitrarily-large dataquery
 
     Perform a FusionTable query and return the fusiontables#sqlresponse object. If the response
-    is estimated to be larger than 10 MB, this will perform several requests. The query is assumed
+    is estimated to be larger than 10 MB, this will perform several requests, each sized from the
+    measured bytes per row of the previous responses. The query is assumed
     to be within appropriate length bounds (i.e. less than 8000 characters) and also appendable,
     (i.e. would not be invalidated by adding LIMIT and OFFSET to the end.
+    Callers that can process the result page-by-page should prefer iter_query_pages.
 
     @params:
         query: str, the SQL GET statement (Show, Select, Describe) to execute.
-        kb_row_size: float, the expected size of an individual returned row, in kB.
+        kb_row_size: float, the expected size of an individual returned row, in kB. Only used
+                until the real row size of this table's responses has been measured.
         offset_start: int, the global offset into the desired query result.
                 i.e. the value normally written after a SQL "OFFSET" descriptor.
         max_rows_received: int, the global maximum number of records the query should return.
                 i.e. the value normally written after a SQL "LIMIT" descriptor.
+        parallel: int, the number of pages to request concurrently (see iter_query_pages).
+        keyset: bool, whether the query may be paged by its ORDER BY column (see iter_query_pages).
 
     @return: dict, conforming to fusiontables#sqlresponse formatting, equivalent to what
-            would be returned as though only a single query were made.
+            would be returned as though only a single query were made. Empty if the query failed.
         '''
-        if not isinstance(query, str):
-            raise TypeError('Complex sql recombination should be done by callee.')
-        if not self.validate_query_is_get(query):
-            print(f'Query is incompatible with sqlGet method:\n{query}')
-            return {}
-
-        # Multi-query parameters.
-        sql = {'assembly': '{query} OFFSET {offset} LIMIT {limit}',
-               'query': query,
-               'limit': int(9.5 * 1024 / kb_row_size),
-               'offset': offset_start}
         # Eventual return value.
         query_result = {'kind': 'fusiontables#sqlresponse', 'is_complete': False}
         collected_row_data = []
-        while True:
-            request: HttpRequest = self.query.sqlGet(sql=sql['assembly'].format_map(sql))
-            try:
-                response = request.execute(num_retries=2)
-            except HttpLib2Error as err:
-                print('Transport error: ', err, '\nRetrying query.')
-            except HttpError as err:
-                rq_as_json = json.loads(request.to_json())
-                print('Error during query:\n')
-                pprint(err)
-                pprint(rq_as_json)
-                return {}
-            else:
-                sql['offset'] += sql['limit']
-                if 'columns' not in query_result and 'columns' in response:
-                    query_result['columns'] = response['columns']
-                if 'rows' not in response:
-                    break
-                collected_row_data.extend(response['rows'])
-                if (len(response['rows']) < sql['limit']
-                        or len(collected_row_data) >= max_rows_received):
-                    break
-
-        # Ensure that the requested maximum return count is obeyed.
-        while len(collected_row_data) > max_rows_received:
-            collected_row_data.pop()
+        try:
+            for page in self.iter_query_pages(query, kb_row_size, offset_start, max_rows_received,
+                                              parallel, keyset):
+                query_result['columns'] = page['columns']
+                collected_row_data.extend(page['rows'])
+        except (HttpError,) + RetryPolicy.TRANSPORT_ERRORS:
+            return {}
+        if 'columns' not in query_result:
+            return {}
 
         # Finalize the output object.
         query_result['rows'] = collected_row_data
@@ -602,6 +1871,118 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
         return query_result
 
 
+    def _open_media_stream(self, query: str):
+        '''Request the CSV (alt=media) result of the given query, without reading its body.
+
+    @params:
+        query: str, the SQL GET statement to execute.
+
+    @return: requests.Response, whose body has yet to be streamed.
+
+    @raises: HttpError (or RequestException), if the request was not successful (after any retries).
+        '''
+        request: HttpRequest = self.query.sqlGet_media(sql=query)
+        method, uri, body = request.method, request.uri, request.body
+        headers = dict(request.headers)
+        if method == 'GET' and len(uri) > 2048:
+            # Long queries must be sent in the body, as the API client itself would do.
+            parsed = urlparse(uri)
+            method, uri, body = 'POST', uri.partition('?')[0], parsed.query
+            headers['x-http-method-override'] = 'GET'
+            headers['content-type'] = 'application/x-www-form-urlencoded'
+        started = time.perf_counter()
+        attempt = 0
+        api = self.get_api_summary()
+        while True:
+            self.rate_governor.acquire(api)
+            try:
+                response = self.get_authorized_session().request(method, uri, data=body, headers=headers, stream=True)
+            except RequestException as err:
+                attempt += 1
+                delay = self.retry_policy.get_delay(err, attempt, started)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            if response.status_code < 300:
+                self.rate_governor.record_success(api)
+                self.retry_policy.record_success()
+                return response
+            content = response.content
+            response.close()
+            err = HttpError(Response({'status': response.status_code}), content, uri=uri)
+            if _is_throttled(err):
+                self.rate_governor.record_throttled(api)
+            attempt += 1
+            delay = self.retry_policy.get_delay(err, attempt, started)
+            if delay is None:
+                raise err
+            time.sleep(delay)
+
+
+    def iter_media_rows(self, query: str, typed=False, resumable=True) -> tuple:
+        '''Stream the CSV (alt=media) result of a query, parsing each row as its bytes arrive.
+    A failed stream of an ORDERed query is resumed from the next row's OFFSET.
+
+    @params:
+        query: str, the SQL GET statement (Show, Select, Describe) to execute.
+        typed: bool, whether to convert each value according to its FusionTable column's type
+                (see get_column_converters). Otherwise, every value is a str.
+        resumable: bool, whether a failed stream of an ORDERed query may be resumed by OFFSET. Pass
+                False if the order is not unique, as the resumed rows could then differ.
+
+    @return: tuple(list, the column headers of the query result
+                   generator, yields each row of the query result)
+
+    @raises: HttpError (or RequestException), if the query could not be performed. The row
+            generator raises RequestException if the stream failed and could not be resumed.
+        '''
+        if not isinstance(query, str):
+            raise TypeError('Complex sql recombination should be done by callee.')
+        if not self.validate_query_is_get(query):
+            print(f'Query is incompatible with sqlGet method:\n{query}')
+            return ([], iter(()))
+
+        def _open(sql: str) -> tuple:
+            response = self._open_media_stream(sql)
+            return response, csv.reader(_iter_text_lines(response.iter_content(self.MEDIA_CHUNK_BYTES)), strict=True)
+
+        response, reader = _open(query)
+        columns = next(reader, [])
+        converters = None
+        table_key = self.get_row_size_key(query)
+        if typed and table_key:
+            known = self.get_column_converters(table_key[0])
+            converters = [known.get(name, str) for name in columns]
+        is_resumable = (resumable and re.search(r'\border\s+by\b', query, flags=re.IGNORECASE) is not None
+                        and re.search(r'\b(limit|offset)\b', query, flags=re.IGNORECASE) is None)
+
+        def _rows():
+            nonlocal response, reader
+            received = 0
+            started = time.perf_counter()
+            attempt = 0
+            while True:
+                try:
+                    with response:
+                        for row in reader:
+                            yield row if converters is None else [convert(value) for convert, value in zip(converters, row)]
+                            received += 1
+                    return
+                except RequestException as err:
+                    attempt += 1
+                    delay = self.retry_policy.get_delay(err, attempt, started) if is_resumable else None
+                    if delay is None:
+                        raise
+                    print(f'Query result stream failed after {received:,} rows ({err!r}). Resuming...')
+                    time.sleep(delay)
+                    response, reader = _open(f'{query} OFFSET {received}')
+                    # Skip the header row.
+                    next(reader, None)
+
+        return (columns, _rows())
+
+
     # Non-destructive tasks
     def set_user_table(self, tableId: str):
         """Set the table id that corresponds to the MHCC Members FusionTable"""
@@ -627,63 +2008,76 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
                   'fields': 'tableId,name,description'}
         #backup = self._service.table().copy(**kwargs).execute()
         try:
-            backup = self.table.copy(**kwargs).execute()
+            # A retried copy could leave a duplicate backup behind.
+            backup = self.execute(self.table.copy(**kwargs), idempotent=False)
         except HttpError as err:
             print('Backup operation failed due to error:\n', err)
             return {}
 
         # Rename the copied table, and provide a better description.
-        assert backup['name'].find('Copy of ') > -1, 'Name does not have "Copy of " in it: \'{}\''.format(backup['name'])
-        now = datetime.datetime.utcnow()
-        backup['name'] = '_'.join(backup['name'][(backup['name'].find('Copy of ') + len('Copy of ')):].split())
-        backup['name'] = '{}_AsOf_{}-{!s:0>2}-{!s:0>2} {!s:0>2}:{!s:0>2}'.format(
-            backup['name'], now.year, now.month, now.day, now.hour, now.minute)
-        backup['description'] = 'Automatically generated backup of tableId=' + tableId
+        copy = dict(backup)
+        self.describe_backup(backup, tableId)
         kwargs = {'tableId': backup['tableId'],
                   'body': backup,
                   'fields': 'tableId,name,description'}
-        self.table.patch(**kwargs).execute()
+        try:
+            self.execute(self.table.patch(**kwargs))
+        except HttpError as err:
+            # The copy is still a complete backup, so it is kept (and logged) under its original name.
+            print(f'Unable to rename backup {backup["tableId"]}:', err)
+            backup = copy
         # Log this new table to disk.
-        with open('tables.txt', 'a', newline='') as f:
-            csv.writer(f, quoting=csv.QUOTE_ALL).writerows([[backup['name'], backup['tableId']]])
+        self._log_backup(backup)
 
         if await_clone:
             # Pause all activities while the backup is cloning
-            while True:
-                tasks = self.get_tasks(backup['tableId'])
-                if tasks:
-                    print(tasks[0]['type'], tasks[0]['progress'])
-                    time.sleep(5)
-                else:
-                    break
+            self._await_tasks(backup['tableId'])
         print(f'Backup of table \'{tableId}\' completed; new table logged to disk.')
         return backup
 
 
     # Methods that delete things!
     def restore_table(self, backupId: str, destination: str):
-        """Replaces all rows in the destination with those from the backup"""
+        """Replaces all rows in the destination with those from the backup
 
-        data = self.get_query_result("SELECT * FROM " + backupId)
-        if not data or data['is_complete'] is False:
-            print('Data acquisition failed.')
-            return False
+    The backup's rows are streamed (as CSV media) to a local staging file, and the staging file is
+    then uploaded, so the backup is never held in memory all at once.
+        """
+        filename = self.get_filename_for_table(destination, 'restore')
+        try:
+            try:
+                columns, rows = self.iter_media_rows("SELECT * FROM " + backupId)
+            except HttpError as err:
+                print('Unable to stream backup data as media, paging through it instead:', err)
+                columns, rows = self.iter_query_rows("SELECT * FROM " + backupId,
+                                                     parallel=self.MAX_PARALLEL_REQUESTS)
+            if not columns:
+                print('Data acquisition failed.')
+                return False
 
-        assert self.count_rows(backupId) == len(data['rows'])
-        indices = {value.__str__().lower(): i for i, value in enumerate(data['columns'])}
-        # Reparse to ensure UIDs are valid.
-        if 'uid' in indices:
+            indices = {value.__str__().lower(): i for i, value in enumerate(columns)}
+            uid_index = indices.get('uid')
+            # Reparse to ensure UIDs are valid.
             coerced = set()
-            for row in data['rows']:
-                if '.' in row[indices['uid']]:
-                    coerced.add(row[indices['uid']])
-                    row[indices['uid']] = row[indices['uid']].partition('.')[0]
-            if coerced:
-                print(f'Updated {len(coerced)} member names to remove \'.0\'')
+            row_count = 0
+            with open(filename, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f, strict=True, quoting=csv.QUOTE_NONNUMERIC)
+                for row in rows:
+                    if uid_index is not None and '.' in row[uid_index]:
+                        coerced.add(row[uid_index])
+                        row[uid_index] = row[uid_index].partition('.')[0]
+                    writer.writerow(row)
+                    row_count += 1
+        except HttpError:
+            print('Data acquisition failed.')
+            return False
+        if coerced:
+            print(f'Updated {len(coerced)} member names to remove \'.0\'')
 
+        assert self.count_rows(backupId, cached=False) == row_count
         # Upload
         print(f'Beginning row replacement of target \'{destination}\' from \'{backupId}\'')
-        return self.replace_rows(destination, data['rows'])
+        return self.replace_rows_from_file(destination, filename)
 
     def verify_known_tables(self, known_tables: dict, drive_service):
         '''Check declared tables for validity and desirability
@@ -728,10 +2122,11 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
             # Obtain the file as known to Drive.
             kwargs['fileId'] = id
             batch_get_requests.add(drive_service.files().get(**kwargs))
-        batch_get_requests.execute()
+        # Retrying a batch would run its callbacks (and so queue the deletions) again.
+        self.execute(batch_get_requests, idempotent=False)
 
         # Delete any of the user's trashed FusionTables.
-        batch_delete_requests.execute()
+        self.execute(batch_delete_requests, idempotent=False)
         if validated_tables and len(validated_tables.items()) < len(known_tables.items()):
             # Rewrite the tables.txt file as CSV.
             print('Rewriting list of known tables (invalid tables have been removed).')
@@ -753,19 +2148,14 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
         '''
         kwargs = {'sql': "DELETE FROM " + tableId}
         try:
-            response = self.query.sql(**kwargs).execute()
-        except (HttpLib2Error | HttpError) as err:
+            response = self.execute(self.query.sql(**kwargs))
+        except (HttpLib2Error, HttpError) as err:
             print('Error during table deletion:', err)
-            print(kwargs, response)
+            print(kwargs)
             return False
 
-        while True:
-            tasks = self.get_tasks(tableId)
-            if tasks:
-                print(tasks[0]['type'], tasks[0]['progress'])
-                time.sleep(2)
-            else:
-                break
+        self._await_tasks(tableId)
+        self._on_table_modified(tableId)
         print("Deleted rows:", response['rows'][0][0])
         return True
 
@@ -777,126 +2167,593 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
         if not tableId or not clause:
             print('Missing args "tableId" and/or "clause"')
         method =  self.query.sqlGet if dryRun else self.query.sql
-        return method(sql=raw_sql).execute()
+        response = self.execute(method(sql=raw_sql))
+        if not dryRun:
+            self._on_table_modified(tableId)
+        return response
 
 
-    def delete_records_by_rowid(self, tableId: str, rowids: list):
+    def delete_records_by_rowid(self, tableId: str, rowids: list, workers: int = MAX_PARALLEL_REQUESTS,
+                                checkpoint: str = '') -> int:
         '''Delete the given records from the given FusionTable. Does not back up the table
-        first. Does not require all input rowids to be present in the target table.
+        first. Does not require all input rowids to be present in the target table. Statements that
+        fail are written to a checkpoint file, which resume_deletes can finish later.
 
     @params:
         tableId: str, the ID of the FusionTable which should have select rows deleted.
-        rowids: list, the rowids identifying data to remove.
+        rowids: list, the rowids identifying data to remove. The list is not modified.
+        workers: int, the maximum number of DELETE statements to have in flight at once.
+        checkpoint: str, the file in which to save failed statements. Defaults to a unique name
+                based on the target table, in the local directory.
 
     @return: int, the number of deleted rows.
         '''
-        raw_sql = 'DELETE FROM ' + tableId + ' WHERE ROWID IN ({})'
-        max_query_length = self.MAX_DELETE_QUERY_LENGTH - 2 * max(len(str(x)) for x in rowids)
-        deleted = 0
-        while rowids:
-            query_ids = [rowids.pop()]
-            while rowids and len(raw_sql.format(','.join(query_ids))) < max_query_length:
-                query_ids.append(rowids.pop())
-            query = raw_sql.format(','.join(query_ids))
-            assert len(query) <= self.MAX_DELETE_QUERY_LENGTH, f'Query too long ({len(query)} chars).'
+        queries = self.get_rowid_queries(tableId, rowids, delete=True)
+        return self._run_deletes(tableId, queries, workers,
+                                 checkpoint or self.get_delete_checkpoint_filename(tableId))
+
+
+    @staticmethod
+    def get_delete_checkpoint_filename(tableId: str) -> str:
+        """Returns the name of the file in which failed DELETE statements for the table are saved"""
+        return f'table_{tableId}_deletes.json'
 
-            response = self.query.sql(sql=query).execute(num_retries=2)
-            deleted += int(response['rows'][0][0])
-            time.sleep(1)
 
+    def resume_deletes(self, checkpoint: str, workers: int = MAX_PARALLEL_REQUESTS) -> int:
+        '''Resend the DELETE statements that were saved to the given checkpoint file by an earlier run.
+
+    @params:
+        checkpoint: str, the checkpoint file written by delete_records_by_rowid.
+        workers: int, the maximum number of DELETE statements to have in flight at once.
+
+    @return: int, the number of deleted rows.
+        '''
+        try:
+            with open(checkpoint, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as err:
+            print(f'Unable to read checkpoint "{checkpoint}":', err)
+            return 0
+        # The checkpoint is only replaced once the statements that still remain have been recorded.
+        return self._run_deletes(saved['tableId'], saved['queries'], workers, checkpoint, resuming=True)
+
+
+    @staticmethod
+    def save_delete_checkpoint(checkpoint: str, tableId: str, queries: list, resuming=False):
+        '''Record the DELETE statements that remain to be sent in the checkpoint file.
+
+    The new state is written beside the checkpoint and then moved into place, so an interruption
+    never leaves the checkpoint partially written (or removed).
+
+    @params:
+        checkpoint: str, the checkpoint file.
+        tableId: str, the table the statements delete from.
+        queries: list, the statements which are not known to have been applied.
+        resuming: bool, whether the statements are those remaining from the checkpoint's own
+                statements (see resume_deletes), which they then replace. Otherwise, the statements
+                are added to any which an earlier run left in the checkpoint.
+        '''
+        if not resuming and os.path.exists(checkpoint):
+            try:
+                with open(checkpoint, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                if saved['tableId'] == tableId:
+                    queries = saved['queries'] + [x for x in queries if x not in set(saved['queries'])]
+            except (OSError, ValueError, KeyError) as err:
+                print(f'Unable to read the earlier checkpoint "{checkpoint}", so it will be replaced:', err)
+        if not queries:
+            if resuming and os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            return
+        partial = checkpoint + '.partial'
+        with open(partial, 'w', encoding='utf-8') as f:
+            json.dump({'tableId': tableId, 'queries': queries}, f)
+        os.replace(partial, checkpoint)
+
+
+    def _run_deletes(self, tableId: str, queries: list, workers: int, checkpoint: str, resuming=False) -> int:
+        '''Send the given DELETE statements from a bounded pool of threads, and checkpoint any that are not applied.
+
+    The checkpoint is written even if the run is interrupted (e.g. by KeyboardInterrupt), and lists
+    every statement that did not succeed, including those that were still queued or in flight.
+        '''
+        if not queries:
+            if resuming:
+                self.save_delete_checkpoint(checkpoint, tableId, [], resuming)
+            return 0
+        progress_parameters = {'total': len(queries), 'prefix': 'Deleting: ', 'length': 50}
+        deleted = 0
+        done = 0
+        applied = set()
+        print_progress_bar(0, **progress_parameters)
+        self._on_table_modified(tableId)
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                futures = {pool.submit(self._delete_rowid_chunk, query): i
+                           for i, query in enumerate(queries)}
+                try:
+                    for future in as_completed(futures):
+                        done += 1
+                        try:
+                            deleted += future.result()
+                            applied.add(futures[future])
+                        except (HttpError,) + RetryPolicy.TRANSPORT_ERRORS as err:
+                            print('\nDelete failed:', err)
+                        print_progress_bar(done, **progress_parameters, suffix=f'({deleted:,} rows)')
+                finally:
+                    for future in futures:
+                        future.cancel()
+        finally:
+            self._on_table_modified(tableId)
+            # Deleting by ROWID is idempotent, so any statement not known to be applied can safely be resent.
+            failed = [query for i, query in enumerate(queries) if i not in applied]
+            self.save_delete_checkpoint(checkpoint, tableId, failed, resuming)
+
+        if failed:
+            print(f'{len(failed)} DELETE statements failed. Resume them with resume_deletes("{checkpoint}")')
         return deleted
 
 
-    def replace_rows(self, tableId: str, new_row_data: list, filename='') -> int:
+    def _delete_rowid_chunk(self, query: str) -> int:
+        '''Send a single DELETE statement (e.g. from a worker thread), retrying it as the retry policy allows.
+
+    @return: int, the number of rows the statement deleted.
+
+    @raises: HttpError, if the statement could not be performed.
+        '''
+        response = self.execute(self.query.sql(sql=query))
+        return int(response['rows'][0][0])
+
+
+    def plan_row_removal(self, tableId: str, kept_rowids, dropped_rowids, table_size: int = 0) -> dict:
+        '''Estimate the cost of removing rows from a table by DELETE statements, and by replaceRows.
+
+    Deleting sends the dropped rowids in DELETE statements, which the server applies slowly. Replacing
+    downloads the kept rows (first scanning the table's ROWIDs, if the kept rowids are not known) and
+    uploads them with replaceRows. For each strategy, the number of API calls, the bytes transferred
+    and the wall time are estimated from REMOVAL_COSTS and the table's measured row size.
+
+    @params:
+        tableId: str, the FusionTable from which rows will be removed.
+        kept_rowids: collection, the rowids that will remain in the table, or None if not known
+                (in which case every row not being dropped is kept).
+        dropped_rowids: collection, the rowids that will be removed.
+        table_size: int, the number of rows in the table. Counted if not given.
+
+    @return: dict, the estimates ('calls', 'bytes', 'seconds') for each strategy in 'strategies', and
+            the cheaper strategy as 'strategy'. Deletion is only offered if, like replaceRows, it
+            would remove every row that is not kept.
+        '''
+        costs = self.REMOVAL_COSTS
+        table_size = table_size or self.count_rows(tableId, cached=False)
+        n_dropped = len(dropped_rowids)
+        n_kept = table_size - n_dropped if kept_rowids is None else len(kept_rowids)
+        row_bytes = self.get_row_bytes(tableId)
+        workers = self.MAX_PARALLEL_REQUESTS
+        plan = {'tableId': tableId, 'table_size': table_size, 'kept': n_kept, 'dropped': n_dropped,
+                'strategies': {}}
+
+        def _estimate(calls: int, sent: int, received: int, server_seconds: float, parallel=1) -> dict:
+            seconds = (calls * costs['seconds_per_request'] + server_seconds) / parallel
+            seconds += (sent + received) / costs['bytes_per_second']
+            return {'calls': calls, 'bytes': sent + received, 'seconds': seconds}
+
+        if n_kept + n_dropped == table_size:
+            deletes = [len(query) for query in self.get_rowid_queries(tableId, dropped_rowids, delete=True)]
+            plan['strategies']['delete'] = _estimate(
+                len(deletes), sum(deletes), 0, n_dropped * costs['seconds_per_deleted_row'], workers)
+
+        rowid_bytes = 1 + (sum(len(str(x)) for x in dropped_rowids) / n_dropped if n_dropped else 8)
+        scan = None
+        if kept_rowids is None:
+            scan = _estimate(1, 0, int(table_size * rowid_bytes), 0)
+        gets = max(1, int(n_kept * rowid_bytes / (self.MAX_GET_QUERY_LENGTH - 60)) + 1)
+        download = _estimate(gets, int(n_kept * rowid_bytes), n_kept * row_bytes, 0, workers)
+        upload = _estimate(1 + int(n_kept * row_bytes / UPLOAD_CHUNK_BYTES), n_kept * row_bytes, 0,
+                           n_kept * costs['seconds_per_imported_row'])
+        plan['strategies']['replace'] = {key: sum(x[key] for x in (scan, download, upload) if x)
+                                         for key in ('calls', 'bytes', 'seconds')}
+        plan['strategy'] = min(plan['strategies'], key=lambda x: plan['strategies'][x]['seconds'])
+        return plan
+
+
+    @staticmethod
+    def print_removal_plan(plan: dict):
+        """Print the estimates made by plan_row_removal, e.g. for a dry run"""
+        print('Removing {dropped:,} of {table_size:,} rows from {tableId} ({kept:,} kept):'.format_map(plan))
+        for name, estimate in plan['strategies'].items():
+            print('\t{}{:>8}: {:,} calls, {:,.1f} MB, {:,.1f} min'.format(
+                '*' if name == plan['strategy'] else ' ', name, estimate['calls'],
+                estimate['bytes'] / 1024 / 1024, estimate['seconds'] / 60))
+
+
+    def get_row_bytes(self, tableId: str) -> float:
+        '''Get the average size of a full (SELECT *) row of the table, as measured from query responses.'''
+        measured = self._row_sizes.get((tableId, '*'))
+        if measured and measured[1]:
+            return measured[0] / measured[1]
+        return self.REMOVAL_COSTS['bytes_per_row']
+
+
+    def remove_rows(self, tableId: str, kept_rowids, dropped_rowids, table_size: int = 0,
+                    kept_rows: list = None, dryRun=False) -> dict:
+        '''Remove rows from the table by DELETE statements or replaceRows, whichever is estimated
+        to be cheaper (see plan_row_removal). Does not back up the table first, and does not
+        replace the table if its row count changed.
+
+    @params:
+        tableId: str, the FusionTable from which rows will be removed.
+        kept_rowids: collection, the rowids that will remain in the table, or None if not known.
+        dropped_rowids: collection, the rowids that will be removed.
+        table_size: int, the number of rows in the table. Counted if not given.
+        kept_rows: list, the full (SELECT *) contents of the kept rows, if they are already available.
+        dryRun: bool, whether to only report the estimates, and not remove any rows.
+
+    @return: dict, the plan that was followed. If rows were removed, 'removed' is the number of rows
+            deleted, or 'rows' is the number of rows the table was replaced with. If the replacement
+            was abandoned because the table changed, 'aborted' is set.
+        '''
+        plan = self.plan_row_removal(tableId, kept_rowids, dropped_rowids, table_size)
+        self.print_removal_plan(plan)
+        if dryRun:
+            return plan
+
+        if plan['strategy'] == 'delete':
+            plan['removed'] = self.delete_records_by_rowid(tableId, list(dropped_rowids))
+            return plan
+
+        if kept_rows is None:
+            if kept_rowids is None:
+                dropped = set(str(x) for x in dropped_rowids)
+                _, rows = self.iter_media_rows(f'SELECT ROWID FROM {tableId}')
+                kept_rowids = [row[0] for row in rows if row[0] not in dropped]
+            kept_rows = self.get_records_by_rowid(list(kept_rowids), tableId)
+        if len(kept_rows) != plan['kept']:
+            print(f'Expected {plan["kept"]:,} rows to keep, but have {len(kept_rows):,}. Not replacing {tableId}.')
+            plan['aborted'] = True
+            return plan
+        current_size = self.count_rows(tableId, cached=False)
+        if current_size != plan['table_size']:
+            print(f'Table {tableId} now has {current_size:,} rows rather than {plan["table_size"]:,}, '
+                  'so replacing it could lose rows. Not replacing it.')
+            plan['aborted'] = True
+            return plan
+        plan['rows'] = self.replace_rows(tableId, kept_rows)
+        return plan
+
+
+    def replace_rows(self, tableId: str, new_row_data, filename='') -> int:
         '''Upload the new data to the target table
 
     Performs a FusionTables.tables().replaceRows() call to the input table, replacing its contents
-    with the input rows. Does not attempt to back up the table for you.
+    with the input rows. Does not attempt to back up the table for you. An interrupted upload can be
+    continued with resume_upload.
 
     @params:
         tableId: str, the FusionTable to update (String)
-        new_row_data: list, the values to overwrite the FusionTable with (list of lists)
-        filename: str, the name of a file to which the uploaded data should first be serialized.
-                Defaults to a unique name based on the target table, in the local directory.
+        new_row_data: iterable, the values to overwrite the FusionTable with (e.g. a list of lists)
+        filename: str, the name of a file to which the uploaded data should also be serialized.
+                If not given, a temporary file is used.
 
     @return: int, the number of rows that comprise the table contents.
         '''
         if not tableId or not new_row_data:
             return False
-        if not filename:
-            filename = self.get_filename_for_table(tableId, 'replaceRows')
-        # Create a resumable MediaFileUpload with the "interesting" data to retain.
-        sep = ','
-        upload = _make_media_file(new_row_data, filename, True, sep)
-        kwargs = {'tableId': tableId,
-                  'media_body': upload,
-                  'media_mime_type': 'application/octet-stream',
-                  'encoding': 'UTF-8',
-                  'delimiter': sep}
-        # Try the upload twice (which requires creating a new request).
-        result, resp = None, None
-        if upload and upload.resumable():
-            try:
-                result, resp = _step_upload(self.table.replaceRows(**kwargs))
-                if not result:
-                    result, resp = _step_upload(self.table.replaceRows(**kwargs))
-            except HttpError as err:
-                if (err.resp.status in [417]
-                        and 'Table will exceed allowed maximum size' in err.__str__()):
-                    # The goal is to replace the table's rows, so every existing row will be deleted
-                    # anyway. If the table's current data is too large, such that old + new >= 250,
-                    # then Error 417 is returned.  Handle this by explicitly deleting the rows first.
-                    if self.delete_all_rows(tableId):
-                        result, resp = _step_upload(self.table.importRows(**kwargs))
-                    else:
-                        raise InterruptedError('Unable to delete target table via API calls.')
-                else:
-                    raise err
+        fallback = None
+        payload_bytes = None
+        if iter(new_row_data) is not new_row_data:
+            fallback = lambda: sum(self.import_row_shards(tableId, new_row_data))
+            payload_bytes = _get_csv_bytes(new_row_data)
+        spool = '' if filename else self.get_filename_for_table(tableId, '_upload')
+        try:
+            return self._send_upload(tableId, self._get_row_media(new_row_data, filename or spool),
+                                     replace=True, fallback=fallback, payload_bytes=payload_bytes)
+        finally:
+            if (spool and os.path.exists(spool)
+                    and not os.path.exists(self.get_upload_session_filename(tableId))):
+                os.remove(spool)
 
-        elif upload:
-            result, resp = _send_whole_upload(self.table.replaceRows(**kwargs))
-            if not result:
-                result, resp = _send_whole_upload(self.table.replaceRows(**kwargs))
-        return int(resp['numRowsReceived']) if result else 0
 
+    def replace_rows_from_file(self, tableId: str, filename: str, delimiter=',') -> int:
+        '''Upload the contents of a local CSV file to the target table
+
+    Performs a FusionTables.tables().replaceRows() call to the input table, replacing its contents
+    with the rows in the given file. Does not attempt to back up the table for you. If the process
+    is interrupted during the upload, it can be continued with resume_upload.
+
+    @params:
+        tableId: str, the FusionTable to update (String)
+        filename: str, the name of a local CSV file (e.g. as written by _write_as_csv).
+        delimiter: str, the CSV delimiter that was used to write the file.
+
+    @return: int, the number of rows that comprise the table contents.
+        '''
+        if not tableId or not filename:
+            return False
+        return self._send_upload(
+            tableId, lambda: MediaFileUpload(filename, mimetype='application/octet-stream',
+                                             chunksize=UPLOAD_CHUNK_BYTES, resumable=True),
+            replace=True, delimiter=delimiter, payload_bytes=os.path.getsize(filename))
 
-    def import_rows(self, tableId: str, new_row_data: list, filename='') -> int:
+
+    def import_rows(self, tableId: str, new_row_data, filename='') -> int:
         '''Upload the new data into the target table
 
-    Performs a FusionTables.tables().importRows() call to the input table, adding the input rows.
-    Does not attempt to back up the table for you.
+    Performs FusionTables.tables().importRows() calls to the input table, adding the input rows.
+    Does not attempt to back up the table for you. Large row sets are split into several uploads
+    (see import_row_shards).
 
     @params:
         tableId: str, the FusionTable to update (String)
-        new_row_data: list, the values to overwrite the FusionTable with (list of lists)
-        filename: str, the name of a file to which the uploaded data should first be serialized.
-                Defaults to a unique name based on the target table, in the local directory.
+        new_row_data: iterable, the values to add to the FusionTable (e.g. a list of lists)
+        filename: str, the name of a file to which the uploaded data should also be serialized.
+                If not given, no copy of the uploaded data is written to disk.
 
     @return: int, the number of rows added to the table.
         '''
         if not tableId or not new_row_data:
             raise TypeError('Missing required function inputs')
-        if not filename:
-            filename = self.get_filename_for_table(tableId, 'importRows')
-        # Create a resumable MediaFileUpload with the "interesting" data to retain.
-        sep = ','
-        upload = _make_media_file(new_row_data, filename, True, sep)
-        kwargs = {'tableId': tableId,
-                  'media_body': upload,
-                  'media_mime_type': 'application/octet-stream',
-                  'encoding': 'UTF-8',
-                  'delimiter': sep}
+        return sum(self.import_row_shards(tableId, new_row_data, filename=filename))
+
+
+    def import_row_shards(self, tableId: str, rows, shard_bytes: int = IMPORT_SHARD_BYTES,
+                          workers: int = MAX_PARALLEL_REQUESTS, filename='') -> list:
+        '''Add the given rows to the table in size-bounded shards, several of which are uploaded at once.
+    Shards whose upload fails are retried once every shard has been attempted.
+
+    @params:
+        tableId: str, the FusionTable to which rows are added.
+        rows: iterable, the values to add to the FusionTable (e.g. a list of lists)
+        shard_bytes: int, the maximum size of each uploaded shard.
+        workers: int, the maximum number of shards to upload concurrently.
+        filename: str, the name of a file to which the uploaded data should also be serialized.
+
+    @return: list[int], the number of rows received by the table for each shard, in order. A shard
+            that could not be uploaded received 0 rows.
+        '''
+        def _upload_shard(data: bytes) -> int:
+            media = MediaIoBaseUpload(io.BytesIO(data), mimetype='application/octet-stream',
+                                      chunksize=UPLOAD_CHUNK_BYTES, resumable=True)
+            request = self._get_upload_request('importRows', tableId, media)
+            try:
+                with self.http_pool.transport() as http:
+                    result, resp = _step_upload(request, http=http, show_progress=False)
+            except HttpError as err:
+                print(f'\nShard upload to {tableId} failed:', err)
+                return 0
+            return int(resp['numRowsReceived']) if result else 0
+
+        received = []
+        failed = {}
+        copy = open(filename, 'wb') if filename else None
+        try:
+            shards = enumerate(_iter_csv_shards(rows, shard_bytes, copy=copy))
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                pending = deque()
+
+                def _submit(count: int):
+                    for index, (data, row_count) in islice(shards, count):
+                        received.append(0)
+                        pending.append((index, data, row_count, pool.submit(_upload_shard, data)))
+
+                _submit(workers)
+                while pending:
+                    index, data, row_count, future = pending.popleft()
+                    received[index] = future.result()
+                    if received[index] != row_count:
+                        failed[index] = (data, row_count)
+                    print(f'Shard {index + 1}: {received[index]:,} of {row_count:,} rows imported')
+                    _submit(1)
+        finally:
+            if copy:
+                copy.close()
+            self._on_table_modified(tableId)
+
+        for index, (data, row_count) in failed.items():
+            if received[index]:
+                # Some rows of the shard were imported, so sending it again would duplicate them.
+                print(f'Shard {index + 1} was partially imported, and is not retried.')
+                continue
+            print(f'Retrying shard {index + 1} ({row_count:,} rows)')
+            received[index] = _upload_shard(data)
+        self._on_table_modified(tableId)
+        return received
+
+
+    @staticmethod
+    def _get_row_media(rows, filename=''):
+        '''Create a factory for the media of each attempt to upload the given rows.
+
+    The first attempt streams the rows. Later attempts use the complete disk copy of the first, if
+    there is one, or otherwise stream the rows again if they can be re-read (e.g. are a list).
+
+    @return: callable, returning the MediaUpload for the next attempt, or None if there is none.
+        '''
+        attempts = []
+
+        def _next_media():
+            if not attempts:
+                attempts.append(_RowStreamUpload(rows, path=filename))
+            elif filename and attempts[0].is_complete():
+                attempts.append(MediaFileUpload(filename, mimetype='application/octet-stream',
+                                                chunksize=UPLOAD_CHUNK_BYTES, resumable=True))
+            elif iter(rows) is not rows:
+                attempts[0].close()
+                attempts.append(_RowStreamUpload(rows))
+            else:
+                attempts[0].close()
+                print('Unable to retry upload: the rows cannot be read again.')
+                return None
+            return attempts[-1]
+        return _next_media
+
+
+    def _send_upload(self, tableId: str, get_media, replace: bool, delimiter=',', fallback=None,
+                     payload_bytes: int = None) -> int:
+        '''Perform a resumable replaceRows or importRows upload, making a second attempt if the first fails.
+
+    If replacing the table's rows would exceed the table size limit (error 417), the table's rows are
+    deleted first, and the data is then imported (by the fallback, if one is given). When the size
+    of the payload is known, this is checked before anything is uploaded (see check_replace_size).
+
+    @params:
+        tableId: str, the FusionTable to update.
+        get_media: callable, returning a new MediaUpload for each attempt (or None, if there is none).
+        replace: bool, whether to replace the table's rows (or add to them).
+        delimiter: str, the CSV delimiter of the media.
+        fallback: callable, which imports the data into the emptied table and returns the number of
+                rows it received, if the media should not be imported in a single upload.
+        payload_bytes: int, the exact size of the uploaded data, if known.
+
+    @return: int, the number of rows received by the table.
+        '''
+        def _upload(method: str) -> tuple:
+            media = get_media()
+            if media is None:
+                return (False, None)
+            session = {'path': self.get_upload_session_filename(tableId), 'tableId': tableId,
+                       'method': method, 'delimiter': delimiter}
+            with self.http_pool.transport() as http:
+                return _step_upload(self._get_upload_request(method, tableId, media, delimiter), session, http)
+
+        def _import_into_empty_table() -> int:
+            # The goal is to replace the table's rows, so every existing row will be deleted
+            # anyway. If the table's current data is too large, such that old + new >= 250,
+            # then Error 417 is returned.  Handle this by explicitly deleting the rows first.
+            if not self.delete_all_rows(tableId):
+                raise InterruptedError('Unable to delete target table via API calls.')
+            if fallback:
+                return fallback()
+            result, resp = _upload('importRows')
+            return int(resp['numRowsReceived']) if result else 0
+
+        method = 'replaceRows' if replace else 'importRows'
         # Try the upload twice (which requires creating a new request).
         result, resp = None, None
-        if upload and upload.resumable():
-            result, resp = _step_upload(self.table.importRows(**kwargs))
-            if not result:
-                result, resp = _step_upload(self.table.importRows(**kwargs))
-        elif upload:
-            result, resp = _send_whole_upload(self.table.importRows(**kwargs))
+        try:
+            if replace and payload_bytes is not None:
+                if payload_bytes > self.MAX_TABLE_BYTES:
+                    print('Upload aborted: the new data alone exceeds the table size limit.')
+                    return 0
+                if not self.check_replace_size(tableId, payload_bytes)['fits']:
+                    print('Deleting the existing rows before importing the new data.')
+                    return _import_into_empty_table()
+            result, resp = _upload(method)
             if not result:
-                result, resp = _send_whole_upload(self.table.importRows(**kwargs))
+                result, resp = _upload(method)
+        except HttpError as err:
+            if (replace and err.resp.status in [417]
+                    and 'Table will exceed allowed maximum size' in err.__str__()):
+                return _import_into_empty_table()
+            raise err
+        finally:
+            self._on_table_modified(tableId)
+        return int(resp['numRowsReceived']) if result else 0
+
+
+    def check_replace_size(self, tableId: str, payload_bytes: int) -> dict:
+        '''Determine whether replacing the table's rows with the given payload would exceed its size limit.
+
+    FusionTables count both the existing and the new data against MAX_TABLE_BYTES while rows are
+    replaced. The table's current size is estimated from its row count and the size of a sample of
+    its rows, serialized as they would be uploaded.
+
+    @params:
+        tableId: str, the FusionTable whose rows would be replaced.
+        payload_bytes: int, the exact size of the new (CSV) data.
+
+    @return: dict, the 'payload_bytes', 'table_rows', 'row_bytes' and 'table_bytes' that were used,
+            the 'limit', and whether the replacement 'fits' within it.
+        '''
+        table_rows = self.count_rows(tableId, cached=False)
+        row_bytes = self.get_csv_row_bytes(tableId) if table_rows else 0
+        sizes = {'payload_bytes': payload_bytes, 'table_rows': table_rows, 'row_bytes': row_bytes,
+                 'table_bytes': int(table_rows * row_bytes), 'limit': self.MAX_TABLE_BYTES}
+        sizes['fits'] = sizes['table_bytes'] + payload_bytes < sizes['limit']
+        print('Replacing rows of {}: {:,.1f} MB existing ({:,} rows at ~{:,.0f} B) + {:,.1f} MB new'
+              ' {} the {:,.0f} MB limit'.format(
+                  tableId, sizes['table_bytes'] / 1024 / 1024, table_rows, row_bytes,
+                  payload_bytes / 1024 / 1024, 'is within' if sizes['fits'] else 'exceeds',
+                  sizes['limit'] / 1024 / 1024))
+        return sizes
+
+
+    def get_csv_row_bytes(self, tableId: str, sample_size=500) -> float:
+        '''Estimate the average size of one of the table's rows, when serialized for upload.
+
+    @params:
+        tableId: str, the FusionTable to sample.
+        sample_size: int, the number of rows to sample.
+
+    @return: float, the average size of a sampled row, in bytes. Falls back to the measured size of
+            the table's query responses, if the sample cannot be read.
+        '''
+        def _sample():
+            try:
+                _, rows = self.iter_media_rows(f'SELECT * FROM {tableId} LIMIT {sample_size}')
+                rows = list(rows)
+            except HttpError as err:
+                print('Unable to sample table rows:', err)
+                return None
+            if not rows:
+                return None
+            return _get_csv_bytes(rows) / len(rows)
+
+        return self.metadata.get('csv_row_bytes', tableId, _sample) or self.get_row_bytes(tableId)
+
+
+    def _get_upload_request(self, method: str, tableId: str, media: MediaUpload, delimiter=',') -> HttpRequest:
+        '''Create a replaceRows or importRows request for the given CSV media.'''
+        return getattr(self.table, method)(tableId=tableId, media_body=media,
+                                           media_mime_type='application/octet-stream',
+                                           encoding='UTF-8', delimiter=delimiter)
+
+
+    @staticmethod
+    def get_upload_session_filename(tableId: str) -> str:
+        """Returns the name of the file in which the state of an upload to the table is saved"""
+        return f'table_{tableId}_upload.json'
 
+
+    def resume_upload(self, session_file: str) -> int:
+        '''Continue an interrupted upload from the last chunk the server acknowledged.
+
+    The server is first asked how much of the upload it received, and the rest of the upload's bytes
+    are then read from the source file that was recorded in the session.
+
+    @params:
+        session_file: str, the session file saved by an earlier upload (see get_upload_session_filename).
+
+    @return: int, the number of rows received by the table, or 0 if the upload could not be resumed.
+        '''
+        try:
+            with open(session_file, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as err:
+            print(f'Unable to read upload session "{session_file}":', err)
+            return 0
+        if not os.path.exists(saved['filename']):
+            print(f'Unable to resume upload: "{saved["filename"]}" no longer exists.')
+            return 0
+
+        media = MediaFileUpload(saved['filename'], mimetype='application/octet-stream',
+                                chunksize=saved['chunksize'], resumable=True)
+        request = self._get_upload_request(saved['method'], saved['tableId'], media, saved['delimiter'])
+        request.resumable_uri = saved['uri']
+        request.resumable_progress = saved['progress']
+        # Query the upload's state before sending more of it.
+        request._in_error_state = True
+        session = {key: saved[key] for key in ('tableId', 'method', 'delimiter')}
+        session['path'] = session_file
+        print(f'Resuming {saved["method"]} upload to {saved["tableId"]} from byte {saved["progress"]:,}')
+        try:
+            with self.http_pool.transport() as http:
+                result, resp = _step_upload(request, session, http)
+        finally:
+            self._on_table_modified(saved['tableId'])
+        spool = os.path.abspath(self.get_filename_for_table(saved['tableId'], '_upload'))
+        if result and saved['filename'] == spool:
+            os.remove(spool)
         return int(resp['numRowsReceived']) if result else 0
 
 
@@ -904,8 +2761,8 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
     def can_use_local_data(tableId: str, filename: str, drive_handler: DriveHandler) -> bool:
         """Check if a local file can be used to update a remote table.
 
-    If the named local file is present, compares determines
-    its modification time. This modification time is then compared to the modification time of the
+    If the named local file (or its snapshot, see get_snapshot_path) is present, determines
+    when its data was saved. This time is then compared to the modification time of the
     given FusionTable. If the FusionTable was modified more recently than the local data, then the
     records must be reacquired.
 
@@ -925,18 +2782,21 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
         elif not filename:
             raise ValueError('Received invalid filename.')
 
-        # Ensure the file exists.
+        # Ensure the data exists, and determine when it was saved.
+        saved_times = []
         try:
-            with open(filename, 'r'):
-                pass
-        except (PermissionError, FileNotFoundError):
+            saved_times.append(TableSnapshot(FusionTableHandler.get_snapshot_path(filename)).modified)
+        except (OSError, ValueError):
+            pass
+        if os.path.isfile(filename):
+            saved_times.append(os.path.getmtime(filename))
+        if not saved_times:
             return False
 
         # Obtain the last modified time for the FusionTable.
         info = drive_handler.get_modified_info(tableId)
-        # Obtain the last modified time for the local file.
-        local_mod_time = datetime.datetime.fromtimestamp(
-            os.path.getmtime(filename), datetime.timezone.utc)
+        # The data that read_local_data would use is the most recently saved.
+        local_mod_time = datetime.datetime.fromtimestamp(max(saved_times), datetime.timezone.utc)
         print(f'FusionTable last modified:\t{info["modifiedDatetime"]}\nlocal data last modified:\t{local_mod_time}')
         if local_mod_time > info['modifiedDatetime']:
             print('Local saved data modified more recently than remote FusionTable.',
@@ -948,30 +2808,190 @@ https://developers.google.com/resources/api-libraries/documentation/fusiontables
 
 
     @staticmethod
-    def read_local_data(csv_filename: str, delimiter=',') -> list:
-        '''Attempt to load column data from the specified CSV.
+    def get_snapshot_path(filename: str) -> str:
+        """Returns the name of the columnar snapshot (see TableSnapshot) kept for the given local data file"""
+        return os.path.splitext(filename)[0] + '.snapshot'
+
+
+    @staticmethod
+    def read_local_snapshot(csv_filename: str, delimiter=',') -> TableSnapshot:
+        '''Open the columnar snapshot of the specified local data.
+
+    If the snapshot is missing, or the CSV datafile was saved more recently, the CSV is parsed once
+    and saved as the snapshot, so later reads need not parse it again.
 
     @params:
         csv_filename: str, the name of the CSV datafile in the local directory.
         delimiter: str, the CSV file delimiter that was used to write the file.
 
-    @returns: list, the data read from the local file.
+    @return: TableSnapshot, the local data, or None if there is none.
         '''
         if not (csv_filename and isinstance(csv_filename, str)):
             raise TypeError('Expected string filename')
-        values_from_disk = []
+        path = FusionTableHandler.get_snapshot_path(csv_filename)
+        try:
+            csv_mod_time = os.path.getmtime(csv_filename)
+        except OSError:
+            csv_mod_time = None
+        try:
+            snapshot = TableSnapshot(path)
+            if csv_mod_time is None or snapshot.modified >= csv_mod_time:
+                return snapshot
+        except (OSError, ValueError) as err:
+            if csv_mod_time is None:
+                print("\n", err)
+                return None
+
         try:
             with open(csv_filename, 'r', newline='', encoding='utf-8') as datafile:
                 data_reader = csv.reader(datafile, strict=True, delimiter=delimiter, quoting=csv.QUOTE_NONNUMERIC)
                 values_from_disk = [row for row in data_reader]
         except (FileNotFoundError, PermissionError) as err:
             print("\n", err)
+            return None
+        return TableSnapshot.write(path, values_from_disk, modified=csv_mod_time)
+
+
+    @staticmethod
+    def read_local_data(csv_filename: str, delimiter=',', columns: list = None) -> list:
+        '''Attempt to load column data from the specified CSV (or its columnar snapshot).
+
+    @params:
+        csv_filename: str, the name of the CSV datafile in the local directory.
+        delimiter: str, the CSV file delimiter that was used to write the file.
+        columns: list, the names of the columns to read (see TableSnapshot), if not all of them.
+
+    @returns: list, the data read from the local file.
+        '''
+        snapshot = FusionTableHandler.read_local_snapshot(csv_filename, delimiter)
+        if snapshot is None:
+            return []
+        return snapshot.to_rows(columns)
+
 
-        return values_from_disk
+    def get_mirror_path(self, tableId: str) -> str:
+        """Returns the name of the snapshot which mirrors every row of the given table (see sync_local_mirror)"""
+        return self.get_snapshot_path(self.get_filename_for_table(tableId, '_mirror'))
+
+
+    def _iter_typed_rows(self, query: str):
+        """Yield the typed rows of the query's result, streamed as media if possible, or paged otherwise.
+    Once a row has been yielded, a failure of the stream can no longer be worked around by paging, so it is raised."""
+        received = 0
+        try:
+            _, rows = self.iter_media_rows(query, typed=True)
+            for row in rows:
+                yield row
+                received += 1
+            return
+        except (HttpError, RequestException) as err:
+            if received:
+                raise
+            print('Unable to stream the query result as media, paging through it instead:', err)
+        columns, rows = self.iter_query_rows(query)
+        known = self.get_column_converters(self.get_row_size_key(query)[0])
+        converters = [known.get(name, str) for name in columns]
+        for row in rows:
+            yield [convert(value) for convert, value in zip(converters, row)]
+
+
+    def sync_local_mirror(self, tableId: str, key: str, uid_column='UID') -> TableSnapshot:
+        '''Bring the local mirror of a table up to date, downloading as few of its rows as possible.
+    Rows at or past the mirror's high-water mark of the key column, and the rows of any member whose
+    row count differs, are downloaded and merged. Without a usable mirror, the whole table is downloaded.
+
+    @params:
+        tableId: str, the table to mirror.
+        key: str, the numeric column whose value increases as rows are added.
+        uid_column: str, the column which identifies the member of each row.
+
+    @return: TableSnapshot, the updated mirror.
+        '''
+        path = self.get_mirror_path(tableId)
+        headers = self.get_all_columns(tableId)['headers']
+        columns = ['rowid'] + headers
+        select = 'SELECT ROWID, {} FROM {}'.format(', '.join(f"'{x}'" for x in headers), tableId)
+        key_index = columns.index(key)
+        uid_index = columns.index(uid_column)
+        started = time.time()
+
+        mirror = None
+        try:
+            mirror = TableSnapshot(path)
+            if (mirror.columns != columns or mirror.properties.get('tableId') != tableId
+                    or mirror.properties.get('key') != key):
+                mirror = None
+        except (OSError, ValueError):
+            pass
+
+        if mirror is None or mirror.properties.get('high_water') is None:
+            print(f'Downloading all rows of table \'{tableId}\' to its local mirror...')
+            rows = self._dedupe_rows(self._iter_typed_rows(f'{select} ORDER BY ROWID'))
+            keys = [row[key_index] for row in rows if isinstance(row[key_index], (int, float))]
+            properties = {'tableId': tableId, 'key': key, 'high_water': max(keys) if keys else None}
+            return TableSnapshot.write(path, rows, columns, modified=started, properties=properties)
+
+        high_water = mirror.properties['high_water']
+        new_rows = self._dedupe_rows(self._iter_typed_rows(f'{select} WHERE {key} >= {high_water} ORDER BY {key}'))
+        print(f'Received {len(new_rows):,} rows with {key} >= {high_water} from table \'{tableId}\'')
+        # Rows with the high-water mark itself are always received again, but need not be stored again.
+        replaced = mirror.isin('rowid', (row[0] for row in new_rows))
+        keep = ~replaced
+        previous = {row[0]: row for row in mirror.to_rows(indices=replaced.nonzero()[0])}
+        changed = any(self._normalize_blanks(previous.get(row[0])) != self._normalize_blanks(row)
+                      for row in new_rows)
+
+        # Rows removed from the table (or changed without a new key) are found by comparing row counts.
+        count_result = self.get_query_result(
+            f'SELECT {uid_column}, COUNT() FROM {tableId} GROUP BY {uid_column}', 0.05)
+        if 'rows' not in count_result:
+            print('Unable to count the table\'s rows by member, so its mirror may include deleted rows.')
+        else:
+            remote_counts = {str(uid): int(count) for uid, count in count_result['rows']}
+            local_counts = Counter(mirror.count_values(uid_column, keep))
+            local_counts.update(str(row[uid_index]) for row in new_rows)
+            stale = set(uid for uid in set(remote_counts).union(local_counts)
+                        if remote_counts.get(uid, 0) != local_counts.get(uid, 0))
+            if stale:
+                changed = True
+                print(f'Row counts differ for {len(stale):,} members. Downloading their rows again...')
+                keep &= ~mirror.isin(uid_column, stale)
+                new_rows = [row for row in new_rows if str(row[uid_index]) not in stale]
+                for query, _ in iter_in_clause_queries(f'{select} WHERE {uid_column} IN ({{}}) ORDER BY ROWID',
+                                                       sorted(x for x in stale if x in remote_counts),
+                                                       self.MAX_GET_QUERY_LENGTH):
+                    new_rows.extend(self._iter_typed_rows(query))
+                new_rows = self._dedupe_rows(new_rows)
+
+        if not changed:
+            return mirror
+        keys = [row[key_index] for row in new_rows if isinstance(row[key_index], (int, float))]
+        kept_max = mirror.max_value(key, keep)
+        if kept_max is not None:
+            keys.append(kept_max)
+        properties = {'tableId': tableId, 'key': key, 'high_water': max(keys) if keys else None}
+        # Record the change from the previous snapshot, so that copies of it (e.g. a LocalMirror) can apply just that.
+        updated = [row[0] for row in new_rows]
+        dropped = set(mirror.get_values('rowid', (~keep).nonzero()[0])).difference(updated)
+        properties['delta'] = {'previous': mirror.modified, 'updated': updated, 'removed': sorted(dropped)}
+        return mirror.merge(path, keep, new_rows, modified=started, properties=properties)
+
+
+    @staticmethod
+    def _dedupe_rows(rows) -> list:
+        """Keep only the last of the given rows (whose first value is the ROWID) with each ROWID, in order of first appearance."""
+        return list({row[0]: row for row in rows}.values())
+
+
+    @staticmethod
+    def _normalize_blanks(row: list) -> list:
+        """Represent each blank value of the row as None, so rows read from a mirror compare equal to downloaded rows."""
+        return None if row is None else [None if x == '' else x for x in row]
 
 
 class GCloudService:
     """Basic authenticated Google Cloud API"""
+    rate_governor = GoogleService.rate_governor
 
     def __init__(self, API_NAME: str, API_VERSION: str, project: str, credentials: 'google.auth.credentials.Credentials'):
         self.__client: bigquery.Client = bigquery.Client(project=project, credentials=credentials)
@@ -983,6 +3003,19 @@ class GCloudService:
     def get_client(self) -> bigquery.Client:
         return self.__client
 
+    def call(self, method, *args, **kwargs):
+        """Call the given client method at the pace set by the (process-wide) rate_governor."""
+        api = self.get_api_summary()
+        self.rate_governor.acquire(api)
+        try:
+            result = method(*args, **kwargs)
+        except (TooManyRequests, Forbidden) as err:
+            if isinstance(err, TooManyRequests) or 'rateLimitExceeded' in str(err):
+                self.rate_governor.record_throttled(api)
+            raise
+        self.rate_governor.record_success(api)
+        return result
+
     def get_credentials(self):
         return self.__credentials
 
@@ -1009,7 +3042,7 @@ class BigQueryHandler(GCloudService):
     #need dataset accessor
     def datasets(self):
         '''Consume the dataset iterator and get all datasets for the current client project'''
-        return list(self.get_client().list_datasets())
+        return self.call(lambda: list(self.get_client().list_datasets()))
 
     #need table accessor
     def tables(self, datasetId: str) -> list:
@@ -0,0 +1,333 @@
+"""Columnar on-disk snapshots of table data, which open quickly and read only the columns that are used"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+class TableSnapshot():
+    """A local copy of a table's rows, stored column by column.
+
+A snapshot is a directory holding one .npy array per column, and a meta.json file describing the
+columns. Integer and float columns are stored as int64 and float64 arrays. String columns (like UID
+and Member) are dictionary-encoded: each distinct value is stored once, and each row holds only the
+int32 code of its value. Arrays are memory-mapped when they are first used, so opening a snapshot
+costs only the read of its metadata, and only the columns an operation uses are read from disk.
+
+Values are read back as the type of their column: ints and floats from numeric columns (an int
+written to a column that also holds floats is read back as a float), and strs from string columns
+(a column with any non-numeric value is a string column, so its numbers are read back as strs).
+Blanks (None or '') are read back as empty strings in every column, as from the CSV files written
+by _write_as_csv, for which a snapshot can stand in.
+    """
+    FORMAT_VERSION = 1
+    META_FILE = 'meta.json'
+    # Stored in place of blank values in integer columns (blank floats are stored as NaN).
+    BLANK_INT = np.iinfo(np.int64).min
+
+    def __init__(self, path: str):
+        '''Open the snapshot in the given directory.
+
+    @params:
+        path: str, the snapshot directory (as written by TableSnapshot.write).
+
+    @raises: OSError, if the snapshot cannot be read; ValueError, if it is not a supported snapshot.
+        '''
+        with open(os.path.join(path, self.META_FILE), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != self.FORMAT_VERSION:
+            raise ValueError(f'Unsupported snapshot version {meta.get("version")} in "{path}"')
+        self.path = path
+        self.meta = meta
+        self.columns = [x['name'] for x in meta['columns']]
+        self._specs = {x['name']: x for x in meta['columns']}
+        self._arrays = {}
+
+    def __len__(self) -> int:
+        return self.meta['row_count']
+
+    @property
+    def modified(self) -> float:
+        """The time (as a POSIX timestamp) at which the snapshot's data was current."""
+        return self.meta['modified']
+
+    @property
+    def properties(self) -> dict:
+        """The information (e.g. about the data's source) that was written with the snapshot."""
+        return self.meta.get('properties', {})
+
+    def close(self):
+        """Release the memory-mapped arrays, e.g. before the snapshot is replaced. They are mapped again if used."""
+        self._arrays.clear()
+
+    def get_kind(self, name: str) -> str:
+        """The storage type of the named column: 'int', 'float' or 'str'."""
+        return self._specs[name]['kind']
+
+    def _load(self, filename: str, mmap=True) -> np.ndarray:
+        array = self._arrays.get(filename)
+        if array is None:
+            array = np.load(os.path.join(self.path, filename), mmap_mode='r' if mmap else None)
+            self._arrays[filename] = array
+        return array
+
+    def get_array(self, name: str) -> np.ndarray:
+        '''Get the stored (memory-mapped) array of the named column.
+
+    For string columns, this is the array of dictionary codes (see get_dictionary).
+    Blank numbers are stored as NaN, or as BLANK_INT in integer columns.
+        '''
+        return self._load(self._specs[name]['file'])
+
+    def get_dictionary(self, name: str) -> np.ndarray:
+        """Get the distinct values of the named string column, indexed by their codes."""
+        spec = self._specs[name]
+        if spec['kind'] != 'str':
+            raise TypeError(f'Column "{name}" is not dictionary-encoded')
+        return self._load(spec['dictionary'], mmap=False)
+
+    def get_values(self, name: str, indices=None) -> list:
+        '''Get the values of the named column, as Python objects of the column's type (see TableSnapshot).
+
+    @params:
+        name: str, the column name.
+        indices: list, the positions of the rows whose values to get, in order. Defaults to every row.
+
+    @return: list, the column's value in each row.
+        '''
+        spec = self._specs[name]
+        array = self.get_array(name)
+        if indices is not None:
+            array = array[np.asarray(indices, dtype=np.int64)]
+        if spec['kind'] == 'str':
+            dictionary = self.get_dictionary(name).tolist()
+            return [dictionary[code] for code in array.tolist()]
+        values = array.tolist()
+        if spec.get('blanks'):
+            if spec['kind'] == 'int':
+                return ['' if x == self.BLANK_INT else x for x in values]
+            return ['' if x != x else x for x in values]
+        return values
+
+    def _get_strings(self, name: str) -> np.ndarray:
+        """Get the values of the named column as an array of strings, without making a Python object per row."""
+        if self.get_kind(name) == 'str':
+            return self.get_dictionary(name)[self.get_array(name)]
+        return self.get_array(name).astype(str)
+
+    def isin(self, name: str, values) -> np.ndarray:
+        '''Find the rows whose value in the named column is one of the given values.
+
+    @params:
+        name: str, the column name.
+        values: iterable, the values to find (compared as strings).
+
+    @return: np.ndarray, a boolean mask with an element for each row.
+        '''
+        values = np.array([str(x) for x in values], dtype=str)
+        if self.get_kind(name) == 'str':
+            # Match against the distinct values, and then look up each row's code.
+            return np.isin(self.get_dictionary(name), values)[self.get_array(name)]
+        return np.isin(self._get_strings(name), values)
+
+    def count_values(self, name: str, mask: np.ndarray = None) -> dict:
+        '''Count the rows with each value of the named column.
+
+    @params:
+        name: str, the column name.
+        mask: np.ndarray, a boolean mask of the rows to count. Defaults to every row.
+
+    @return: dict, the number of rows with each value (as a string).
+        '''
+        values = self._get_strings(name)
+        unique, counts = np.unique(values if mask is None else values[mask], return_counts=True)
+        return dict(zip(unique.tolist(), counts.tolist()))
+
+    def max_value(self, name: str, mask: np.ndarray = None):
+        '''Get the largest (non-blank) value of the named numeric column.
+
+    @params:
+        name: str, the column name.
+        mask: np.ndarray, a boolean mask of the rows to consider. Defaults to every row.
+
+    @return: int or float, the largest value, or None if there is none (or the column is not numeric).
+        '''
+        kind = self.get_kind(name)
+        if kind == 'str':
+            return None
+        array = self.get_array(name)
+        array = array if mask is None else array[mask]
+        array = array[array != self.BLANK_INT] if kind == 'int' else array[~np.isnan(array)]
+        return array.max().item() if array.size else None
+
+    def to_rows(self, columns: list = None, indices=None) -> list:
+        '''Assemble the snapshot's rows, e.g. for code that expects the rows of a CSV file.
+
+    @params:
+        columns: list, the names of the columns to include, in order. Defaults to every column.
+        indices: iterable, the positions of the rows to include, in order. Defaults to every row.
+
+    @return: list, a list of values for each row.
+        '''
+        indices = None if indices is None else list(indices)
+        values = [self.get_values(name, indices) for name in (columns or self.columns)]
+        return [list(row) for row in zip(*values)]
+
+
+    @staticmethod
+    def _infer_kind(values) -> str:
+        '''Determine how a column's values can be stored without changing them.
+
+    Columns of ints (and blanks) are 'int', columns of ints and floats (and blanks) are 'float',
+    and columns with any other value are 'str'.
+        '''
+        kind = 'int'
+        for value in values:
+            if isinstance(value, bool):
+                return 'str'
+            elif value == '' or value is None:
+                continue
+            elif isinstance(value, float):
+                kind = 'float'
+            elif not isinstance(value, int):
+                return 'str'
+        return kind
+
+    @staticmethod
+    def _to_str(value) -> str:
+        """Convert a value of a string column to the str that is stored. None is stored as a blank."""
+        return '' if value is None else str(value)
+
+    @classmethod
+    def _encode(cls, values, kind: str) -> tuple:
+        '''Convert a column's values to the arrays that store them.
+
+    @return: tuple(np.ndarray, the column array
+                   np.ndarray, the dictionary of a 'str' column, or None
+                   bool, whether the column has blank numbers)
+        '''
+        if kind == 'str':
+            index = {}
+            codes = np.fromiter((index.setdefault(cls._to_str(x), len(index)) for x in values),
+                                dtype=np.int32, count=len(values))
+            return codes, np.array(list(index), dtype=str), False
+        blank = cls.BLANK_INT if kind == 'int' else float('nan')
+        dtype = np.int64 if kind == 'int' else np.float64
+        blanks = any(x == '' or x is None for x in values)
+        if blanks:
+            values = [blank if x == '' or x is None else x for x in values]
+        return np.array(values, dtype=dtype), None, blanks
+
+    @classmethod
+    def write(cls, path: str, rows, columns: list = None, types: dict = None,
+              modified: float = None, properties: dict = None) -> 'TableSnapshot':
+        '''Write the given rows as a snapshot, replacing any snapshot already in the given directory.
+
+    The snapshot is written beside the directory and then moved into place, so an interrupted write
+    does not leave a partial snapshot behind.
+
+    @params:
+        path: str, the snapshot directory.
+        rows: iterable, the rows (lists of values) to store. All rows must have the same length.
+        columns: list, the name of each column. Defaults to the column indices ('0', '1', ...).
+        types: dict, the kind ('int', 'float' or 'str') to store each named column as. Columns
+                which are not given are stored as the type of their values.
+        modified: float, the time at which the data was current. Defaults to now.
+        properties: dict, JSON-serializable information to keep with the data (see properties).
+
+    @return: TableSnapshot, the written snapshot.
+        '''
+        rows = rows if isinstance(rows, list) else list(rows)
+        width = len(columns) if columns is not None else (len(rows[0]) if rows else 0)
+        if any(len(row) != width for row in rows):
+            raise ValueError('Expected each row to have one value per column.')
+        columns = [str(x) for x in (columns if columns is not None else range(width))]
+        if len(set(columns)) != width:
+            raise ValueError('Column names must be unique.')
+        types = types or {}
+
+        encoded = []
+        for name, values in zip(columns, zip(*rows) if rows else [()] * width):
+            kind = types.get(name) or cls._infer_kind(values)
+            encoded.append((name, kind) + cls._encode(values, kind))
+        return cls._write_columns(path, encoded, len(rows), modified, properties)
+
+    def merge(self, path: str, keep: np.ndarray, rows: list,
+              modified: float = None, properties: dict = None) -> 'TableSnapshot':
+        '''Write a snapshot of the kept rows of this one, followed by the given rows.
+
+    Only the given rows are encoded: the kept rows are copied from the stored arrays, so merging a
+    few changed rows into a large snapshot does not convert every row to Python values and back.
+    A column is only re-encoded in full if the new values do not fit its stored type.
+
+    @params:
+        path: str, the snapshot directory (e.g. this snapshot's own path).
+        keep: np.ndarray, a boolean mask of the rows of this snapshot to keep.
+        rows: list, the rows to add, with a value for each of this snapshot's columns.
+        modified: float, the time at which the data was current. Defaults to now.
+        properties: dict, JSON-serializable information to keep with the data (see properties).
+
+    @return: TableSnapshot, the written snapshot.
+        '''
+        if any(len(row) != len(self.columns) for row in rows):
+            raise ValueError('Expected each row to have one value per column.')
+        encoded = []
+        for name, values in zip(self.columns, zip(*rows) if rows else [()] * len(self.columns)):
+            kind = self.get_kind(name)
+            added = self._infer_kind(values)
+            if kind == 'str':
+                # Extend the dictionary with the new values, and then drop those that no row uses.
+                index = {value: code for code, value in enumerate(self.get_dictionary(name).tolist())}
+                codes = np.fromiter((index.setdefault(self._to_str(x), len(index)) for x in values),
+                                    dtype=np.int32, count=len(values))
+                used, codes = np.unique(np.concatenate((self.get_array(name)[keep], codes)), return_inverse=True)
+                encoded.append((name, kind, codes.astype(np.int32), np.array(list(index), dtype=str)[used], False))
+            elif added == kind or (kind == 'float' and added == 'int'):
+                array = np.concatenate((self.get_array(name)[keep], self._encode(values, kind)[0]))
+                blanks = (array == self.BLANK_INT) if kind == 'int' else np.isnan(array)
+                encoded.append((name, kind, array, None, bool(blanks.any())))
+            else:
+                kind = 'float' if added == 'float' else 'str'
+                values = [x for x, kept in zip(self.get_values(name), keep.tolist()) if kept] + list(values)
+                encoded.append((name, kind) + self._encode(values, kind))
+        self.close()
+        return self._write_columns(path, encoded, int(keep.sum()) + len(rows), modified, properties)
+
+    @classmethod
+    def _write_columns(cls, path: str, encoded: list, row_count: int,
+                       modified: float = None, properties: dict = None) -> 'TableSnapshot':
+        '''Write the encoded columns as a snapshot, replacing any snapshot already in the given directory.
+
+    @params:
+        path: str, the snapshot directory.
+        encoded: list, the (name, kind, array, dictionary, blanks) of each column (see _encode).
+        row_count: int, the number of rows.
+        modified: float, the time at which the data was current. Defaults to now.
+        properties: dict, JSON-serializable information to keep with the data (see properties).
+
+    @return: TableSnapshot, the written snapshot.
+        '''
+        partial = path + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        meta = {'version': cls.FORMAT_VERSION, 'row_count': row_count, 'columns': [],
+                'modified': time.time() if modified is None else modified,
+                'properties': properties or {}}
+        for i, (name, kind, array, dictionary, blanks) in enumerate(encoded):
+            spec = {'name': name, 'kind': kind, 'file': f'{i}.npy'}
+            np.save(os.path.join(partial, spec['file']), array)
+            if dictionary is not None:
+                spec['dictionary'] = f'{i}.dict.npy'
+                np.save(os.path.join(partial, spec['dictionary']), dictionary)
+            if blanks:
+                spec['blanks'] = True
+            meta['columns'].append(spec)
+        with open(os.path.join(partial, cls.META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(partial, path)
+        return cls(path)
@@ -0,0 +1,85 @@
+'''Compares select_interesting_rank_records with the per-record selection it replaced.'''
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mhcc_maintainer  # noqa: E402
+
+INDICES = {'rowid': 0, 'uid': 1, 'rank': 2, 'ls': 3, 'rt': 4}
+
+
+def select_per_record(records: list, indices: dict) -> tuple:
+    '''The original per-record selection: keep the first record of each (UID, LastSeen, Rank) triple.'''
+    tracker = {}
+    rowids = []
+    kept = []
+    for position, record in enumerate(records):
+        uid = str(record[indices['uid']])
+        try:
+            ls = str(int(record[indices['ls']]))
+        except ValueError:
+            continue
+        rank = str(int(record[indices['rank']]))
+        str(int(record[indices['rt']]))
+        if uid not in tracker:
+            tracker[uid] = dict([(ls, {rank})])
+        elif ls not in tracker[uid]:
+            tracker[uid][ls] = {rank}
+        elif rank not in tracker[uid][ls]:
+            tracker[uid][ls].add(rank)
+        else:
+            continue
+        rowids.append(str(record[indices['rowid']]))
+        kept.append(position)
+    return rowids, kept
+
+
+class SelectInterestingRankRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1)
+
+
+    def random_last_seen(self):
+        if self.rng.random() < 0.05:
+            return self.rng.choice(['', 'abc', '1.5', 'NaN'])
+        value = self.rng.randint(0, 20)
+        return self.rng.choice([value, str(value), float(value), ' %d' % value, '0%d' % value])
+
+
+    def random_records(self, count: int) -> list:
+        rng = self.rng
+        return [[rng.choice([i, str(i)]),
+                 rng.choice([rng.randint(0, 5), str(rng.randint(0, 5)), 3.0]),
+                 rng.choice([rng.randint(0, 4), str(rng.randint(0, 4)), 2.9]),
+                 self.random_last_seen(),
+                 rng.randint(0, 10**12)] for i in range(count)]
+
+
+    def test_matches_per_record_selection(self):
+        for trial in range(300):
+            records = self.random_records(self.rng.randint(0, 300))
+            if trial % 2:
+                records.sort(key=lambda r: (str(r[1]), str(r[3]), r[4]))
+            with self.subTest(trial=trial):
+                self.assertEqual(mhcc_maintainer.select_interesting_rank_records(records, INDICES),
+                                 select_per_record(records, INDICES))
+
+
+    def test_skips_invalid_last_seen(self):
+        records = [['1', 'u', 'x', 'bad', 1], ['2', 'u', 1, '', 1]]
+        self.assertEqual(mhcc_maintainer.select_interesting_rank_records(records, INDICES), ([], []))
+
+
+    def test_invalid_rank_or_rank_time_raises(self):
+        for records in ([['1', 'u', 'x', 5, 1]], [['1', 'u', 1, 5, 'y']]):
+            with self.subTest(records=records):
+                with self.assertRaises(ValueError):
+                    select_per_record(records, INDICES)
+                with self.assertRaises(ValueError):
+                    mhcc_maintainer.select_interesting_rank_records(records, INDICES)
+
+
+if __name__ == '__main__':
+    unittest.main()